@@ -0,0 +1,227 @@
+"""A bounded, health-checked pool of database connections per process."""
+import os
+import threading
+import time
+
+from django.db.utils import OperationalError
+
+
+class PoolTimeout(OperationalError):
+    """Raised when no connection is free within the checkout timeout."""
+
+
+class PooledConnection:
+    """A raw connection with the times it was opened and last returned."""
+
+    def __init__(self, connection):
+        """Wrap a newly opened connection."""
+        self.connection = connection
+        self.created_at = self.returned_at = time.monotonic()
+
+
+class ConnectionPool:
+    """
+    Hand out reusable raw connections, at most max_size at a time.
+
+    Idle connections are closed after idle_timeout seconds and every
+    connection after max_lifetime seconds. A connection that sat idle
+    longer than health_check_after seconds is pinged before it is reused.
+    """
+
+    def __init__(self, max_size=10, idle_timeout=300.0, checkout_timeout=5.0,
+                 max_lifetime=3600.0, health_check_after=30.0, ping=None):
+        """Create an empty pool."""
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.ping = ping
+        self._idle = []
+        self._in_use = {}
+        self._lock = threading.Condition()
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'exhausted': 0,
+            'opened': 0,
+            'closed': 0,
+        }
+
+    def checkout(self, connect):
+        """Return an idle connection, or one opened with connect()."""
+        deadline = time.monotonic() + self.checkout_timeout
+        waited = False
+        with self._lock:
+            while True:
+                pooled = self._take_idle()
+                if pooled is None and self.size < self.max_size:
+                    # reserve the slot, then connect outside the lock
+                    pooled = PooledConnection(None)
+                    self._in_use[id(pooled)] = pooled
+                    break
+                if pooled is not None:
+                    self._in_use[id(pooled.connection)] = pooled
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['exhausted'] += 1
+                    raise PoolTimeout(
+                        f"No database connection free after "
+                        f"{self.checkout_timeout} seconds "
+                        f"({self.max_size} in use).")
+                if not waited:
+                    waited = True
+                    self.stats['waits'] += 1
+                started = time.monotonic()
+                self._lock.wait(remaining)
+                self.stats['wait_seconds'] += time.monotonic() - started
+            self.stats['checkouts'] += 1
+
+        if pooled.connection is not None:
+            return pooled.connection
+        try:
+            connection = connect()
+        except Exception:
+            with self._lock:
+                del self._in_use[id(pooled)]
+                self._lock.notify()
+            raise
+        with self._lock:
+            del self._in_use[id(pooled)]
+            pooled.connection = connection
+            pooled.created_at = time.monotonic()
+            self._in_use[id(connection)] = pooled
+            self.stats['opened'] += 1
+        return connection
+
+    def checkin(self, connection):
+        """Return a connection, closing it if it is broken or too old."""
+        now = time.monotonic()
+        with self._lock:
+            pooled = self._in_use.get(id(connection))
+        reusable = pooled is not None
+        if reusable:
+            try:
+                if (is_closed(connection)
+                        or now - pooled.created_at > self.max_lifetime):
+                    raise OperationalError("connection retired")
+                # never hand an open transaction to the next user
+                connection.rollback()
+            except Exception:
+                reusable = False
+        with self._lock:
+            # the slot is freed and refilled in one step, so a waiter woken
+            # by notify() finds either the idle connection or room to open
+            self._in_use.pop(id(connection), None)
+            if reusable:
+                pooled.returned_at = now
+                self._idle.append(pooled)
+            else:
+                self._close(connection)
+            self._lock.notify()
+
+    @property
+    def size(self):
+        """Return the number of open connections, idle or in use."""
+        return len(self._idle) + len(self._in_use)
+
+    def metrics(self):
+        """Return the pool counters, current sizes and connection ages."""
+        now = time.monotonic()
+        with self._lock:
+            ages = [now - pooled.created_at
+                    for pooled in self._idle + list(self._in_use.values())]
+            return dict(
+                self.stats,
+                size=self.size,
+                idle=len(self._idle),
+                in_use=len(self._in_use),
+                max_size=self.max_size,
+                oldest_connection_age=max(ages, default=0.0),
+                mean_connection_age=sum(ages) / len(ages) if ages else 0.0,
+            )
+
+    def close_all(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._close(pooled.connection)
+
+    def _take_idle(self):
+        """Return a healthy idle connection, closing stale ones, or None."""
+        now = time.monotonic()
+        while self._idle:
+            # most recently returned first, so spare connections can expire
+            pooled = self._idle.pop()
+            idle_for = now - pooled.returned_at
+            if (idle_for > self.idle_timeout
+                    or now - pooled.created_at > self.max_lifetime
+                    or is_closed(pooled.connection)
+                    or (idle_for > self.health_check_after
+                        and not self._healthy(pooled.connection))):
+                self._close(pooled.connection)
+                continue
+            return pooled
+        return None
+
+    def _healthy(self, connection):
+        """Return True if the connection answers a ping."""
+        if self.ping is None:
+            return True
+        try:
+            self.ping(connection)
+            return True
+        except Exception:
+            return False
+
+    def _close(self, connection):
+        """Close a raw connection, ignoring errors."""
+        self.stats['closed'] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+def is_closed(connection):
+    """Return True if a raw DB-API connection reports itself closed."""
+    return bool(getattr(connection, 'closed', False))
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options):
+    """Return the pool of a database alias, creating it on first use."""
+    with _pools_lock:
+        if alias not in _pools:
+            _pools[alias] = ConnectionPool(**options)
+        return _pools[alias]
+
+
+def pool_metrics():
+    """Return the metrics of every pool in this process, by alias."""
+    with _pools_lock:
+        pools = dict(_pools)
+    return {alias: pool.metrics() for alias, pool in pools.items()}
+
+
+def close_pools():
+    """Close the idle connections of every pool, e.g. before forking."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+
+def _forget_pools_after_fork():
+    """Drop inherited pools so a forked worker never shares a socket."""
+    _pools.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pools_after_fork)
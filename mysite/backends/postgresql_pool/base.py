@@ -0,0 +1,41 @@
+"""
+PostgreSQL backend that reuses connections from a per-process pool.
+
+Configure the pool with a POOL dict next to the usual settings, e.g.
+``'POOL': {'max_size': 10, 'idle_timeout': 300, 'checkout_timeout': 5}``.
+Django still "closes" the connection at the end of each request, which
+now returns it to the pool instead of tearing down the socket.
+"""
+from django.db.backends.postgresql import base
+
+from mysite.backends.pool import get_pool
+
+
+def ping(connection):
+    """Run a trivial query to check that a connection is alive."""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """A PostgreSQL connection wrapper backed by a ConnectionPool."""
+
+    @property
+    def pool(self):
+        """Return the connection pool of this database alias."""
+        return get_pool(self.alias, dict(self.settings_dict.get('POOL', {}),
+                                         ping=ping))
+
+    def get_new_connection(self, conn_params):
+        """Check a connection out of the pool, opening one if needed."""
+        options = self.settings_dict['OPTIONS']
+        self.isolation_level = base.IsolationLevel(
+            options.get('isolation_level', base.IsolationLevel.READ_COMMITTED))
+        return self.pool.checkout(
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+
+    def _close(self):
+        """Return the connection to the pool instead of closing it."""
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.checkin(self.connection)
@@ -0,0 +1,191 @@
+"""
+Read replicas for the polls pages, with read-your-writes after a write.
+
+A database in DATABASES with a REPLICA entry, e.g. {'weight': 3}, is a
+replica of 'default'. ReplicaMiddleware lets the reads of a safe,
+non-admin request go to the replicas. ReplicaRouter then sends reads of
+REPLICA_APPS models to a healthy replica, picked by weight. Everything
+else goes to the primary: writes, sessions and users, management
+commands and background threads. After a request that may have written,
+the client gets a cookie that keeps it on the primary for
+REPLICA_STICKY_SECONDS, so the results page after a vote counts it.
+
+Reads whose result is cached and shared, like the results table or the
+anonymous index page, run inside primary_reads(): a lagging replica would
+otherwise leave a stale copy under the new version.
+
+Two SQLite files can stand in for a primary and a replica locally:
+
+    DATABASES = {
+        'default': {'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': 'primary.sqlite3'},
+        'replica': {'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': 'replica.sqlite3', 'REPLICA': {'weight': 1}},
+    }
+
+copying primary.sqlite3 to replica.sqlite3 to "replicate".
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.urls import NoReverseMatch, reverse
+
+# only the reads of these apps may lag behind the primary
+REPLICA_APPS = ('polls',)
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# True while handling a request whose reads may go to a replica
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+@contextmanager
+def primary_reads():
+    """Read from the primary inside the with block."""
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_weights(databases):
+    """Return the weight of every replica in DATABASES, by alias."""
+    return {alias: database['REPLICA'].get('weight', 1)
+            for alias, database in databases.items()
+            if 'REPLICA' in database}
+
+
+class ReplicaHealth:
+    """Remember which replicas answered their last check."""
+
+    def __init__(self, interval):
+        """Check each replica at most once per interval seconds."""
+        self.interval = interval
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def is_healthy(self, alias):
+        """Return True if the replica answered its latest check."""
+        now = time.monotonic()
+        with self._lock:
+            healthy, checked_at = self._checked.get(alias, (True, None))
+            if checked_at is not None and now - checked_at < self.interval:
+                return healthy
+            # claim the check, so one request runs it and the rest carry on
+            self._checked[alias] = (healthy, now)
+        healthy = self.check(alias)
+        with self._lock:
+            self._checked[alias] = (healthy, now)
+        return healthy
+
+    def check(self, alias):
+        """Run a trivial query on a replica."""
+        connection = connections[alias]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except DatabaseError:
+            connection.close()
+            return False
+
+
+class ReplicaRouter:
+    """Send the polls reads of safe requests to a weighted healthy replica."""
+
+    def __init__(self, databases=None, health=None):
+        """Find the replicas among the configured databases."""
+        self.weights = replica_weights(databases or settings.DATABASES)
+        self.health = health or ReplicaHealth(
+            settings.REPLICA_HEALTH_CHECK_INTERVAL)
+
+    def db_for_read(self, model, **hints):
+        """Return a replica for reads that may lag, else the primary."""
+        if (not self.weights or not _replica_reads.get()
+                or model._meta.app_label not in REPLICA_APPS):
+            return DEFAULT_DB_ALIAS
+        # related rows come from the replica their object came from
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in self.weights:
+            return instance._state.db
+        healthy = [alias for alias in self.weights
+                   if self.health.is_healthy(alias)]
+        if not healthy:
+            return DEFAULT_DB_ALIAS
+        return random.choices(
+            healthy, weights=[self.weights[alias] for alias in healthy])[0]
+
+    def db_for_write(self, model, **hints):
+        """Write everything to the primary."""
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """Allow relations between rows of the primary and its replicas."""
+        databases = {DEFAULT_DB_ALIAS, *self.weights}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaMiddleware:
+    """Let safe requests read from replicas, and pin writers to the primary."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        """Wrap the next handler."""
+        self.get_response = get_response
+        self._admin_prefix = None
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """Handle a request, sync or async."""
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _replica_reads.set(self.may_read_replicas(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _replica_reads.reset(token)
+        return self.stick(request, response)
+
+    async def __acall__(self, request):
+        """Handle a request under ASGI."""
+        token = _replica_reads.set(self.may_read_replicas(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _replica_reads.reset(token)
+        return self.stick(request, response)
+
+    def may_read_replicas(self, request):
+        """Return True if the request can be answered from a replica."""
+        return (request.method in SAFE_METHODS
+                and settings.REPLICA_STICKY_COOKIE not in request.COOKIES
+                and not request.path.startswith(self.admin_prefix()))
+
+    def stick(self, request, response):
+        """Keep a client that may have written on the primary for a while."""
+        if request.method not in SAFE_METHODS:
+            response.set_cookie(settings.REPLICA_STICKY_COOKIE, '1',
+                                max_age=settings.REPLICA_STICKY_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
+
+    def admin_prefix(self):
+        """Return the path of the admin site, which always reads the primary."""
+        if self._admin_prefix is None:
+            try:
+                self._admin_prefix = reverse('admin:index')
+            except NoReverseMatch:
+                # a prefix no path has
+                self._admin_prefix = '\0'
+        return self._admin_prefix
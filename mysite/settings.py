@@ -14,6 +14,7 @@ from pathlib import Path
 from decouple import config
 
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -34,24 +35,32 @@ LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
-        'details': {
-            'format': '{levelname} {asctime} {module} {message}',
-            'style': '{',
-        },
         'simple': {
             'format': '{levelname} {message}',
             'style': '{',
         },
     },
     'handlers': {
+        # JSON lines written by a background thread, so a slow disk never
+        # holds up a request; all workers share LOG_FILE and rotate it
+        # under a lock; see polls/log.py
         'file': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
-            'filename': 'polls.log',
-            'formatter': 'details',
+            '()': 'polls.log.QueuedJSONHandler',
+            'filename': config('LOG_FILE', default='polls.log'),
+            'max_bytes': config('LOG_MAX_BYTES', cast=int, default=10 * 1024 * 1024),
+            'backup_count': config('LOG_BACKUP_COUNT', cast=int, default=5),
+            'batch_size': config('LOG_BATCH_SIZE', cast=int, default=256),
+            'queue_size': config('LOG_QUEUE_SIZE', cast=int, default=10000),
+            # fraction of the info records of each event that is kept
+            'sample_rates': {
+                'vote': config('LOG_SAMPLE_VOTES', cast=float, default=1.0),
+                'login': config('LOG_SAMPLE_LOGINS', cast=float, default=1.0),
+                'logout': config('LOG_SAMPLE_LOGINS', cast=float, default=1.0),
+            },
         },
         'console': {
-            'level': 'INFO',
+            'level': config('LOG_CONSOLE_LEVEL', default='INFO'),
             'class': 'logging.StreamHandler',
             'formatter': 'simple',
         },
@@ -59,7 +68,7 @@ LOGGING = {
     'loggers': {
         'polls': {
             'handlers': ['file', 'console'],
-            'level': 'DEBUG',
+            'level': config('LOG_LEVEL', default='DEBUG'),
             'propagate': True,
         },
     },
@@ -79,7 +88,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "polls.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "polls.staticfiles.StaticFilesMiddleware",
+    "mysite.routers.ReplicaMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -90,6 +102,16 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = "mysite.urls"
 
+# Flash messages travel in a signed cookie, so anonymous visitors reading
+# polls never read or write the django_session table; only signing in
+# (and so voting) creates a session.
+MESSAGE_STORAGE = config('MESSAGE_STORAGE', default='django.contrib.messages.storage.cookie.CookieStorage')
+
+# Views going over their query budget raise under DEBUG and in the tests,
+# and are logged otherwise (see polls/budget.py).
+QUERY_BUDGET_RAISE = config('QUERY_BUDGET_RAISE', cast=bool, default=DEBUG)
+TEST_RUNNER = 'polls.test_runner.QueryBudgetRunner'
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -106,6 +128,24 @@ TEMPLATES = [
     },
 ]
 
+# The polls pages are rendered with 'django' or, with the jinja2 package
+# installed, 'jinja2' templates (see polls/rendering.py).
+POLLS_TEMPLATE_ENGINE = config('POLLS_TEMPLATE_ENGINE', default='django')
+JINJA2_TEMPLATES = {
+    "BACKEND": "django.template.backends.jinja2.Jinja2",
+    "DIRS": [],
+    "APP_DIRS": True,
+    "OPTIONS": {
+        "environment": "polls.rendering.environment",
+        "context_processors": [
+            "django.contrib.auth.context_processors.auth",
+            "django.contrib.messages.context_processors.messages",
+        ],
+    },
+}
+if POLLS_TEMPLATE_ENGINE == 'jinja2':
+    TEMPLATES.append(JINJA2_TEMPLATES)
+
 WSGI_APPLICATION = "mysite.wsgi.application"
 
 
@@ -115,16 +155,87 @@ WSGI_APPLICATION = "mysite.wsgi.application"
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        # PostgreSQL with a per-process connection pool (mysite/backends)
+        'ENGINE': 'mysite.backends.postgresql_pool',
         'NAME': os.getenv('POSTGRES_DB', 'ku_polls'),
         'USER': os.getenv('POSTGRES_USER', 'your_postgres_user'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'your_postgres_password'),
         'HOST': 'db',  # Matches the service name in docker-compose.yml
         'PORT': 5432,
+        'POOL': {
+            'max_size': config('DB_POOL_MAX_SIZE', cast=int, default=10),
+            'idle_timeout': config('DB_POOL_IDLE_TIMEOUT', cast=float, default=300),
+            'checkout_timeout': config('DB_POOL_CHECKOUT_TIMEOUT', cast=float, default=5),
+            'max_lifetime': config('DB_POOL_MAX_LIFETIME', cast=float, default=3600),
+        },
+    }
+}
+
+# Read replicas of the primary, as "host" or "host*weight", comma-separated.
+# Reads of the polls pages go to them; see mysite/routers.py. A client that
+# posted anything reads the primary for REPLICA_STICKY_SECONDS after.
+REPLICA_HOSTS = config('DATABASE_REPLICAS', default='')
+for number, replica in enumerate(filter(None, REPLICA_HOSTS.split(',')), 1):
+    host, _, weight = replica.strip().partition('*')
+    DATABASES[f'replica{number}'] = dict(
+        DATABASES['default'], HOST=host, REPLICA={'weight': int(weight or 1)},
+        TEST={'MIRROR': 'default'})
+DATABASE_ROUTERS = ['mysite.routers.ReplicaRouter']
+REPLICA_HEALTH_CHECK_INTERVAL = config('REPLICA_HEALTH_CHECK_INTERVAL', cast=float, default=5.0)
+REPLICA_STICKY_SECONDS = config('REPLICA_STICKY_SECONDS', cast=int, default=10)
+REPLICA_STICKY_COOKIE = 'polls_primary'
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# The local-memory default is only for one process; `serve` refuses more
+# than one worker with it. docker.env points CACHE_BACKEND at Redis.
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='ku-polls'),
     }
 }
 
 
+# finalize_polls freezes the results of polls closed more than this many
+# seconds ago, leaving time for votes still being written.
+POLLS_FINALIZE_GRACE = config('POLLS_FINALIZE_GRACE', cast=int, default=300)
+
+# Vote ingestion: 'sync' writes each vote in its request, 'buffered' queues
+# it in the POLLS_VOTE_JOURNAL file for the flush_votes command to write.
+
+POLLS_VOTE_INGESTION = config('POLLS_VOTE_INGESTION', default='sync')
+POLLS_VOTE_JOURNAL = config('POLLS_VOTE_JOURNAL', default=str(BASE_DIR / 'vote-journal.sqlite3'))
+
+# The most votes one request to the kiosk batch API may carry.
+POLLS_VOTE_BATCH_MAX_SIZE = config('POLLS_VOTE_BATCH_MAX_SIZE', cast=int, default=10000)
+
+# The most questions one request to the results API may ask for.
+POLLS_RESULTS_API_MAX_IDS = config('POLLS_RESULTS_API_MAX_IDS', cast=int, default=500)
+
+# Serve the polls views from polls.async_views (for ASGI servers).
+POLLS_ASYNC_VIEWS = config('POLLS_ASYNC_VIEWS', cast=bool, default=False)
+
+# Question dates and choice lists are cached in each process for up to
+# POLLS_QUESTION_CACHE_TTL seconds (see polls/question_cache.py). Turn on
+# the shared invalidation when CACHES is shared by all processes, so edits
+# are seen everywhere at once.
+POLLS_QUESTION_CACHE_TTL = config('POLLS_QUESTION_CACHE_TTL', cast=float, default=30)
+POLLS_QUESTION_CACHE_MAX_ENTRIES = config('POLLS_QUESTION_CACHE_MAX_ENTRIES', cast=int, default=10000)
+POLLS_QUESTION_CACHE_MAX_BYTES = config('POLLS_QUESTION_CACHE_MAX_BYTES', cast=int, default=8 * 1024 * 1024)
+POLLS_QUESTION_CACHE_SHARED_INVALIDATION = config('POLLS_QUESTION_CACHE_SHARED_INVALIDATION', cast=bool, default=False)
+
+# Each worker process writes its request metrics to METRICS_DIR at most
+# every METRICS_FLUSH_INTERVAL seconds; /metrics adds them all up. It
+# answers only requests with "Authorization: Bearer <METRICS_TOKEN>", so it
+# stays closed while METRICS_TOKEN is unset.
+METRICS_DIR = config('METRICS_DIR', default=os.path.join(tempfile.gettempdir(), 'ku-polls-metrics'))
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', cast=float, default=1.0)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -161,6 +272,39 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.2/howto/static-files/
 
 STATIC_URL = "static/"
+STATIC_ROOT = config('STATIC_ROOT', default=str(BASE_DIR / 'staticfiles'))
+
+# With STATIC_MANIFEST, collectstatic writes content-hashed, precompressed
+# files and pages link to the hashed names, so collectstatic must run
+# before the site serves pages (see polls/staticfiles.py).
+STATIC_MANIFEST = config('STATIC_MANIFEST', cast=bool, default=False)
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": ("polls.staticfiles.CompressedManifestStaticFilesStorage"
+                    if STATIC_MANIFEST else
+                    "django.contrib.staticfiles.storage.StaticFilesStorage"),
+    },
+}
+# Serve STATIC_ROOT from the app; hashed names are cached for a year,
+# others for STATIC_MAX_AGE seconds.
+STATIC_SERVE = config('STATIC_SERVE', cast=bool, default=True)
+STATIC_MAX_AGE = config('STATIC_MAX_AGE', cast=int, default=60)
+# collectstatic scales wider images down to this many pixels
+STATIC_IMAGE_MAX_WIDTH = config('STATIC_IMAGE_MAX_WIDTH', cast=int,
+                                default=1920)
+
+# The production server (python manage.py serve). SERVER_WORKERS = 0 sizes
+# the workers from the CPU count, or runs a single worker while the cache is
+# process-local (LocMemCache); each worker is replaced after about
+# SERVER_MAX_REQUESTS requests, jittered so they do not restart together.
+SERVER_BIND = config('SERVER_BIND', default='0.0.0.0:8000')
+SERVER_WORKERS = config('SERVER_WORKERS', cast=int, default=0)
+SERVER_MAX_REQUESTS = config('SERVER_MAX_REQUESTS', cast=int, default=1000)
+SERVER_MAX_REQUESTS_JITTER = config('SERVER_MAX_REQUESTS_JITTER', cast=int,
+                                    default=100)
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
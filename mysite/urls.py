@@ -24,5 +24,6 @@ urlpatterns = [
     path('polls/', include('polls.urls')),
     path("admin/", admin.site.urls),
     path('accounts/', include('django.contrib.auth.urls')),
-    path('signup/', views.signup, name='signup')
+    path('signup/', views.signup, name='signup'),
+    path('metrics', views.metrics, name='metrics'),
 ]
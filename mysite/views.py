@@ -2,8 +2,16 @@ from django.shortcuts import render, redirect
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib import messages
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
 
+from polls import metrics as polls_metrics
+from polls.budget import query_budget
 
+
+@query_budget(8)
 def signup(request):
     """Register a new user."""
     if request.method == 'POST':
@@ -22,4 +30,14 @@ def signup(request):
     else:
         # create a user form and display it the signup page
         form = UserCreationForm()
-    return render(request, 'registration/signup.html', {'form': form})
\ No newline at end of file
+    return render(request, 'registration/signup.html', {'form': form})
+
+@require_GET
+def metrics(request):
+    """Show the request metrics of every worker in Prometheus format."""
+    expected = f'Bearer {settings.METRICS_TOKEN}'
+    if not settings.METRICS_TOKEN or not constant_time_compare(
+            request.headers.get('Authorization', ''), expected):
+        return HttpResponseForbidden()
+    return HttpResponse(polls_metrics.render(),
+                        content_type='text/plain; version=0.0.4')
@@ -0,0 +1,18 @@
+from django.urls import path, re_path
+
+from . import async_views, views
+
+app_name = 'kupolls'
+urlpatterns = [
+    path('', async_views.index, name='index'),
+    path('<int:pk>/', async_views.detail, name='detail'),
+    path('<int:pk>/results/', async_views.results, name='results'),
+    path('<int:pk>/results/stream/', async_views.results_stream,
+         name='results_stream'),
+    path('<int:pk>/results/poll/', async_views.results_poll, name='results_poll'),
+    path('api/results', async_views.results_api, name='results_api'),
+    path('api/votes/', views.vote_batch, name='vote_batch'),
+    path('<int:question_id>/vote/', async_views.vote, name='vote'),
+    re_path(r'^export/(?P<kind>votes|results)\.(?P<export_format>csv|ndjson)$',
+            async_views.export_data, name='export'),
+]
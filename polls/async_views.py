@@ -0,0 +1,273 @@
+"""Async versions of the index, detail, results and vote views."""
+import logging
+from contextlib import nullcontext
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, transaction
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+                         JsonResponse, StreamingHttpResponse)
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from mysite.routers import primary_reads
+
+from . import metrics
+from .cache import (aget_results_table, aindex_version, index_page_key,
+                    index_timeout, invalidate_results)
+from .conditional import (aresults_validators, may_have_messages,
+                          not_modified, set_validators)
+from .export import aiterate
+from .ingest import buffered_ingestion, get_journal
+from .live import afinal_tally, astream_tally, await_tally
+from .models import Question, ResultSnapshot, Vote
+from .question_cache import aget_choices, aget_question, forget_question
+from .rendering import (load_messages, render_page, render_template,
+                        signed_in)
+from .views import (choices_of, export_response, find_choice,
+                    index_page_validators, index_queryset, is_anonymous_read,
+                    next_index_changes, results_api_response,
+                    split_index_page)
+
+logger = logging.getLogger('polls')
+
+
+async def load_session_state(request):
+    """
+    Resolve the lazy user and flash messages of a request.
+
+    The user, and messages unless MESSAGE_STORAGE keeps them in a cookie,
+    read the session table, which the async ORM cannot do, so they are
+    loaded in a worker thread. Visitors without a session cookie have
+    nothing to load and stay on the event loop.
+    """
+    if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+        return
+
+    def load():
+        signed_in(request)
+        load_messages(request)
+
+    await sync_to_async(load)()
+
+
+async def get_question(request, pk, unpublished_message):
+    """Return a published question, or None after flashing an error."""
+    question = await aget_question(pk)
+    if question is None:
+        messages.error(request, f"Poll number {pk} does not exists.")
+        return None
+    if not question.is_published():
+        messages.error(request, unpublished_message.format(pk=question.id))
+        return None
+    return question
+
+
+async def index(request):
+    """Show one page of published questions, newest first."""
+    anonymous = is_anonymous_read(request)
+    if anonymous:
+        version = await aindex_version()
+        key = index_page_key(request.GET, version)
+        page = await cache.aget(key)
+        if page is not None:
+            content, etag, last_modified = page
+            return (not_modified(request, etag, last_modified)
+                    or set_validators(HttpResponse(content), etag,
+                                      last_modified))
+    await load_session_state(request)
+    now = timezone.now()
+    # a page shared by every visitor is read from the primary
+    with primary_reads() if anonymous else nullcontext():
+        page, next_cursor = split_index_page(
+            [question async for question in index_queryset(request.GET)])
+        response = render_page(request, 'polls/index.html', {
+            'latest_question_list': page,
+            'next_cursor': next_cursor,
+            'status': request.GET.get('status', ''),
+            'signed_in': signed_in(request),
+        })
+        if anonymous:
+            timeout = index_timeout(now, (await Question.objects.aaggregate(
+                **next_index_changes(now))).values())
+    if anonymous and timeout > 0:
+        etag, last_modified = index_page_validators(version, now)
+        await cache.aset(key, (response.content, etag, last_modified),
+                         timeout)
+        set_validators(response, etag, last_modified)
+    return response
+
+
+async def detail(request, pk):
+    """Show the voting form of a question that is open for voting."""
+    await load_session_state(request)
+    question = await get_question(
+        request, pk, "Poll number {pk} is not published yet.")
+    if question is None:
+        return redirect("kupolls:index")
+    if not question.can_vote():
+        messages.error(request,
+                       f"Poll number {question.id} is not available to vote.")
+        return redirect("kupolls:index")
+
+    user_vote = None
+    if request.user.is_authenticated:
+        user_vote = await (Vote.objects
+                           .filter(user=request.user, question=question)
+                           .values_list('choice_id', flat=True).afirst())
+    return render_page(request, 'polls/detail.html', {
+        'question': question,
+        'choices': await aget_choices(question.id),
+        'user_vote': user_vote,
+        'error_message': request.GET.get('error_message'),
+    })
+
+
+async def results(request, pk):
+    """Show the vote counts of a published question."""
+    await load_session_state(request)
+    question = await get_question(
+        request, pk, "Result for poll number {pk} is not available yet.")
+    if question is None:
+        return redirect("kupolls:index")
+    conditional = not may_have_messages(request)
+    if conditional:
+        etag, last_modified = await aresults_validators(question)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+
+    async def render_table():
+        if not question.can_vote():
+            html = await (ResultSnapshot.objects
+                          .filter(question_id=question.id)
+                          .values_list('html', flat=True).afirst())
+            if html is not None:
+                return html
+        choices = [choice async for choice
+                   in choices_of(question, 'choice_text', 'vote_count')]
+        return render_template('polls/results_table.html',
+                               {'choices': choices})
+
+    results_table = await aget_results_table(question.id, render_table)
+    response = render_page(request, 'polls/results.html', {
+        'question': question,
+        'results_table': mark_safe(results_table),
+        'live': question.can_vote(),
+    })
+    if conditional:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+async def published_question_or_404(pk):
+    """Return a published question or raise Http404."""
+    question = await aget_question(pk)
+    if question is None or not question.is_published():
+        raise Http404(f"Poll number {pk} is not available.")
+    return question
+
+
+async def results_stream(request, pk):
+    """Stream live vote counts of a question as Server-Sent Events."""
+    question = await published_question_or_404(pk)
+    if not question.can_vote():
+        # the counts are final; 204 stops the EventSource reconnecting
+        return HttpResponse(status=204)
+    response = StreamingHttpResponse(astream_tally(question.id, question.end_date),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # keep proxies from buffering the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def results_poll(request, pk):
+    """Return the vote counts once they change from the ?since= version."""
+    question = await published_question_or_404(pk)
+    if not question.can_vote():
+        return JsonResponse(await afinal_tally(question.id))
+    payload = await await_tally(question.id, request.GET.get('since', ''))
+    if payload is None:
+        return HttpResponse(status=204)
+    return JsonResponse(payload)
+
+
+async def results_api(request):
+    """Return the vote counts of several questions, streaming long lists."""
+    return await sync_to_async(results_api_response)(request, wrap=aiterate)
+
+
+async def export_data(request, kind, export_format):
+    """Stream votes or per-choice results without buffering them."""
+    await load_session_state(request)
+    if not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    if not await sync_to_async(request.user.has_perm)('polls.view_vote'):
+        raise PermissionDenied
+    return export_response(request, kind, export_format, wrap=aiterate)
+
+
+def record_vote(user, choice):
+    """Write a vote and invalidate the cached results once committed."""
+    with transaction.atomic():
+        Vote.objects.record(user, choice)
+        transaction.on_commit(
+            lambda: invalidate_results(choice.question_id))
+
+
+async def vote(request, question_id):
+    """Vote for one of the answers to a question."""
+    await load_session_state(request)
+    this_user = request.user
+    if not this_user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+
+    with metrics.timer('polls_vote_phase_seconds', phase='lookup'):
+        question = await aget_question(question_id)
+        if question is None:
+            raise Http404(f"Poll number {question_id} does not exist.")
+        choices = await aget_choices(question.id)
+        selected_choice = find_choice(choices, request.POST.get('choice'))
+
+    if not question.can_vote():
+        logger.info("User %s attempted to vote on closed question %s",
+                    this_user.pk, question_id,
+                    extra={'event': 'vote_rejected', 'user_id': this_user.pk,
+                           'question_id': question_id})
+        error_message = "Voting is not allowed for this question."
+    elif selected_choice is None:
+        error_message = "You didn't select a choice."
+    else:
+        error_message = None
+    if error_message:
+        return render_page(request, 'polls/detail.html', {
+            'question': question,
+            'choices': choices,
+            'error_message': error_message,
+        })
+
+    with metrics.timer('polls_vote_phase_seconds', phase='write'):
+        if buffered_ingestion():
+            await sync_to_async(get_journal().append)(
+                this_user.pk, question.id, selected_choice.id)
+        else:
+            try:
+                await sync_to_async(record_vote)(this_user, selected_choice)
+            except IntegrityError:
+                # the cached choice was deleted by another process
+                forget_question(question.id)
+                raise Http404(f"Choice {selected_choice.id} does not exist.")
+    logger.info("User %s voted on question %s for choice %s",
+                this_user.pk, question.id, selected_choice.id,
+                extra={'event': 'vote', 'user_id': this_user.pk,
+                       'question_id': question.id,
+                       'choice_id': selected_choice.id})
+    messages.success(request, "Your vote has been recorded")
+    return HttpResponseRedirect(reverse('kupolls:results',
+                                        args=(question.id,)))
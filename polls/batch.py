@@ -0,0 +1,157 @@
+"""
+Batched vote submission for kiosks and offline clients.
+
+A kiosk collects votes while offline and replays them in one request,
+with the bearer token of a user with the add_vote permission (see
+polls.tokens), instead of one vote form per voter. check_votes()
+validates a whole batch with one query for the voters and one for the
+choices and their questions, and submit_votes() writes the valid votes
+in one transaction through Vote.objects.record_many().
+
+Every vote carries the time it was cast on the kiosk and is only written
+if the voter has no later vote on the question, so replaying a batch that
+was already applied changes nothing and reports its votes as duplicates.
+"""
+import json
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .cache import invalidate_results
+from .models import RECORDED, STALE, Choice, Question, Vote
+
+REJECTED = 'rejected'
+# how far ahead of the server a kiosk clock may run
+MAX_CLOCK_SKEW = timezone.timedelta(minutes=5)
+
+
+class BatchError(ValueError):
+    """Raised when the body of a batch request cannot be used."""
+
+
+def parse_batch(body, max_size):
+    """Return the vote records of a JSON request body."""
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise BatchError("The body is not valid JSON.")
+    records = payload.get('votes') if isinstance(payload, dict) else None
+    if not isinstance(records, list):
+        raise BatchError('The body must be an object with a "votes" list.')
+    if len(records) > max_size:
+        raise BatchError(f"A batch holds at most {max_size} votes.")
+    return records
+
+
+def parse_record(record, now):
+    """
+    Return the (user_id, question_id, choice_id, cast_at) of a vote record.
+
+    Raise ValueError, with a message for the client, if it is malformed.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("A vote must be an object.")
+    ids = []
+    for field in ('user', 'question', 'choice'):
+        value = record.get(field)
+        # JSON true and false are ints to Python
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(f'"{field}" must be an integer id.')
+        ids.append(value)
+    timestamp = record.get('client_timestamp')
+    try:
+        cast_at = parse_datetime(timestamp)
+    except (TypeError, ValueError):
+        cast_at = None
+    if cast_at is None:
+        raise ValueError('"client_timestamp" must be an ISO 8601 time.')
+    if timezone.is_naive(cast_at):
+        cast_at = timezone.make_aware(cast_at)
+    if cast_at > now + MAX_CLOCK_SKEW:
+        raise ValueError('"client_timestamp" is in the future.')
+    return (*ids, cast_at)
+
+
+def rejected(error):
+    """Return the result of a vote that was not written."""
+    return {'status': REJECTED, 'error': error}
+
+
+def check_votes(records):
+    """
+    Validate vote records against the voters and the open questions.
+
+    A question must be open when the batch arrives, not only when the vote
+    was cast, so a kiosk that flushes after a poll closes has its votes on
+    that poll rejected.
+
+    Return a list with the result of every rejected record and None for
+    the others, and the parsed votes that may be written, by index.
+    """
+    now = timezone.now()
+    results = [None] * len(records)
+    votes = {}
+    for index, record in enumerate(records):
+        try:
+            votes[index] = parse_record(record, now)
+        except ValueError as error:
+            results[index] = rejected(str(error))
+
+    voters = set(User.objects.filter(
+        pk__in={vote[0] for vote in votes.values()}, is_active=True,
+    ).values_list('pk', flat=True))
+    choices = {}
+    is_open = {}
+    for choice_id, question_id, pub_date, end_date in Choice.objects.filter(
+            pk__in={vote[2] for vote in votes.values()}).values_list(
+                'pk', 'question_id', 'question__pub_date',
+                'question__end_date'):
+        choices[choice_id] = question_id
+        if question_id not in is_open:
+            is_open[question_id] = Question(
+                pk=question_id, pub_date=pub_date,
+                end_date=end_date).can_vote()
+
+    for index, (user_id, question_id, choice_id, _) in list(votes.items()):
+        if user_id not in voters:
+            error = "There is no active user with this id."
+        elif choices.get(choice_id) != question_id:
+            error = "The choice is not one of the question's choices."
+        elif not is_open[question_id]:
+            error = "Voting is not allowed for this question."
+        else:
+            continue
+        results[index] = rejected(error)
+        del votes[index]
+    return results, votes
+
+
+def submit_votes(records):
+    """Validate and write a batch of vote records, returning their results."""
+    results, votes = check_votes(records)
+    # the vote cast last wins; sorting is stable, so ties go to the later record
+    latest = {}
+    for index, vote in sorted(votes.items(), key=lambda item: item[1][3]):
+        pair = vote[:2]
+        if pair in latest:
+            results[latest[pair][0]] = {'status': STALE}
+        latest[pair] = (index, vote)
+
+    with transaction.atomic():
+        outcomes = Vote.objects.record_many(vote for _, vote in latest.values())
+        changed = {question_id for (_, question_id), outcome
+                   in outcomes.items() if outcome == RECORDED}
+        for question_id in changed:
+            transaction.on_commit(
+                lambda question_id=question_id: invalidate_results(question_id))
+    for pair, (index, _) in latest.items():
+        results[index] = {'status': outcomes[pair]}
+    return results
+
+
+def count_results(results):
+    """Return how many records ended with each status."""
+    return dict(Counter(result['status'] for result in results))
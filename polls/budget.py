@@ -0,0 +1,105 @@
+"""
+Query budgets for views.
+
+A view decorated with query_budget() may run at most max_queries SQL
+queries, and no single SQL statement more than max_duplicates times, the
+signature of an N+1 loop. Going over raises QueryBudgetExceeded when
+QUERY_BUDGET_RAISE is true (under DEBUG and in the test suite) and is
+logged with the repeated SQL and where it was run from otherwise.
+"""
+import logging
+import traceback
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('polls')
+
+DEFAULT_MAX_DUPLICATES = 1
+# transaction control depends on the database and the surrounding
+# transaction, not on the view, so it is not counted
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT',
+                          'RELEASE SAVEPOINT')
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a view runs more queries than its budget allows."""
+
+
+class QueryWatcher:
+    """A database execute wrapper that counts queries and repeats."""
+
+    def __init__(self, max_duplicates):
+        """Start with no queries."""
+        self.max_duplicates = max_duplicates
+        self.statements = Counter()
+        self.sample_stack = None
+
+    def __call__(self, execute, sql, params, many, context):
+        """Count one query, keeping a stack of the first one repeated."""
+        if not sql.lstrip().upper().startswith(TRANSACTION_STATEMENTS):
+            self.statements[sql] += 1
+            if (self.sample_stack is None
+                    and self.statements[sql] > self.max_duplicates):
+                self.sample_stack = ''.join(traceback.format_stack(limit=12))
+        return execute(sql, params, many, context)
+
+    @property
+    def queries(self):
+        """Return the number of queries run."""
+        return sum(self.statements.values())
+
+    def most_repeated(self):
+        """Return the most repeated SQL and how often it ran."""
+        return self.statements.most_common(1)[0] if self.statements else ('', 0)
+
+
+@contextmanager
+def watch_queries(watcher):
+    """Pass the queries run on every database inside the block to watcher."""
+    with ExitStack() as stack:
+        # replicas too, since the router may send reads to any of them
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(watcher))
+        yield
+
+
+def query_budget(max_queries, max_duplicates=DEFAULT_MAX_DUPLICATES):
+    """
+    Limit the queries a view runs while it builds its response.
+
+    Queries on every database count, whichever one the router picks. A
+    template response is rendered inside the budget. Queries run later,
+    while a streaming response is consumed, are not counted. Use
+    method_decorator() to put a budget on a class-based view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            watcher = QueryWatcher(max_duplicates)
+            with watch_queries(watcher):
+                response = view(request, *args, **kwargs)
+                if not getattr(response, 'is_rendered', True):
+                    response.render()
+            check_budget(request, view, watcher, max_queries, max_duplicates)
+            return response
+        return wrapper
+    return decorator
+
+
+def check_budget(request, view, watcher, max_queries, max_duplicates):
+    """Raise or log if a request went over its query budget."""
+    sql, repeats = watcher.most_repeated()
+    if watcher.queries <= max_queries and repeats <= max_duplicates:
+        return
+    match = getattr(request, 'resolver_match', None)
+    name = match.view_name if match else view.__qualname__
+    message = (f"{name} ran {watcher.queries} queries (budget {max_queries}); "
+               f"the most repeated ran {repeats} times (budget "
+               f"{max_duplicates}): {sql}")
+    if settings.QUERY_BUDGET_RAISE:
+        raise QueryBudgetExceeded(message)
+    logger.warning("%s\n%s", message, watcher.sample_stack or '')
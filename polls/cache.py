@@ -0,0 +1,202 @@
+"""
+Caching of rendered poll results, invalidated whenever votes change, and
+of the anonymous index page, invalidated whenever a question changes.
+
+Each version is stored with the time it last changed, which
+polls.conditional turns into ETag and Last-Modified headers.
+"""
+import asyncio
+import hashlib
+import time
+
+from django.core.cache import cache
+
+from mysite.routers import primary_reads
+
+RESULTS_CACHE_TIMEOUT = 60 * 60
+RESULTS_LOCK_TIMEOUT = 10
+RESULTS_LOCK_WAIT = 2.0
+RESULTS_LOCK_POLL_INTERVAL = 0.02
+# the index is rendered again at least this often, in seconds
+INDEX_CACHE_MAX_TIMEOUT = 60 * 60
+INDEX_VERSION_KEY = 'polls:index-version'
+
+
+def results_version_key(question_id):
+    """Return the cache key of a question's results version."""
+    return f'polls:results-version:{question_id}'
+
+
+def changed_key(version_key):
+    """Return the cache key of the time a version last changed."""
+    return f'{version_key}:changed'
+
+
+def new_version():
+    """
+    Return a version for a key the cache does not hold.
+
+    Versions start from the clock, not from 1, so a key that was evicted
+    or lost with a cache restart never returns to a version whose pages
+    are still cached here or in a client.
+    """
+    return time.time_ns()
+
+
+def results_version(question_id):
+    """Return the current results version of a question."""
+    key = results_version_key(question_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(changed_key(key), time.time(), None)
+        version = new_version()
+        cache.add(key, version, None)
+        version = cache.get(key, version)
+    return version
+
+
+def results_versions(question_ids):
+    """Return the current results versions of several questions, by id."""
+    keys = {results_version_key(question_id): question_id
+            for question_id in question_ids}
+    versions = {keys[key]: version
+                for key, version in cache.get_many(keys).items()}
+    for question_id in question_ids:
+        if question_id not in versions:
+            versions[question_id] = results_version(question_id)
+    return versions
+
+
+async def aresults_version(question_id):
+    """Return the current results version of a question, asynchronously."""
+    key = results_version_key(question_id)
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(changed_key(key), time.time(), None)
+        version = new_version()
+        await cache.aadd(key, version, None)
+        version = await cache.aget(key, version)
+    return version
+
+
+def bump(key):
+    """Increment a version and record when it changed."""
+    cache.set(changed_key(key), time.time(), None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, new_version(), None)
+
+
+def invalidate_results(question_id):
+    """Bump the results version so the cached results are rendered again."""
+    bump(results_version_key(question_id))
+
+
+def get_results_table(question_id, render_table):
+    """
+    Return the cached results table of a question.
+
+    On a miss only one worker calls render_table(); the others wait for
+    its result and fall back to rendering themselves if it takes too long.
+    The table is cached under the current version, so it is read from the
+    primary database.
+    """
+    key = f'polls:results:{question_id}:{results_version(question_id)}'
+    table = cache.get(key)
+    if table is not None:
+        return table
+
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, RESULTS_LOCK_TIMEOUT):
+        try:
+            with primary_reads():
+                table = render_table()
+            cache.set(key, table, RESULTS_CACHE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+        return table
+
+    deadline = time.monotonic() + RESULTS_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(RESULTS_LOCK_POLL_INTERVAL)
+        table = cache.get(key)
+        if table is not None:
+            return table
+    with primary_reads():
+        return render_table()
+
+
+async def aget_results_table(question_id, render_table):
+    """Return the cached results table like get_results_table(), async."""
+    key = f'polls:results:{question_id}:{await aresults_version(question_id)}'
+    table = await cache.aget(key)
+    if table is not None:
+        return table
+
+    lock_key = f'{key}:lock'
+    if await cache.aadd(lock_key, 1, RESULTS_LOCK_TIMEOUT):
+        try:
+            with primary_reads():
+                table = await render_table()
+            await cache.aset(key, table, RESULTS_CACHE_TIMEOUT)
+        finally:
+            await cache.adelete(lock_key)
+        return table
+
+    deadline = time.monotonic() + RESULTS_LOCK_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(RESULTS_LOCK_POLL_INTERVAL)
+        table = await cache.aget(key)
+        if table is not None:
+            return table
+    with primary_reads():
+        return await render_table()
+
+
+def index_version():
+    """Return the current version of the index page."""
+    version = cache.get(INDEX_VERSION_KEY)
+    if version is None:
+        cache.add(changed_key(INDEX_VERSION_KEY), time.time(), None)
+        version = new_version()
+        cache.add(INDEX_VERSION_KEY, version, None)
+        version = cache.get(INDEX_VERSION_KEY, version)
+    return version
+
+
+async def aindex_version():
+    """Return the current version of the index page, asynchronously."""
+    version = await cache.aget(INDEX_VERSION_KEY)
+    if version is None:
+        await cache.aadd(changed_key(INDEX_VERSION_KEY), time.time(), None)
+        version = new_version()
+        await cache.aadd(INDEX_VERSION_KEY, version, None)
+        version = await cache.aget(INDEX_VERSION_KEY, version)
+    return version
+
+
+def invalidate_index():
+    """Bump the index version so every cached index page is rendered again."""
+    bump(INDEX_VERSION_KEY)
+
+
+def index_page_key(params, version):
+    """Return the cache key of the index page the params ask for."""
+    # only the parameters the page depends on, so others cannot bust it
+    page = f"{params.get('status', '')}|{params.get('after', '')}"
+    digest = hashlib.sha1(page.encode()).hexdigest()
+    return f'polls:index-page:{version}:{digest}'
+
+
+def index_timeout(now, next_changes):
+    """
+    Return how long an index page rendered at now stays correct, or 0.
+
+    next_changes are the next pub_date and end_date after now, or None.
+    The page is not cached in the last second before a change.
+    """
+    moments = [moment for moment in next_changes if moment is not None]
+    if not moments:
+        return INDEX_CACHE_MAX_TIMEOUT
+    return min(INDEX_CACHE_MAX_TIMEOUT, int((min(moments) - now).total_seconds()))
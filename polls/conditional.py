@@ -0,0 +1,113 @@
+"""
+Conditional GET for the results and index pages.
+
+A question's results version is bumped by every vote and the index
+version by every question change, and polls.cache stores when each last
+changed. Together they give an ETag and a Last-Modified time without a
+query, so a client that already has the current page gets a 304 before
+anything is counted or rendered. JSON endpoints can use the same
+validators for their own conditional responses.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.utils.module_loading import import_string
+
+from .cache import (INDEX_VERSION_KEY, aindex_version, aresults_version,
+                    changed_key, index_version, results_version,
+                    results_version_key)
+
+
+def changed_at(key):
+    """Return when a version last changed, as a whole Unix timestamp."""
+    changed = cache.get(changed_key(key))
+    if changed is None:
+        # the time was evicted; claim a change now rather than too early
+        changed = time.time()
+        cache.add(changed_key(key), changed, None)
+    return int(changed)
+
+
+async def achanged_at(key):
+    """Return when a version last changed, asynchronously."""
+    changed = await cache.aget(changed_key(key))
+    if changed is None:
+        changed = time.time()
+        await cache.aadd(changed_key(key), changed, None)
+    return int(changed)
+
+
+def results_validators(question):
+    """
+    Return the ETag and Last-Modified timestamp of a question's results.
+
+    A page rendered while the poll was open shows live updates, so closing
+    the poll changes both validators even if no vote came in.
+    """
+    version = results_version(question.id)
+    return closing_validators(
+        question, version, changed_at(results_version_key(question.id)))
+
+
+async def aresults_validators(question):
+    """Return the validators of a question's results, asynchronously."""
+    version = await aresults_version(question.id)
+    return closing_validators(
+        question, version,
+        await achanged_at(results_version_key(question.id)))
+
+
+def closing_validators(question, version, changed):
+    """Return the results validators given whether the poll is still open."""
+    if question.can_vote():
+        return f'"results-{question.id}-{version}-open"', changed
+    if question.end_date is not None:
+        changed = max(changed, int(question.end_date.timestamp()))
+    return f'"results-{question.id}-{version}"', changed
+
+
+def index_validators():
+    """
+    Return the ETag and Last-Modified timestamp of the set of questions.
+
+    They change when a question is saved or deleted, not when a poll opens
+    or closes with time; a page that shows that must add its own moment.
+    """
+    return f'"index-{index_version()}"', changed_at(INDEX_VERSION_KEY)
+
+
+async def aindex_validators():
+    """Return the validators of the set of questions, asynchronously."""
+    version = await aindex_version()
+    return f'"index-{version}"', await achanged_at(INDEX_VERSION_KEY)
+
+
+def may_have_messages(request):
+    """Return True if a response could show flash messages to the request."""
+    if CookieStorage.cookie_name in request.COOKIES:
+        return True
+    storage = import_string(settings.MESSAGE_STORAGE)
+    return (not issubclass(storage, CookieStorage)
+            and settings.SESSION_COOKIE_NAME in request.COOKIES)
+
+
+def not_modified(request, etag, last_modified):
+    """Return a 304 response if the client's copy is current, or None."""
+    response = get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified):
+    """Add the ETag and Last-Modified headers, and ask to revalidate."""
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # caches keep the page but check it is current before every use
+    response['Cache-Control'] = 'no-cache'
+    return response
@@ -0,0 +1,110 @@
+"""
+Vote counts of many questions in one JSON document, for dashboards.
+
+A dashboard asks for ?ids=1,2,3 and gets the count of every choice of
+those questions from one query, with each question's results version.
+On the next refresh it sends the versions it has, as ?ids=1:5,2:7,3, and
+questions whose version has not moved are listed as unchanged instead of
+being read again. Ids that are not of a published question are listed as
+missing, and get no version. The document is written in chunks, so a
+long list of ids can be streamed.
+"""
+import json
+from itertools import groupby
+from operator import itemgetter
+
+from django.db import router
+from django.utils import timezone
+
+from .models import Question
+
+# questions per chunk of the document
+CHUNK_QUESTIONS = 100
+
+
+def parse_ids(value, max_size):
+    """
+    Return the question ids of an ?ids= value and the versions known.
+
+    Raise ValueError, with a message for the client, if it is malformed.
+    """
+    question_ids = set()
+    known = {}
+    for item in filter(None, value.split(',')):
+        question_id, _, version = item.partition(':')
+        try:
+            question_id = int(question_id)
+            if version:
+                known[question_id] = int(version)
+        except ValueError:
+            raise ValueError(f"{item!r} is not a question id or id:version.")
+        question_ids.add(question_id)
+    if not question_ids:
+        raise ValueError("Give the question ids as ?ids=1,2,3.")
+    if len(question_ids) > max_size:
+        raise ValueError(f"At most {max_size} questions can be asked for.")
+    return sorted(question_ids), known
+
+
+def published_ids(question_ids):
+    """Return the ids, among question_ids, of published questions."""
+    return list(Question.objects.published(timezone.now())
+                .filter(pk__in=question_ids).order_by('id')
+                .values_list('id', flat=True))
+
+
+def counts_query(question_ids):
+    """Return (question id, choice id, votes) rows of published questions."""
+    # a question without choices still has a row, with None for the choice
+    return (Question.objects.published(timezone.now())
+            .filter(pk__in=question_ids)
+            .order_by('id', 'choice__id')
+            .values_list('id', 'choice__id', 'choice__vote_count'))
+
+
+def results_entry(question_id, version, rows):
+    """Return the JSON of one question's counts."""
+    counts = {str(choice_id): votes for _, choice_id, votes in rows
+              if choice_id is not None}
+    return json.dumps({'id': question_id, 'version': version,
+                       'total': sum(counts.values()), 'counts': counts},
+                      separators=(',', ':'))
+
+
+def results_document(question_ids, versions, known):
+    """
+    Yield the results document of the questions, in encoded chunks.
+
+    versions holds the version of every published question; the others
+    are missing. versions are read before the counts, so a vote in between
+    makes the counts newer than their version, never older.
+    """
+    published = [question_id for question_id in question_ids
+                 if question_id in versions]
+    wanted = [question_id for question_id in published
+              if known.get(question_id) != versions[question_id]]
+    unchanged = [question_id for question_id in published
+                 if known.get(question_id) == versions[question_id]]
+    found = set()
+    yield b'{"results":['
+    if wanted:
+        # the counts go out with their version, so they must not lag it;
+        # the rows are read while streaming, so the alias is fixed up front
+        rows = counts_query(wanted).using(router.db_for_write(Question))
+        entries = []
+        separator = b''
+        for question_id, group in groupby(rows.iterator(),
+                                          key=itemgetter(0)):
+            entries.append(results_entry(question_id, versions[question_id],
+                                         group))
+            found.add(question_id)
+            if len(entries) == CHUNK_QUESTIONS:
+                yield separator + ','.join(entries).encode()
+                entries, separator = [], b','
+        if entries:
+            yield separator + ','.join(entries).encode()
+    missing = [question_id for question_id in question_ids
+               if question_id not in versions
+               or (question_id in wanted and question_id not in found)]
+    yield (f'],"unchanged":{json.dumps(unchanged)},'
+           f'"missing":{json.dumps(missing)}}}').encode()
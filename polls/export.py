@@ -0,0 +1,119 @@
+"""Streaming CSV and NDJSON exports of votes and poll results."""
+import csv
+import heapq
+import itertools
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ArchivedVote, Choice, Vote
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+VOTE_COLUMNS = ('id', 'user_id', 'question_id', 'choice_id', 'voted_at')
+RESULT_COLUMNS = ('question_id', 'choice_id', 'choice_text', 'votes')
+
+
+class Echo:
+    """A file-like object whose write() returns what it was given."""
+
+    def write(self, value):
+        """Return the value instead of storing it."""
+        return value
+
+
+def parse_filters(question=None, since=None, until=None):
+    """
+    Return export filters from their string form.
+
+    Raise ValueError when a question id or time is not valid.
+    """
+    filters = {}
+    if question:
+        filters['question_id'] = int(question)
+    for name, value in (('since', since), ('until', until)):
+        if value:
+            moment = parse_datetime(value)
+            if moment is None:
+                raise ValueError(f"{name} must be an ISO 8601 date and time.")
+            if timezone.is_naive(moment):
+                moment = timezone.make_aware(moment)
+            filters[name] = moment
+    return filters
+
+
+def vote_rows(question_id=None, since=None, until=None,
+              chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield votes as tuples of VOTE_COLUMNS, in id order.
+
+    The rows are read with a server-side cursor where the database has
+    one, so memory use does not grow with the number of votes.
+    """
+    def rows(model):
+        votes = model.objects.order_by('id')
+        if question_id is not None:
+            votes = votes.filter(question_id=question_id)
+        if since is not None:
+            votes = votes.filter(voted_at__gte=since)
+        if until is not None:
+            votes = votes.filter(voted_at__lt=until)
+        return votes.values_list(*VOTE_COLUMNS).iterator(chunk_size=chunk_size)
+
+    # archived votes kept their ids, so both tables merge into id order
+    return heapq.merge(rows(Vote), rows(ArchivedVote))
+
+
+def result_rows(question_id=None, chunk_size=EXPORT_CHUNK_SIZE, **kwargs):
+    """Yield the tally of every choice as tuples of RESULT_COLUMNS."""
+    choices = Choice.objects.order_by('question_id', 'id')
+    if question_id is not None:
+        choices = choices.filter(question_id=question_id)
+    return (choices.values_list('question_id', 'id', 'choice_text',
+                                'vote_count')
+            .iterator(chunk_size=chunk_size))
+
+
+def as_csv(columns, rows):
+    """Yield a header line and then one CSV line per row."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def as_ndjson(columns, rows):
+    """Yield one JSON object per line for every row."""
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def export(kind, export_format, filters, chunk_size=EXPORT_CHUNK_SIZE):
+    """Return a generator of the lines of an export of votes or results."""
+    if kind == 'votes':
+        columns, rows = VOTE_COLUMNS, vote_rows(chunk_size=chunk_size,
+                                                **filters)
+    else:
+        columns, rows = RESULT_COLUMNS, result_rows(chunk_size=chunk_size,
+                                                    **filters)
+    render = as_csv if export_format == 'csv' else as_ndjson
+    return render(columns, rows)
+
+
+async def aiterate(lines, batch_size=500):
+    """Yield the lines of an export, producing them in a worker thread."""
+    def take():
+        return list(itertools.islice(lines, batch_size))
+
+    while True:
+        batch = await sync_to_async(take)()
+        if not batch:
+            return
+        for line in batch:
+            yield line
@@ -0,0 +1,113 @@
+"""
+Finalization of closed polls.
+
+The votes of a question never change once its end_date has passed, so
+finalize_question() freezes its results into a ResultSnapshot, with the
+results table rendered once, and can move its votes from the live vote
+table to the archive. Choice.vote_count is left as it is, so results and
+exports do not change. A finalized question that is reopened gets its
+votes back and is counted live again.
+"""
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .cache import invalidate_results
+from .models import ArchivedVote, Choice, Question, ResultSnapshot, Vote
+from .rendering import render_template
+
+ARCHIVE_BATCH_SIZE = 5000
+
+
+def closed_before(grace, now=None):
+    """Return the time a question must have closed by to be finalized."""
+    return (now or timezone.now()) - timezone.timedelta(seconds=grace)
+
+
+def closed_questions(grace, now=None):
+    """Return questions closed more than grace seconds ago, not finalized."""
+    return Question.objects.filter(end_date__lte=closed_before(grace, now),
+                                   snapshot__isnull=True)
+
+
+def finalize_question(question_id, archive=False,
+                      batch_size=ARCHIVE_BATCH_SIZE, grace=0):
+    """
+    Freeze the results of a closed question, archiving its votes if asked.
+
+    Return the snapshot, or None if the question is gone, already
+    finalized, or no longer closed more than grace seconds ago.
+    """
+    with transaction.atomic():
+        question = (Question.objects.select_for_update()
+                    .filter(pk=question_id).first())
+        # the question may have been reopened since it was found closed
+        if (question is None or question.end_date is None
+                or question.end_date > closed_before(grace)
+                or ResultSnapshot.objects.filter(
+                    question_id=question_id).exists()):
+            return None
+        choices = list(Choice.objects.filter(question_id=question_id)
+                       .order_by('id'))
+        snapshot = ResultSnapshot.objects.create(
+            question=question,
+            counts={str(choice.id): choice.vote_count for choice in choices},
+            total=sum(choice.vote_count for choice in choices),
+            finalized_at=timezone.now(),
+            html=render_template('polls/results_table.html',
+                                 {'choices': choices}),
+            archived=archive,
+        )
+        if archive:
+            archive_votes(question_id, batch_size)
+        transaction.on_commit(lambda: invalidate_results(question_id))
+    return snapshot
+
+
+def archive_votes(question_id, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move the votes of a question to the archive, keeping their ids."""
+    votes = (Vote.objects.filter(question_id=question_id).order_by('id')
+             .values_list('id', 'choice_id', 'user_id', 'voted_at'))
+    batch = []
+    for pk, choice_id, user_id, voted_at in votes.iterator(batch_size):
+        batch.append(ArchivedVote(id=pk, choice_id=choice_id, user_id=user_id,
+                                  question_id=question_id, voted_at=voted_at))
+        if len(batch) >= batch_size:
+            ArchivedVote.objects.bulk_create(batch)
+            batch = []
+    ArchivedVote.objects.bulk_create(batch)
+    # deleted in SQL so no post_delete is sent, which would take the votes
+    # off the tally the snapshot was just taken from
+    connection = connections[router.db_for_write(Vote)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(Vote._meta.db_table)} '
+            'WHERE question_id = %s', [question_id])
+
+
+def reopen_question(question_id):
+    """Drop the snapshot of a question and bring back its archived votes."""
+    with transaction.atomic():
+        deleted, _ = ResultSnapshot.objects.filter(
+            question_id=question_id).delete()
+        if not deleted:
+            return
+        archived = ArchivedVote.objects.filter(question_id=question_id)
+        batch = []
+        for vote in archived.order_by('id').iterator(ARCHIVE_BATCH_SIZE):
+            batch.append(vote)
+            if len(batch) >= ARCHIVE_BATCH_SIZE:
+                restore_votes(batch)
+                batch = []
+        restore_votes(batch)
+        archived.delete()
+        transaction.on_commit(lambda: invalidate_results(question_id))
+
+
+def restore_votes(archived):
+    """Put archived votes back in the live table with their vote times."""
+    if not archived:
+        return
+    Vote.objects.bulk_create([
+        Vote(id=vote.id, choice_id=vote.choice_id, user_id=vote.user_id,
+             question_id=vote.question_id, voted_at=vote.voted_at)
+        for vote in archived])
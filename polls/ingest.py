@@ -0,0 +1,184 @@
+"""
+Write-behind ingestion of votes through a durable local journal.
+
+A queued vote whose user or choice no longer exists can never be written;
+flush() moves it to the journal's dead_vote table, with the reason, so
+the votes queued after it are not held up.
+"""
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .cache import invalidate_results
+from .models import Choice, Vote
+
+_journals = {}
+
+
+class VoteJournal:
+    """A durable queue of votes kept in a local SQLite file."""
+
+    def __init__(self, path):
+        """Open (or create) the journal stored at path."""
+        self.path = str(path)
+        self._local = threading.local()
+        self._connect().executescript('''
+            CREATE TABLE IF NOT EXISTS queued_vote (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                question_id INTEGER NOT NULL,
+                choice_id INTEGER NOT NULL,
+                queued_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS dead_vote (
+                seq INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                question_id INTEGER NOT NULL,
+                choice_id INTEGER NOT NULL,
+                reason TEXT NOT NULL,
+                failed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS journal_stat (
+                name TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            );
+        ''')
+
+    def _connect(self):
+        """Return this thread's connection to the journal."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # a vote is only acknowledged once it is on disk
+            connection.execute('PRAGMA synchronous=FULL')
+            self._local.connection = connection
+        return connection
+
+    def append(self, user_id, question_id, choice_id):
+        """Queue one vote."""
+        self._connect().execute(
+            'INSERT INTO queued_vote (user_id, question_id, choice_id, '
+            'queued_at) VALUES (?, ?, ?, ?)',
+            (user_id, question_id, choice_id, time.time()))
+
+    def peek(self, limit):
+        """Return up to limit of the oldest queued votes, oldest first."""
+        return self._connect().execute(
+            'SELECT seq, user_id, question_id, choice_id FROM queued_vote '
+            'ORDER BY seq LIMIT ?', (limit,)).fetchall()
+
+    def ack(self, last_seq, dead=()):
+        """
+        Remove every queued vote up to and including last_seq.
+
+        dead holds (seq, user_id, question_id, choice_id, reason) of votes
+        that could not be written; they are kept in dead_vote instead.
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany(
+                'INSERT OR REPLACE INTO dead_vote (seq, user_id, '
+                'question_id, choice_id, reason, failed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(*row, time.time()) for row in dead])
+            connection.execute('DELETE FROM queued_vote WHERE seq <= ?',
+                               (last_seq,))
+
+    def dead(self):
+        """Return the votes that could not be written, oldest first."""
+        return self._connect().execute(
+            'SELECT seq, user_id, question_id, choice_id, reason '
+            'FROM dead_vote ORDER BY seq').fetchall()
+
+    def depth(self):
+        """Return the number of queued votes."""
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM queued_vote').fetchone()[0]
+
+    def record_flush(self, size, latency):
+        """Remember the size and latency of the last flush."""
+        self._connect().executemany(
+            'INSERT OR REPLACE INTO journal_stat (name, value) VALUES (?, ?)',
+            [('last_flush_size', size), ('last_flush_latency', latency),
+             ('last_flush_at', time.time())])
+
+    def stats(self):
+        """Return the queue depth, age of the oldest vote and flush stats."""
+        connection = self._connect()
+        depth, oldest = connection.execute(
+            'SELECT COUNT(*), MIN(queued_at) FROM queued_vote').fetchone()
+        stats = dict(connection.execute(
+            'SELECT name, value FROM journal_stat').fetchall())
+        stats['depth'] = depth
+        stats['dead'] = connection.execute(
+            'SELECT COUNT(*) FROM dead_vote').fetchone()[0]
+        stats['oldest_age'] = time.time() - oldest if oldest else 0.0
+        return stats
+
+
+def get_journal():
+    """Return the journal configured by POLLS_VOTE_JOURNAL."""
+    path = str(settings.POLLS_VOTE_JOURNAL)
+    if path not in _journals:
+        _journals[path] = VoteJournal(path)
+    return _journals[path]
+
+
+def buffered_ingestion():
+    """Return True if votes are queued instead of written synchronously."""
+    return settings.POLLS_VOTE_INGESTION == 'buffered'
+
+
+def check_rows(batch):
+    """
+    Split queued votes into those that can be written and dead ones.
+
+    A vote is dead if its user or choice has been deleted, or its choice
+    is not one of its question's.
+    """
+    users = set(User.objects.filter(
+        pk__in={row[1] for row in batch}).values_list('pk', flat=True))
+    choices = dict(Choice.objects.filter(
+        pk__in={row[3] for row in batch}).values_list('pk', 'question_id'))
+    valid, dead = [], []
+    for seq, user_id, question_id, choice_id in batch:
+        if user_id not in users:
+            reason = "The user no longer exists."
+        elif choices.get(choice_id) != question_id:
+            reason = "The choice no longer exists on the question."
+        else:
+            valid.append((user_id, question_id, choice_id))
+            continue
+        dead.append((seq, user_id, question_id, choice_id, reason))
+    return valid, dead
+
+
+def flush(journal, batch_size=500):
+    """
+    Write one batch of queued votes to the database.
+
+    Votes are acknowledged only after the database transaction commits,
+    so a crash in between replays the batch; the upsert is idempotent.
+    Votes that can no longer be written are moved to the dead_vote table.
+    Return the number of votes taken off the queue.
+    """
+    batch = journal.peek(batch_size)
+    if not batch:
+        return 0
+    started = time.monotonic()
+    with transaction.atomic():
+        valid, dead = check_rows(batch)
+        Vote.objects.record_many(valid)
+        for question_id in {row[1] for row in valid}:
+            transaction.on_commit(
+                lambda question_id=question_id: invalidate_results(question_id))
+    journal.ack(batch[-1][0], dead)
+    journal.record_flush(len(valid), time.monotonic() - started)
+    return len(batch)
@@ -0,0 +1,141 @@
+"""
+Live vote tallies pushed as Server-Sent Events or long-poll responses.
+
+Holding a connection open ties up a whole worker under WSGI, so only the
+async views stream and long-poll. The sync views answer at once: their
+event stream sends the current tally and ends, telling the EventSource to
+reconnect after SHORT_POLL_INTERVAL, and their long poll does not wait.
+
+Only open polls are live. The stream of a closed poll answers 204, which
+stops an EventSource from reconnecting, and its poll returns the final
+counts marked closed, so clients know to stop asking.
+"""
+import asyncio
+import json
+import time
+
+from django.utils import timezone
+
+from mysite.routers import primary_reads
+
+from .cache import aresults_version, results_version
+from .models import Choice
+
+STREAM_INTERVAL = 1.0
+STREAM_HEARTBEAT = 15.0
+STREAM_MAX_DURATION = 5 * 60
+LONG_POLL_TIMEOUT = 25.0
+# seconds between the reconnections of a short-polling EventSource
+SHORT_POLL_INTERVAL = 5.0
+
+
+def tally_query(question_id):
+    """Return a query of (choice id, vote count) pairs of a question."""
+    return (Choice.objects.filter(question_id=question_id)
+            .values_list('id', 'vote_count'))
+
+
+def tally(question_id):
+    """Return the vote count of every choice of a question."""
+    # sent with the current version, so never from a lagging replica
+    with primary_reads():
+        return dict(tally_query(question_id))
+
+
+async def atally(question_id):
+    """Return the vote count of every choice of a question, async."""
+    with primary_reads():
+        return {pk: count async for pk, count in tally_query(question_id)}
+
+
+def changed_counts(previous, current):
+    """Return the counts in current that differ from previous."""
+    return {pk: count for pk, count in current.items()
+            if previous.get(pk) != count}
+
+
+def tally_payload(version, counts):
+    """Return the JSON-ready update for a tally version."""
+    return {'version': version,
+            'counts': {str(pk): count for pk, count in counts.items()}}
+
+
+def sse_event(version, counts):
+    """Format a tally update as a Server-Sent Event."""
+    data = json.dumps(tally_payload(version, counts), separators=(',', ':'))
+    return f"id: {version}\nevent: tally\ndata: {data}\n\n"
+
+
+def short_poll_events(question_id, last_version):
+    """
+    Return the events that answer one poll of an EventSource.
+
+    The tally is only sent if its version is not last_version, the id of
+    the last event the client received.
+    """
+    events = f"retry: {int(SHORT_POLL_INTERVAL * 1000)}\n\n"
+    version = results_version(question_id)
+    if str(version) != last_version:
+        events += sse_event(version, tally(question_id))
+    return events
+
+
+async def astream_tally(question_id, end_date=None):
+    """
+    Yield the tally of a question, then only the changed counts.
+
+    The version is checked once per STREAM_INTERVAL, so a burst of votes
+    becomes a single update. The stream ends after STREAM_MAX_DURATION, or
+    when the poll closes at end_date, and clients reconnect automatically.
+    """
+    started = last_sent = time.monotonic()
+    version = await aresults_version(question_id)
+    counts = await atally(question_id)
+    yield sse_event(version, counts)
+    while (time.monotonic() - started < STREAM_MAX_DURATION
+           and (end_date is None or timezone.now() <= end_date)):
+        await asyncio.sleep(STREAM_INTERVAL)
+        current_version = await aresults_version(question_id)
+        if current_version != version:
+            version, current = current_version, await atally(question_id)
+            delta = changed_counts(counts, current)
+            counts = current
+            if delta:
+                last_sent = time.monotonic()
+                yield sse_event(version, delta)
+                continue
+        if time.monotonic() - last_sent >= STREAM_HEARTBEAT:
+            last_sent = time.monotonic()
+            yield ": heartbeat\n\n"
+
+
+def poll_tally(question_id, since):
+    """Return the tally if its version differs from since, or None."""
+    version = results_version(question_id)
+    if str(version) != since:
+        return tally_payload(version, tally(question_id))
+    return None
+
+
+def final_tally(question_id):
+    """Return the tally of a closed question, marked as final."""
+    return dict(tally_payload(results_version(question_id), tally(question_id)),
+                closed=True)
+
+
+async def afinal_tally(question_id):
+    """Return the tally of a closed question, marked as final, async."""
+    version = await aresults_version(question_id)
+    return dict(tally_payload(version, await atally(question_id)), closed=True)
+
+
+async def await_tally(question_id, since):
+    """Return the tally once its version differs from since, async."""
+    deadline = time.monotonic() + LONG_POLL_TIMEOUT
+    while True:
+        version = await aresults_version(question_id)
+        if str(version) != since:
+            return tally_payload(version, await atally(question_id))
+        if time.monotonic() >= deadline:
+            return None
+        await asyncio.sleep(STREAM_INTERVAL)
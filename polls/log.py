@@ -0,0 +1,201 @@
+"""
+Logging that never makes a request wait for the disk.
+
+QueuedJSONHandler puts records on a bounded in-memory queue and returns.
+A background thread takes them off in batches, formats them as JSON lines
+and appends each batch to a size-rotated file with one write. When the
+queue is full, records are dropped and counted instead of blocking.
+
+Every worker of a service appends to the same file. A batch is written
+and the file rotated while holding a lock on a .lock file next to it, and
+a worker whose file was rotated by another reopens it, so maxBytes and
+backupCount bound the disk used by the whole service.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+
+# attributes every LogRecord has; anything else came in through extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord(
+    '', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Format a record as one JSON object, with its extra fields."""
+
+    def format(self, record):
+        """Return the record as a JSON line."""
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+                            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                data[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """A RotatingFileHandler that processes share and can write in batches."""
+
+    def emit_batch(self, records):
+        """Append the formatted records with one write, rotating first."""
+        text = ''.join(self.format(record) + self.terminator
+                       for record in records)
+        with self.lock, open(f'{self.baseFilename}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.stream is not None and self._rotated_away():
+                self.stream.close()
+                self.stream = None
+            if self.stream is None:
+                self.stream = self._open()
+            position = os.fstat(self.stream.fileno()).st_size
+            if self.maxBytes and position and position + len(text) > self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(text)
+            self.stream.flush()
+
+    def _rotated_away(self):
+        """Return True if another process has rotated the open file."""
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return True
+        opened = os.fstat(self.stream.fileno())
+        return (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the info records of high-volume events."""
+
+    def __init__(self, rates=None):
+        """Keep each record of an event with the given probability."""
+        super().__init__()
+        self.rates = rates or {}
+
+    def filter(self, record):
+        """Return False for the records sampled away."""
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class QueuedJSONHandler(logging.Handler):
+    """Hand records to a background thread that writes them in batches."""
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5,
+                 batch_size=256, queue_size=10000, sample_rates=None):
+        """Create the queue; the writer thread starts with the first record."""
+        super().__init__()
+        self.file_handler = BatchRotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count,
+            encoding='utf-8', delay=True)
+        self.file_handler.setFormatter(JSONFormatter())
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.addFilter(SamplingFilter(sample_rates))
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._queue = None
+        self._writer = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        """Queue a record without formatting it, or drop it if full."""
+        if self._pid != os.getpid():
+            self._start()
+        # a traceback is rendered now, while its frames are still current
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def _start(self):
+        """Start the writer thread of this process."""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # a forked worker gets its own queue and thread
+            self._queue = queue.Queue(self.queue_size)
+            self._writer = threading.Thread(
+                target=self._write_forever, args=(self._queue,),
+                name='polls-log-writer', daemon=True)
+            self._writer.start()
+            self._pid = os.getpid()
+
+    def _write_forever(self, records):
+        """
+        Write queued records in batches until a None arrives.
+
+        An Event on the queue is set once the records before it are written.
+        """
+        while True:
+            batch = [records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            flushed = [item for item in batch
+                       if isinstance(item, threading.Event)]
+            batch = [item for item in batch
+                     if isinstance(item, logging.LogRecord)]
+            if batch:
+                try:
+                    self.file_handler.emit_batch(batch)
+                except Exception:
+                    self.handleError(batch[0])
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                self.file_handler.emit_batch([logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING,
+                    'levelname': 'WARNING', 'event': 'log_dropped',
+                    'msg': '%s log records dropped, queue full',
+                    'args': (dropped,), 'count': dropped})])
+            for event in flushed:
+                event.set()
+            if stop:
+                return
+
+    def flush(self):
+        """Wait until every record queued so far is written."""
+        if self._pid == os.getpid() and self._writer.is_alive():
+            written = threading.Event()
+            self._queue.put(written)
+            written.wait()
+
+    def close(self):
+        """Write what is queued, stop the writer and close the file."""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                self._queue.put(None)
+                self._writer.join()
+                self._pid = None
+        self.file_handler.close()
+        super().close()
@@ -0,0 +1,116 @@
+"""Compare the sync and async polls views under uvicorn."""
+import asyncio
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.bench import percentile
+
+
+async def fetch_forever(host, port, path, deadline, latencies, errors):
+    """Send keep-alive GET requests on one connection until the deadline."""
+    reader, writer = await asyncio.open_connection(host, port)
+    request = (f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+               f"Connection: keep-alive\r\n\r\n").encode()
+    try:
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                name, _, value = line.partition(b":")
+                if name.lower() == b"content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.monotonic() - started)
+            if not head.startswith(b"HTTP/1.1 200"):
+                errors.append(head.split(b"\r\n", 1)[0].decode())
+    except (ConnectionError, asyncio.IncompleteReadError) as error:
+        errors.append(repr(error))
+    finally:
+        writer.close()
+
+
+async def drive(host, port, path, connections, duration):
+    """Hold many connections open against path and collect latencies."""
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[
+        fetch_forever(host, port, path, deadline, latencies, errors)
+        for _ in range(connections)])
+    return latencies, errors
+
+
+def wait_for_port(host, port, timeout=30):
+    """Wait until a server accepts connections on host:port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise CommandError(f"Server did not start on {host}:{port}.")
+
+
+class Command(BaseCommand):
+    """Run uvicorn with sync and async views and compare req/s and p99."""
+
+    help = ("Benchmark the polls views under uvicorn with many concurrent "
+            "connections, once with sync and once with async views.")
+
+    def add_arguments(self, parser):
+        """Add load and server options."""
+        parser.add_argument('--path', default='/polls/',
+                            help='Path to request, e.g. /polls/1/results/.')
+        parser.add_argument('--connections', type=int, default=200)
+        parser.add_argument('--duration', type=float, default=10.0,
+                            help='Seconds of load per run.')
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        """Run both benchmarks and print a JSON report."""
+        if importlib.util.find_spec('uvicorn') is None:
+            raise CommandError("uvicorn is required: pip install uvicorn")
+        host, port = '127.0.0.1', options['port']
+        report = {}
+        for mode in ('sync', 'async'):
+            env = dict(os.environ,
+                       DJANGO_SETTINGS_MODULE=os.environ.get(
+                           'DJANGO_SETTINGS_MODULE', 'mysite.settings'),
+                       POLLS_ASYNC_VIEWS=str(mode == 'async'),
+                       ALLOWED_HOSTS=','.join(settings.ALLOWED_HOSTS
+                                              + [host]))
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'uvicorn', 'mysite.asgi:application',
+                 '--host', host, '--port', str(port), '--log-level',
+                 'warning', '--no-access-log'],
+                env=env, cwd=settings.BASE_DIR)
+            try:
+                wait_for_port(host, port)
+                latencies, errors = asyncio.run(drive(
+                    host, port, options['path'], options['connections'],
+                    options['duration']))
+            finally:
+                server.terminate()
+                server.wait()
+            report[mode] = {
+                'requests': len(latencies),
+                'requests_per_second': len(latencies) / options['duration'],
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'errors': len(errors),
+            }
+        self.stdout.write(json.dumps({
+            'path': options['path'],
+            'connections': options['connections'],
+            'results': report,
+        }, indent=2))
@@ -0,0 +1,244 @@
+"""Seed a synthetic dataset and benchmark the polls views on it."""
+import json
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from polls.bench import summarize
+from polls.models import Choice, Question, User, Vote
+from polls.question_cache import forget_all
+
+# one in CLOSED_EVERY questions has already closed
+CLOSED_EVERY = 10
+# spreads each user's votes over the questions
+USER_STRIDE = 7919
+
+
+def next_pk(model, using):
+    """Return the first primary key above every existing row of a model."""
+    return (model.objects.using(using).aggregate(top=Max('pk'))['top'] or 0) + 1
+
+
+def batched(objs, batch_size):
+    """Yield lists of at most batch_size objects."""
+    batch = []
+    for obj in objs:
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class QueryCounter:
+    """A database execute wrapper that counts the queries it runs."""
+
+    def __init__(self):
+        """Start with no queries."""
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """Run one query and count it."""
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    """Seed questions, choices, users and votes, then time the views."""
+
+    help = ("Seed a synthetic polls dataset with bulk inserts and report "
+            "throughput, p50/p95/p99 latency and queries per request of "
+            "the index, detail, results and vote views as JSON.")
+
+    def add_arguments(self, parser):
+        """Add dataset size, load and database options."""
+        parser.add_argument('--questions', type=int, default=1000)
+        parser.add_argument('--choices', type=int, default=10,
+                            help='Choices per question.')
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--votes', type=int, default=100000)
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Requests per view.')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed, for runs that can be compared.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--in-place', action='store_true',
+                            help='Seed the configured database instead of a '
+                                 'throwaway test database.')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the throwaway database afterwards.')
+        parser.add_argument('--output', help='Write the report to this file.')
+
+    def handle(self, *args, **options):
+        """Seed, benchmark and write the JSON report."""
+        if options['votes'] > options['users'] * options['questions']:
+            raise CommandError("Each user votes at most once per question, "
+                               "so --votes cannot exceed users x questions.")
+        if min(options['questions'], options['choices'], options['users'],
+               options['requests']) < 1:
+            raise CommandError("Sizes and --requests must be at least 1.")
+        self.using = options['database']
+        self.rng = random.Random(options['seed'])
+        connection = connections[self.using]
+        if options['in_place']:
+            report = self.run(options)
+        else:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False,
+                keepdb=options['keepdb'])
+            try:
+                report = self.run(options)
+            finally:
+                connection.creation.destroy_test_db(
+                    old_name, verbosity=0, keepdb=options['keepdb'])
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run(self, options):
+        """Seed the dataset and benchmark every view."""
+        started = time.perf_counter()
+        self.seed(options)
+        dataset = {
+            'questions': options['questions'],
+            'choices': options['questions'] * options['choices'],
+            'users': options['users'],
+            'votes': options['votes'],
+            'seed': options['seed'],
+            'database': connections[self.using].vendor,
+            'seed_seconds': time.perf_counter() - started,
+        }
+        return {'dataset': dataset, 'views': self.benchmark(options)}
+
+    def seed(self, options):
+        """Bulk-insert the synthetic rows with precomputed primary keys."""
+        questions, choices = options['questions'], options['choices']
+        users, votes = options['users'], options['votes']
+        batch_size = options['batch_size']
+        self.question_base = next_pk(Question, self.using)
+        self.choice_base = next_pk(Choice, self.using)
+        self.user_base = next_pk(User, self.using)
+        vote_base = next_pk(Vote, self.using)
+        now = timezone.now()
+        password = make_password('bench')
+        counts = [0] * (questions * choices)
+
+        def vote_objs():
+            for number in range(votes):
+                user = number % users
+                question = (number // users + user * USER_STRIDE) % questions
+                choice = question * choices + self.rng.randrange(choices)
+                counts[choice] += 1
+                yield Vote(pk=vote_base + number,
+                           user_id=self.user_base + user,
+                           question_id=self.question_base + question,
+                           choice_id=self.choice_base + choice)
+
+        with transaction.atomic(using=self.using):
+            self.bulk_insert(User, batch_size, (
+                User(pk=self.user_base + number,
+                     username=f'bench-{self.user_base + number}',
+                     password=password)
+                for number in range(users)))
+            self.bulk_insert(Question, batch_size, (
+                Question(pk=self.question_base + number,
+                         question_text=f'Benchmark question {number}?',
+                         pub_date=now - timezone.timedelta(minutes=questions - number),
+                         end_date=(now - timezone.timedelta(minutes=1)
+                                   if number % CLOSED_EVERY == 0 else None))
+                for number in range(questions)))
+            # votes go in before choices so the tally can be counted on the
+            # way; foreign keys are only checked when the transaction commits
+            self.bulk_insert(Vote, batch_size, vote_objs())
+            self.bulk_insert(Choice, batch_size, (
+                Choice(pk=self.choice_base + number,
+                       question_id=self.question_base + number // choices,
+                       choice_text=f'Choice {number % choices}',
+                       vote_count=counts[number])
+                for number in range(questions * choices)))
+            self.reset_sequences()
+        # bulk inserts send no signals, and primary keys may be reused
+        forget_all()
+
+    def bulk_insert(self, model, batch_size, objs):
+        """Insert objects of a model in batches."""
+        manager = model._base_manager.using(self.using)
+        for batch in batched(objs, batch_size):
+            manager.bulk_create(batch)
+
+    def reset_sequences(self):
+        """Move primary key sequences past the seeded ids."""
+        connection = connections[self.using]
+        statements = connection.ops.sequence_reset_sql(
+            no_style(), [User, Question, Choice, Vote])
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+    def benchmark(self, options):
+        """Request every view and summarize latency and queries."""
+        questions, choices = options['questions'], options['choices']
+        open_questions = [number for number in range(questions)
+                          if number % CLOSED_EVERY != 0] or [0]
+        client = Client()
+        client.force_login(User.objects.using(self.using).get(pk=self.user_base))
+
+        def question_pk(numbers):
+            return self.question_base + self.rng.choice(numbers)
+
+        def vote_request():
+            number = self.rng.choice(open_questions)
+            choice = (self.choice_base + number * choices
+                      + self.rng.randrange(choices))
+            return client.post(
+                reverse('kupolls:vote', args=(self.question_base + number,)),
+                {'choice': choice})
+
+        all_questions = range(questions)
+        targets = {
+            'index': (lambda: client.get(reverse('kupolls:index')), 200),
+            'detail': (lambda: client.get(reverse(
+                'kupolls:detail', args=(question_pk(open_questions),))), 200),
+            'results': (lambda: client.get(reverse(
+                'kupolls:results', args=(question_pk(all_questions),))), 200),
+            'vote': (vote_request, 302),
+        }
+        report = {}
+        connection = connections[self.using]
+        hosts = [*settings.ALLOWED_HOSTS, 'testserver']
+        with override_settings(ALLOWED_HOSTS=hosts):
+            for name, (send, expected_status) in targets.items():
+                samples, queries, errors = [], 0, 0
+                started = time.perf_counter()
+                for _ in range(options['requests']):
+                    counter = QueryCounter()
+                    request_started = time.perf_counter()
+                    with connection.execute_wrapper(counter):
+                        response = send()
+                    samples.append(time.perf_counter() - request_started)
+                    queries += counter.queries
+                    errors += response.status_code != expected_status
+                elapsed = time.perf_counter() - started
+                report[name] = dict(
+                    summarize(samples),
+                    requests_per_second=len(samples) / elapsed,
+                    queries_per_request=queries / len(samples),
+                    errors=errors,
+                )
+        return report
@@ -0,0 +1,48 @@
+"""Measure per-request connection overhead with and without the pool."""
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from polls.bench import summarize
+
+
+class Command(BaseCommand):
+    """Open, query and close a connection per simulated request."""
+
+    help = ("Compare connect + SELECT 1 + close per request on the plain "
+            "PostgreSQL backend and on the pooled backend.")
+
+    def add_arguments(self, parser):
+        """Add the request count and database alias."""
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        """Run both backends and print the latencies as JSON."""
+        settings_dict = connections[options['database']].settings_dict
+        if 'postgresql' not in settings_dict['ENGINE']:
+            raise CommandError("bench_pool needs a PostgreSQL database.")
+        from django.db.backends.postgresql.base import DatabaseWrapper
+        from mysite.backends.postgresql_pool.base import (
+            DatabaseWrapper as PooledDatabaseWrapper)
+
+        report = {}
+        for name, wrapper_class in (('plain', DatabaseWrapper),
+                                    ('pooled', PooledDatabaseWrapper)):
+            wrapper = wrapper_class(dict(settings_dict), alias=f'bench_{name}')
+            samples = []
+            for _ in range(options['requests']):
+                started = time.perf_counter()
+                # what every request does with CONN_MAX_AGE = 0
+                wrapper.ensure_connection()
+                with wrapper.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                wrapper.close()
+                samples.append(time.perf_counter() - started)
+            report[name] = summarize(samples)
+            if name == 'pooled':
+                report[name]['pool'] = wrapper.pool.metrics()
+                wrapper.pool.close_all()
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,115 @@
+"""Benchmark rendering the polls templates with many or few choices."""
+import json
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from polls.bench import summarize
+from polls.models import Choice, Question
+from polls.rendering import render_template
+
+ENGINES = ('django', 'jinja2')
+
+
+def sample_context(template_name, size):
+    """Return the context a view gives a template, with size choices."""
+    now = timezone.now()
+    question = Question(id=1, question_text="Which colour?",
+                        pub_date=now - timezone.timedelta(days=1),
+                        end_date=now + timezone.timedelta(days=1))
+    choices = [Choice(id=pk, question_id=question.id,
+                      choice_text=f"Choice {pk}", vote_count=pk * 3)
+               for pk in range(1, size + 1)]
+    if template_name == 'polls/index.html':
+        questions = []
+        for pk in range(1, size + 1):
+            listed = Question(id=pk, question_text=f"Question {pk}?",
+                              pub_date=question.pub_date)
+            listed.is_open = pk % 2 == 0
+            questions.append(listed)
+        return {'latest_question_list': questions, 'next_cursor': 'abc',
+                'status': '', 'signed_in': False}
+    if template_name == 'polls/detail.html':
+        return {'question': question, 'choices': choices, 'user_vote': 2,
+                'error_message': None}
+    if template_name == 'polls/results.html':
+        table = render_template('polls/results_table.html',
+                                {'choices': choices})
+        return {'question': question, 'results_table': mark_safe(table),
+                'live': True}
+    return {'choices': choices}
+
+
+def engine_templates(engine):
+    """Return the TEMPLATES setting that renders the polls with engine."""
+    if engine == 'jinja2' and settings.JINJA2_TEMPLATES not in settings.TEMPLATES:
+        return [*settings.TEMPLATES, settings.JINJA2_TEMPLATES]
+    return settings.TEMPLATES
+
+
+class Command(BaseCommand):
+    """Time the polls templates with sample contexts, without a database."""
+
+    help = ("Render every polls template with 10 and 500 choices (or "
+            "--choices) on each engine and report p50/p95/p99 render time "
+            "per template as JSON.")
+
+    def add_arguments(self, parser):
+        """Add sizes, engines and iteration options."""
+        parser.add_argument('--choices', type=int, nargs='+',
+                            default=[10, 500],
+                            help='Choices (or questions, for the index).')
+        parser.add_argument('--engine', choices=ENGINES, action='append',
+                            help='Engines to time; all installed by default.')
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--output', help='Write the report to this file.')
+
+    def handle(self, *args, **options):
+        """Render every template and write the JSON report."""
+        if options['iterations'] < 1 or min(options['choices']) < 1:
+            raise CommandError("Sizes and --iterations must be at least 1.")
+        engines = options['engine']
+        if not engines:
+            engines = ['django']
+            try:
+                import jinja2  # noqa: F401
+                engines.append('jinja2')
+            except ImportError:
+                pass
+        report = {}
+        for engine in engines:
+            with override_settings(POLLS_TEMPLATE_ENGINE=engine,
+                                   TEMPLATES=engine_templates(engine)):
+                report[engine] = self.run(options)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run(self, options):
+        """Time every template at every size with the current engine."""
+        request = RequestFactory().get('/polls/')
+        request.user = AnonymousUser()
+        report = {}
+        for template_name in ('polls/index.html', 'polls/detail.html',
+                              'polls/results.html',
+                              'polls/results_table.html'):
+            for size in options['choices']:
+                context = sample_context(template_name, size)
+                # the first render compiles the template
+                render_template(template_name, context, request)
+                samples = []
+                for _ in range(options['iterations']):
+                    started = time.perf_counter()
+                    render_template(template_name, context, request)
+                    samples.append(time.perf_counter() - started)
+                report[f'{template_name}@{size}'] = summarize(samples)
+        return report
@@ -0,0 +1,27 @@
+"""Issue a bearer token for an API client such as a kiosk."""
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.tokens import create_token
+
+
+class Command(BaseCommand):
+    """Create a token for a user and print it once."""
+
+    help = ("Create a bearer token for a user, e.g. a kiosk account with "
+            "the polls.add_vote permission, and print it. Only its digest "
+            "is stored, so it cannot be shown again.")
+
+    def add_arguments(self, parser):
+        """Add the username and token name."""
+        parser.add_argument('username')
+        parser.add_argument('--name', default='kiosk',
+                            help='What the token is for.')
+
+    def handle(self, *args, **options):
+        """Create the token and print it."""
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"There is no user {options['username']!r}.")
+        self.stdout.write(create_token(user, options['name']))
@@ -0,0 +1,40 @@
+"""Export votes or poll results as CSV or NDJSON."""
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export, parse_filters
+
+
+class Command(BaseCommand):
+    """Stream votes or results to stdout or a file in constant memory."""
+
+    help = "Export votes or per-choice results as CSV or NDJSON."
+
+    def add_arguments(self, parser):
+        """Add what to export, filters and output options."""
+        parser.add_argument('--kind', choices=('votes', 'results'),
+                            default='votes')
+        parser.add_argument('--format', dest='export_format',
+                            choices=tuple(EXPORT_FORMATS), default='csv')
+        parser.add_argument('--question', help='Only this question id.')
+        parser.add_argument('--since',
+                            help='Only votes cast at or after this time.')
+        parser.add_argument('--until', help='Only votes cast before this time.')
+        parser.add_argument('--output', help='File to write instead of stdout.')
+        parser.add_argument('--chunk-size', type=int,
+                            default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        """Write the export line by line."""
+        try:
+            filters = parse_filters(options['question'], options['since'],
+                                    options['until'])
+        except ValueError as error:
+            raise CommandError(error)
+        lines = export(options['kind'], options['export_format'], filters,
+                       chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,42 @@
+"""Freeze the results of polls that have closed."""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from polls.finalize import (ARCHIVE_BATCH_SIZE, closed_questions,
+                            finalize_question)
+
+
+class Command(BaseCommand):
+    """Write a results snapshot of every closed poll, archiving its votes."""
+
+    help = ("Snapshot the results of polls closed more than --grace seconds "
+            "ago, and with --archive move their votes out of polls_vote. "
+            "Safe to run repeatedly, e.g. from cron.")
+
+    def add_arguments(self, parser):
+        """Add the archive and grace options."""
+        parser.add_argument('--archive', action='store_true',
+                            help='Move the votes of finalized polls to the '
+                                 'archive table.')
+        parser.add_argument('--grace', type=int,
+                            default=settings.POLLS_FINALIZE_GRACE,
+                            help='Seconds after end_date before a poll is '
+                                 'finalized, for votes still being written.')
+        parser.add_argument('--batch-size', type=int,
+                            default=ARCHIVE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        """Finalize every poll that closed before the grace period."""
+        finalized = 0
+        question_ids = list(closed_questions(options['grace'])
+                            .values_list('pk', flat=True))
+        for question_id in question_ids:
+            snapshot = finalize_question(question_id, options['archive'],
+                                         options['batch_size'],
+                                         options['grace'])
+            if snapshot is not None:
+                finalized += 1
+                self.stdout.write(f"Finalized poll {question_id}: "
+                                  f"{snapshot.total} votes.")
+        self.stdout.write(self.style.SUCCESS(
+            f"Finalized {finalized} closed polls."))
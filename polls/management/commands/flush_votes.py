@@ -0,0 +1,41 @@
+"""Drain the write-behind vote journal into the database."""
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from polls.ingest import flush, get_journal
+
+
+class Command(BaseCommand):
+    """Write queued votes in batches, last write wins per (user, question)."""
+
+    help = "Drain queued votes from POLLS_VOTE_JOURNAL into the database."
+
+    def add_arguments(self, parser):
+        """Add batching and scheduling options."""
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Votes written per transaction.')
+        parser.add_argument('--interval', type=float, default=0.5,
+                            help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the queue once and exit.')
+        parser.add_argument('--stats', action='store_true',
+                            help='Print queue depth and flush latency as JSON.')
+
+    def handle(self, *args, **options):
+        """Flush the journal until stopped, or once with --once."""
+        journal = get_journal()
+        if options['stats']:
+            self.stdout.write(json.dumps(journal.stats()))
+            return
+        while True:
+            while flush(journal, options['batch_size']):
+                stats = journal.stats()
+                self.stdout.write(
+                    f"Flushed {stats['last_flush_size']:.0f} votes in "
+                    f"{stats['last_flush_latency'] * 1000:.1f} ms, "
+                    f"{stats['depth']} queued.")
+            if options['once']:
+                return
+            time.sleep(options['interval'])
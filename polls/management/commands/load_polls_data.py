@@ -0,0 +1,193 @@
+"""Load the polls fixtures in one process with bulk inserts."""
+import csv
+import hashlib
+import io
+import json
+import os
+
+from django.conf import settings
+from django.core import serializers
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from polls.models import Choice, FixtureFingerprint, Vote
+from polls.question_cache import forget_all
+
+
+def default_fixtures():
+    """Return the fixtures in data/, in the order the old loop used."""
+    return sorted(str(path) for path in (settings.BASE_DIR / 'data').glob('*.json'))
+
+
+def fingerprint(paths):
+    """Return a digest of the names and contents of the fixtures."""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as fixture:
+            for chunk in iter(lambda: fixture.read(1 << 16), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_fixture(path, chunk_size=1 << 16):
+    """Yield the objects of a JSON array fixture without reading it whole."""
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as fixture:
+        buffer = fixture.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise CommandError(f"{path} is not a JSON array fixture.")
+        buffer = buffer[1:]
+        at_end = False
+        while True:
+            buffer = buffer.lstrip().lstrip(',').lstrip()
+            if buffer.startswith(']'):
+                return
+            try:
+                obj, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if at_end:
+                    raise CommandError(f"{path} is not a valid fixture.")
+                chunk = fixture.read(chunk_size)
+                at_end = not chunk
+                buffer += chunk
+                continue
+            yield obj
+            buffer = buffer[end:]
+
+
+def copy_upsert(connection, model, objs):
+    """Upsert objects on Postgres by COPYing them into a temporary table."""
+    fields = model._meta.concrete_fields
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    staging = quote(f'load_{model._meta.db_table}')
+    columns = ', '.join(quote(field.column) for field in fields)
+    updates = ', '.join(f'{quote(field.column)} = EXCLUDED.{quote(field.column)}'
+                        for field in fields if not field.primary_key)
+
+    rows = io.StringIO()
+    writer = csv.writer(rows)
+    for obj in objs:
+        values = (field.get_db_prep_save(field.pre_save(obj, add=True), connection)
+                  for field in fields)
+        writer.writerow(['\\N' if value is None else value for value in values])
+    copy_sql = (f"COPY {staging} ({columns}) FROM STDIN "
+                f"WITH (FORMAT csv, NULL '\\N')")
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE TEMPORARY TABLE IF NOT EXISTS {staging} '
+                       f'(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP')
+        cursor.execute(f'TRUNCATE {staging}')
+        raw = cursor.cursor
+        if hasattr(raw, 'copy_expert'):  # psycopg2
+            raw.copy_expert(copy_sql, io.StringIO(rows.getvalue()))
+        else:  # psycopg 3
+            with raw.copy(copy_sql) as copy:
+                copy.write(rows.getvalue())
+        cursor.execute(
+            f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} '
+            f'ON CONFLICT ({quote(model._meta.pk.column)}) DO UPDATE SET {updates}')
+
+
+class Command(BaseCommand):
+    """Bulk-load fixtures, skipping them when they are already loaded."""
+
+    help = ("Load the polls fixtures in one process using batched bulk "
+            "inserts (COPY on Postgres), unless they are already loaded.")
+
+    def add_arguments(self, parser):
+        """Add fixture, batching and database options."""
+        parser.add_argument('fixtures', nargs='*',
+                            help='Fixture files; defaults to data/*.json.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--force', action='store_true',
+                            help='Load even if the fingerprint matches.')
+
+    def handle(self, *args, **options):
+        """Load every fixture in one transaction and record its digest."""
+        paths = options['fixtures'] or default_fixtures()
+        using = options['database']
+        digest = fingerprint(paths)
+        fingerprints = FixtureFingerprint.objects.using(using)
+        if not options['force'] and fingerprints.filter(digest=digest).exists():
+            self.stdout.write("Fixtures already loaded, skipping.")
+            return
+
+        self.connection = connections[using]
+        self.using = using
+        self.loaded_models = set()
+        self.m2m_rows = []
+        loaded = 0
+        with transaction.atomic(using=using):
+            for path in paths:
+                model, batch = None, {}
+                for deserialized in serializers.deserialize(
+                        'python', iter_fixture(path), using=using,
+                        ignorenonexistent=True):
+                    obj = deserialized.object
+                    if batch and (type(obj) is not model
+                                  or len(batch) >= options['batch_size']):
+                        loaded += self.flush(model, batch.values())
+                        batch = {}
+                    model = type(obj)
+                    # like loaddata, a later object with the same pk wins
+                    batch[obj.pk] = obj
+                    if any(deserialized.m2m_data.values()):
+                        self.m2m_rows.append((obj, deserialized.m2m_data))
+                if batch:
+                    loaded += self.flush(model, batch.values())
+            self.flush_m2m()
+            self.reset_sequences()
+            call_command('tally_votes', database=using,
+                         stdout=io.StringIO())
+            fingerprints.get_or_create(digest=digest)
+        # bulk upserts send no signals, so cached questions may be stale
+        forget_all()
+        self.stdout.write(self.style.SUCCESS(
+            f"Loaded {loaded} objects from {len(paths)} fixtures."))
+
+    def flush(self, model, objs):
+        """Upsert one batch of objects of a model."""
+        objs = list(objs)
+        if model is Vote:
+            self.add_vote_questions(objs)
+        if self.connection.vendor == 'postgresql':
+            copy_upsert(self.connection, model, objs)
+        else:
+            model._base_manager.using(self.using).bulk_create(
+                objs, update_conflicts=True,
+                unique_fields=[model._meta.pk.name],
+                update_fields=[field.name for field in model._meta.concrete_fields
+                               if not field.primary_key])
+        self.loaded_models.add(model)
+        return len(objs)
+
+    def add_vote_questions(self, votes):
+        """Fill in the question of votes from fixtures older than the field."""
+        missing = [vote for vote in votes if vote.question_id is None]
+        if missing:
+            questions = dict(Choice.objects.using(self.using)
+                             .filter(pk__in={vote.choice_id for vote in missing})
+                             .values_list('pk', 'question_id'))
+            for vote in missing:
+                vote.question_id = questions[vote.choice_id]
+
+    def flush_m2m(self):
+        """Add the many-to-many relations of the loaded objects."""
+        for obj, m2m_data in self.m2m_rows:
+            for name, pks in m2m_data.items():
+                if pks:
+                    getattr(obj, name).add(*pks)
+        self.m2m_rows = []
+
+    def reset_sequences(self):
+        """Move primary key sequences past the loaded ids."""
+        statements = self.connection.ops.sequence_reset_sql(
+            no_style(), list(self.loaded_models))
+        with self.connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
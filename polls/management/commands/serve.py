@@ -0,0 +1,189 @@
+"""Run the site on a preforking gunicorn server, migrating first if asked."""
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.template import engines
+from django.urls import get_resolver
+
+from mysite.backends.pool import close_pools
+
+# any constant shared by every replica; pg_advisory_lock takes a bigint
+MIGRATION_LOCK_ID = 0x706f6c6c73
+# caches whose entries live in one process; workers would each keep their
+# own versions and serve pages another worker has invalidated
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+# compiled in the master process, so every worker shares them
+WARM_TEMPLATES = ('polls/index.html', 'polls/detail.html',
+                  'polls/results.html', 'polls/results_table.html')
+
+
+def cpu_count():
+    """Return the number of CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def default_workers(asgi=False):
+    """Return the worker count for this machine."""
+    # a sync worker waits on the database, an event loop does not
+    return cpu_count() if asgi else 2 * cpu_count() + 1
+
+
+def pending_migrations(using):
+    """Return the migrations not yet applied to a database."""
+    executor = MigrationExecutor(connections[using])
+    return executor.migration_plan(executor.loader.graph.leaf_nodes())
+
+
+@contextmanager
+def migration_lock(using):
+    """Hold a lock that only one replica at a time can take."""
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s)', [MIGRATION_LOCK_ID])
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)',
+                               [MIGRATION_LOCK_ID])
+    else:
+        # other databases here are local files, so replicas share a host
+        path = os.path.join(tempfile.gettempdir(), f'polls-migrate-{using}.lock')
+        with open(path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def process_local_caches():
+    """Return the aliases of the caches each worker would keep its own of."""
+    return [alias for alias, cache in settings.CACHES.items()
+            if cache['BACKEND'] in PROCESS_LOCAL_CACHES]
+
+
+def check_shared_cache(workers):
+    """Raise CommandError if several workers would not share the cache."""
+    local = process_local_caches()
+    if workers > 1 and local:
+        raise CommandError(
+            f"{workers} workers cannot share the {', '.join(local)} cache "
+            f"of {PROCESS_LOCAL_CACHES[0]}; set CACHE_BACKEND to a shared "
+            f"cache such as django.core.cache.backends.redis.RedisCache, "
+            f"or run --workers 1.")
+
+
+def prepare_database(using, migrate, load_data, stdout):
+    """Migrate and load the fixtures unless another replica already did."""
+    if not (migrate and pending_migrations(using)) and not load_data:
+        return
+    with migration_lock(using):
+        # a replica that waited for the lock finds the work done
+        if migrate and pending_migrations(using):
+            call_command('migrate', database=using, interactive=False,
+                         stdout=stdout)
+        if load_data:
+            call_command('load_polls_data', database=using, stdout=stdout)
+
+
+def load_application(asgi):
+    """Import the application and warm what every request uses."""
+    if asgi:
+        from mysite.asgi import application
+    else:
+        from mysite.wsgi import application
+    get_resolver().url_patterns
+    engine = engines[settings.POLLS_TEMPLATE_ENGINE]
+    for name in WARM_TEMPLATES:
+        engine.get_template(name)
+    return application
+
+
+class Command(BaseCommand):
+    """Serve mysite.wsgi or mysite.asgi with preforked gunicorn workers."""
+
+    help = ("Run the site on gunicorn with the application loaded before "
+            "the workers fork. With --migrate, one replica at a time "
+            "applies migrations first.")
+
+    def add_arguments(self, parser):
+        """Add server, worker and startup options."""
+        parser.add_argument('--bind', default=settings.SERVER_BIND)
+        parser.add_argument('--workers', type=int,
+                            default=settings.SERVER_WORKERS,
+                            help='Worker processes; 0 sizes them from the '
+                                 'CPU count, or runs one while the cache '
+                                 'is process-local.')
+        parser.add_argument('--asgi', action='store_true',
+                            help='Run mysite.asgi on uvicorn workers.')
+        parser.add_argument('--max-requests', type=int,
+                            default=settings.SERVER_MAX_REQUESTS,
+                            help='Replace a worker after this many requests; '
+                                 '0 never does.')
+        parser.add_argument('--max-requests-jitter', type=int,
+                            default=settings.SERVER_MAX_REQUESTS_JITTER)
+        parser.add_argument('--timeout', type=int, default=30)
+        parser.add_argument('--graceful-timeout', type=int, default=30)
+        parser.add_argument('--migrate', action='store_true',
+                            help='Apply pending migrations first.')
+        parser.add_argument('--load-data', action='store_true',
+                            help='Load the fixtures first, unless loaded.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        """Prepare the database, load the application and run the server."""
+        workers = options['workers']
+        if not workers:
+            # without a shared cache the site runs in a single worker
+            workers = (1 if process_local_caches()
+                       else default_workers(options['asgi']))
+        check_shared_cache(workers)
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            raise CommandError("The serve command needs gunicorn installed.")
+
+        if options['migrate'] or options['load_data']:
+            prepare_database(options['database'], options['migrate'],
+                             options['load_data'], self.stdout)
+        application = load_application(options['asgi'])
+        # workers must not inherit the master's database sockets
+        connections.close_all()
+        close_pools()
+
+        config = {
+            'bind': options['bind'],
+            'workers': workers,
+            'preload_app': True,
+            'max_requests': options['max_requests'],
+            'max_requests_jitter': options['max_requests_jitter'],
+            'timeout': options['timeout'],
+            'graceful_timeout': options['graceful_timeout'],
+        }
+        if options['asgi']:
+            config['worker_class'] = 'uvicorn.workers.UvicornWorker'
+
+        class Server(BaseApplication):
+            """A gunicorn application configured in code."""
+
+            def load_config(self):
+                """Apply the server options."""
+                for key, value in config.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                """Return the application loaded before forking."""
+                return application
+
+        Server().run()
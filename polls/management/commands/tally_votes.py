@@ -0,0 +1,61 @@
+"""Rebuild or verify the per-choice vote tally from the vote table."""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from polls.models import ArchivedVote, Choice, Vote
+
+
+def count_of(model):
+    """Return a subquery counting the rows of model stored for a choice."""
+    return Coalesce(
+        Subquery(model.objects.filter(choice=OuterRef('pk'))
+                 .order_by().values('choice')
+                 .annotate(total=Count('pk')).values('total'),
+                 output_field=IntegerField()),
+        0,
+    )
+
+
+def counted_votes():
+    """Return the live and archived votes actually stored for a choice."""
+    return count_of(Vote) + count_of(ArchivedVote)
+
+
+class Command(BaseCommand):
+    """Recount votes per choice and store them in Choice.vote_count."""
+
+    help = ("Rebuild Choice.vote_count from polls_vote and the archive, "
+            "or only report drift with --check.")
+
+    def add_arguments(self, parser):
+        """Add the --check and --database options."""
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only verify the tally; exit with an error on any drift.',
+        )
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        """Verify or rebuild the tally."""
+        using = options['database']
+        drifted = (Choice.objects.using(using).annotate(counted=counted_votes())
+                   .exclude(vote_count=counted_votes())
+                   .values_list('pk', 'vote_count', 'counted'))
+        if options['check']:
+            drift = list(drifted)
+            for pk, tallied, counted in drift:
+                self.stderr.write(f"Choice {pk}: tally {tallied}, "
+                                  f"counted {counted}")
+            if drift:
+                raise CommandError(f"{len(drift)} choice tallies are out "
+                                   f"of date.")
+            self.stdout.write(self.style.SUCCESS("Vote tally is up to date."))
+            return
+
+        with transaction.atomic(using=using):
+            updated = (Choice.objects.using(using).exclude(vote_count=counted_votes())
+                       .update(vote_count=counted_votes()))
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt vote tally, {updated} choices corrected."))
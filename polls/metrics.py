@@ -0,0 +1,261 @@
+"""
+Request metrics in the Prometheus text format, shared across workers.
+
+Every process keeps its counters and histograms in memory and writes a
+snapshot to METRICS_DIR at most once per METRICS_FLUSH_INTERVAL. The
+/metrics endpoint adds up the snapshots of all processes. The snapshot of
+a process that has exited is folded into metrics-retired.json, so its
+counts are kept without a file per worker that ever ran.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+HELP = {
+    'polls_requests_total': ('counter', 'Requests handled, by URL name.'),
+    'polls_request_seconds': ('histogram', 'Request latency, by URL name.'),
+    'polls_db_queries_total': ('counter', 'SQL queries run, by URL name.'),
+    'polls_db_query_seconds_total': ('counter',
+                                     'Time spent in SQL, by URL name.'),
+    'polls_vote_phase_seconds': ('histogram',
+                                 'Time spent in each phase of vote().'),
+    'polls_db_pool': ('gauge', 'Connection pool metrics, by process.'),
+    'polls_vote_queue': ('gauge', 'Write-behind vote queue metrics.'),
+    'polls_question_cache': ('gauge',
+                             'Question metadata cache metrics, by process.'),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_last_flush = 0.0
+RETIRED_FILE = 'metrics-retired.json'
+
+
+def series(name, **labels):
+    """Return the Prometheus series name of a metric and its labels."""
+    if not labels:
+        return name
+    pairs = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f'{name}{{{pairs}}}'
+
+
+def inc(name, amount=1, **labels):
+    """Add amount to a counter."""
+    key = series(name, **labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    """Record one observation in a latency histogram."""
+    key = series(name, **labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # one count per bucket, then the sum and the total count
+            histogram = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[index] += 1
+                break
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe how long the body of a with block takes."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def record_request(view, seconds, queries, query_seconds):
+    """Record the latency and SQL use of one request."""
+    inc('polls_requests_total', view=view)
+    observe('polls_request_seconds', seconds, view=view)
+    inc('polls_db_queries_total', queries, view=view)
+    inc('polls_db_query_seconds_total', query_seconds, view=view)
+    maybe_flush()
+
+
+def snapshot():
+    """Return a copy of this process's metrics."""
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'histograms': {key: list(value)
+                           for key, value in _histograms.items()},
+            'gauges': process_gauges(),
+        }
+
+
+def process_gauges():
+    """Return the connection pool and question cache gauges of this process."""
+    from mysite.backends.pool import pool_metrics
+    from .question_cache import local_cache
+
+    values = {
+        series('polls_db_pool', alias=alias, metric=metric, pid=os.getpid()):
+            value
+        for alias, metrics in pool_metrics().items()
+        for metric, value in metrics.items()
+    }
+    for metric, value in local_cache().metrics().items():
+        values[series('polls_question_cache', metric=metric,
+                      pid=os.getpid())] = value
+    return values
+
+
+def is_running(pid):
+    """Return True if a process with the pid exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def maybe_flush():
+    """Write this process's snapshot if the flush interval has passed."""
+    global _last_flush
+    now = time.monotonic()
+    if now - _last_flush < settings.METRICS_FLUSH_INTERVAL:
+        return
+    _last_flush = now
+    flush()
+
+
+def flush():
+    """Write this process's snapshot to METRICS_DIR."""
+    directory = settings.METRICS_DIR
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as snapshot_file:
+        json.dump(snapshot(), snapshot_file)
+    os.replace(temporary, path)
+
+
+def merge(total, data):
+    """Add the counters and histograms of a snapshot to total."""
+    for key, value in data['counters'].items():
+        total['counters'][key] = total['counters'].get(key, 0) + value
+    for key, value in data['histograms'].items():
+        histogram = total['histograms'].setdefault(key, [0] * len(value))
+        for index, amount in enumerate(value):
+            histogram[index] += amount
+
+
+def read_snapshot(path):
+    """Return the snapshot stored at path, or None if it cannot be read."""
+    try:
+        with open(path) as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError):
+        return None
+
+
+def retire(directory, names):
+    """Fold the snapshots of exited processes into the retired snapshot."""
+    with open(os.path.join(directory, f'{RETIRED_FILE}.lock'), 'w') as lock:
+        # another scrape may be folding the same files
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = os.path.join(directory, RETIRED_FILE)
+        retired = read_snapshot(path) or {'counters': {}, 'histograms': {}}
+        folded = []
+        for name in names:
+            # the pid may have been reused since it was found exited
+            if is_running(int(name[len('metrics-'):-len('.json')])):
+                continue
+            data = read_snapshot(os.path.join(directory, name))
+            if data is not None:
+                merge(retired, data)
+                folded.append(name)
+        if not folded:
+            return
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as snapshot_file:
+            json.dump(retired, snapshot_file)
+        os.replace(temporary, path)
+        for name in folded:
+            os.remove(os.path.join(directory, name))
+
+
+def collect():
+    """Return the counters, histograms and gauges of every process."""
+    snapshots = [snapshot()]
+    directory = settings.METRICS_DIR
+    own_file = f'metrics-{os.getpid()}.json'
+    if directory and os.path.isdir(directory):
+        exited = []
+        for name in os.listdir(directory):
+            if (not name.startswith('metrics-') or not name.endswith('.json')
+                    or name in (own_file, RETIRED_FILE)):
+                continue
+            pid = name[len('metrics-'):-len('.json')]
+            if pid.isdigit() and not is_running(int(pid)):
+                exited.append(name)
+        if exited:
+            retire(directory, exited)
+        for name in os.listdir(directory):
+            if (not name.startswith('metrics-') or not name.endswith('.json')
+                    or name == own_file):
+                continue
+            data = read_snapshot(os.path.join(directory, name))
+            if data is not None:
+                snapshots.append(data)
+
+    total = {'counters': {}, 'histograms': {}}
+    values = {}
+    for data in snapshots:
+        merge(total, data)
+        values.update(data.get('gauges', {}))
+
+    from .ingest import buffered_ingestion, get_journal
+    if buffered_ingestion():
+        for metric, value in get_journal().stats().items():
+            values[series('polls_vote_queue', metric=metric)] = value
+    return total['counters'], total['histograms'], values
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    counters, histograms, values = collect()
+    lines = []
+    for name, (kind, description) in HELP.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key in sorted(k for k in counters if k.split('{')[0] == name):
+            lines.append(f'{key} {counters[key]}')
+        for key in sorted(k for k in values if k.split('{')[0] == name):
+            lines.append(f'{key} {values[key]}')
+        for key in sorted(k for k in histograms if k.split('{')[0] == name):
+            labels = key[len(name):].strip('{}')
+            prefix = f'{labels},' if labels else ''
+            histogram = histograms[key]
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram[-1]}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}_sum{suffix} {histogram[-2]}')
+            lines.append(f'{name}_count{suffix} {histogram[-1]}')
+    return '\n'.join(lines) + '\n'
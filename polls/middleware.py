@@ -0,0 +1,103 @@
+"""Middleware that records per-view latency and SQL use."""
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import metrics
+
+# the counter of the request being handled; sync_to_async copies it into
+# the thread that runs the ORM, so async views are counted too
+_current_counter = ContextVar('polls_query_counter', default=None)
+
+
+class QueryCounter:
+    """The number of queries a request ran and the time they took."""
+
+    def __init__(self):
+        """Start with no queries."""
+        self.queries = 0
+        self.seconds = 0.0
+
+
+def count_queries(execute, sql, params, many, context):
+    """Run a query and add it to the current request's counter."""
+    counter = _current_counter.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        counter.queries += 1
+        counter.seconds += time.perf_counter() - started
+
+
+def instrument(connection):
+    """Install count_queries on a connection, once."""
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+@receiver(connection_created)
+def instrument_new_connection(sender, connection, **kwargs):
+    """Count the queries of every connection opened from now on."""
+    instrument(connection)
+
+
+def view_name(request):
+    """Return the URL name of the view that handled a request."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.view_name:
+        return 'unmatched'
+    return match.view_name
+
+
+class MetricsMiddleware:
+    """Time every request and count the SQL queries it runs."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        """Wrap the next handler."""
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """Handle a request, sync or async."""
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        for connection in connections.all(initialized_only=True):
+            instrument(connection)
+        counter = QueryCounter()
+        token = _current_counter.set(counter)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_counter.reset(token)
+        self.record(request, started, counter)
+        return response
+
+    async def __acall__(self, request):
+        """Handle a request under ASGI."""
+        counter = QueryCounter()
+        token = _current_counter.set(counter)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_counter.reset(token)
+        self.record(request, started, counter)
+        return response
+
+    def record(self, request, started, counter):
+        """Record the request once the response is ready."""
+        metrics.record_request(view_name(request),
+                               time.perf_counter() - started,
+                               counter.queries, counter.seconds)
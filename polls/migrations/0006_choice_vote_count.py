@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:05
+
+from django.db import migrations, models
+import polls.models
+
+
+def backfill_vote_count(apps, schema_editor):
+    """Fill the new tally column from the votes already stored."""
+    Choice = apps.get_model('polls', 'Choice')
+    Vote = apps.get_model('polls', 'Vote')
+    counts = (Vote.objects.order_by().values('choice')
+              .annotate(total=models.Count('pk')))
+    for row in counts:
+        Choice.objects.filter(pk=row['choice']).update(vote_count=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0005_remove_choice_votes_alter_question_end_date_vote'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='choice',
+            name='vote_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_vote_count, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='question',
+            name='end_date',
+            field=models.DateTimeField(blank=True, default=polls.models.default_end_date, null=True, verbose_name='date expired'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_vote_question(apps, schema_editor):
+    """Copy each vote's question from its choice and merge duplicate votes."""
+    Choice = apps.get_model('polls', 'Choice')
+    Vote = apps.get_model('polls', 'Vote')
+    Vote.objects.update(question_id=models.Subquery(
+        Choice.objects.filter(pk=models.OuterRef('choice_id'))
+        .values('question_id')[:1]))
+
+    # keep only the latest vote of a user on a question
+    duplicates = (Vote.objects.order_by().values('user_id', 'question_id')
+                  .annotate(latest=models.Max('pk'), votes=models.Count('pk'))
+                  .filter(votes__gt=1))
+    for row in duplicates:
+        (Vote.objects.filter(user_id=row['user_id'],
+                             question_id=row['question_id'])
+         .exclude(pk=row['latest']).delete())
+
+    # the merged votes no longer count towards their choices
+    Choice.objects.update(vote_count=models.functions.Coalesce(
+        models.Subquery(Vote.objects.filter(choice=models.OuterRef('pk'))
+                        .order_by().values('choice')
+                        .annotate(total=models.Count('pk')).values('total'),
+                        output_field=models.IntegerField()),
+        0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('polls', '0007_question_index_keyset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vote',
+            name='question',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='polls.question'),
+        ),
+        migrations.RunPython(backfill_vote_question, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0009_vote_one_per_question'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FixtureFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('loaded_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -1,11 +1,22 @@
 """Models for the Question and Choice in the poll application."""
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import BooleanField, Case, F, Q, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.contrib.auth.models import User
 
+from .cache import invalidate_index, invalidate_results
+from .question_cache import forget_question
+
 DEFAULT_END_DATE = 7
 RECENTLY_PUBLISHED_DAYS = 1
 
+# what VoteManager.record_many() did with each vote
+RECORDED = 'recorded'
+DUPLICATE = 'duplicate'
+STALE = 'stale'
+
 
 def default_end_date():
     """Return the default end_date which is 7 days after the current time."""
@@ -13,6 +24,30 @@ def default_end_date():
             + timezone.timedelta(days=DEFAULT_END_DATE))
 
 
+class QuestionQuerySet(models.QuerySet):
+    """Queries over questions that are evaluated by the database."""
+
+    def published(self, now=None):
+        """Return questions whose pub_date has passed."""
+        return self.filter(pub_date__lte=now or timezone.now())
+
+    def open(self, now=None):
+        """Return questions that are open for voting, like can_vote()."""
+        now = now or timezone.now()
+        return self.filter(Q(end_date__isnull=True) | Q(end_date__gte=now),
+                           pub_date__lte=now)
+
+    def with_is_open(self, now=None):
+        """Annotate each question with is_open, computed in SQL."""
+        now = now or timezone.now()
+        return self.annotate(is_open=Case(
+            When(Q(end_date__isnull=True) | Q(end_date__gte=now),
+                 pub_date__lte=now, then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField(),
+        ))
+
+
 class Question(models.Model):
     """Represents a poll question in the database."""
 
@@ -25,6 +60,29 @@ class Question(models.Model):
         blank=True
     )
 
+    objects = QuestionQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # backs keyset pagination of the index page
+            models.Index(fields=['-pub_date', '-id'],
+                         name='polls_question_pub_id_idx'),
+            # lets the open-polls filter skip polls that have closed
+            models.Index(fields=['end_date'], name='polls_question_end_idx'),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        """Create a question; its saved end date is not known yet."""
+        super().__init__(*args, **kwargs)
+        self._loaded_end_date = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Load a question and remember the end date it was saved with."""
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_end_date = instance.__dict__.get('end_date')
+        return instance
+
     def __str__(self):
         """Return the question text."""
         return self.question_text
@@ -57,23 +115,306 @@ class Choice(models.Model):
 
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     choice_text = models.CharField(max_length=200)
+    vote_count = models.PositiveIntegerField(default=0)
 
     @property
     def votes(self):
-        """Return the number of votes for this choice."""
-        return Vote.objects.filter(choice=self).count()
+        """Return the number of votes for this choice from its tally."""
+        self.refresh_from_db(fields=['vote_count'])
+        return self.vote_count
 
     def __str__(self):
         """Return the choice text."""
         return self.choice_text
 
 
+class VoteManager(models.Manager):
+    """Manager that writes votes as upserts and keeps the tally in step."""
+
+    def record(self, user, choice):
+        """Record the user's vote for a choice, replacing any earlier one."""
+        self.record_many([(user.pk, choice.question_id, choice.pk)])
+
+    def record_many(self, votes):
+        """
+        Upsert (user_id, question_id, choice_id) votes in one transaction.
+
+        The last vote of each user on a question wins. A vote may carry a
+        fourth item, the time it was cast; it is then only written if the
+        user has no vote on the question cast as late.
+
+        First votes are written by one INSERT ... ON CONFLICT DO NOTHING
+        RETURNING, which reports the rows it created. The votes that
+        conflicted are then read under a lock on their vote rows and
+        updated, so concurrent votes on the same (user, question) cannot
+        move the tally twice. This is not a single ON CONFLICT DO UPDATE
+        because the tally needs the choice a vote replaced, which RETURNING
+        cannot give before PostgreSQL 18.
+
+        Return what happened to each (user_id, question_id): RECORDED,
+        DUPLICATE for a timed vote that was already recorded, or STALE for
+        one older than the recorded vote.
+        """
+        latest = {}
+        for user_id, question_id, choice_id, *cast_at in votes:
+            latest[user_id, question_id] = (choice_id,
+                                             cast_at[0] if cast_at else None)
+        if not latest:
+            return {}
+
+        with transaction.atomic(using=self.db):
+            now = timezone.now()
+            created = self._insert_new(
+                [(pair, choice_id, cast_at or now)
+                 for pair, (choice_id, cast_at) in sorted(latest.items())])
+            outcomes = dict.fromkeys(created, RECORDED)
+            deltas = {}
+            for pair in created:
+                choice_id = latest[pair][0]
+                deltas[choice_id] = deltas.get(choice_id, 0) + 1
+
+            conflicted = sorted(pair for pair in latest if pair not in created)
+            changed = []
+            for vote in self._lock_votes(conflicted):
+                pair = (vote.user_id, vote.question_id)
+                choice_id, cast_at = latest[pair]
+                if cast_at is None or vote.voted_at < cast_at:
+                    outcomes[pair] = RECORDED
+                elif (vote.choice_id, vote.voted_at) == (choice_id, cast_at):
+                    outcomes[pair] = DUPLICATE
+                    continue
+                else:
+                    outcomes[pair] = STALE
+                    continue
+                if vote.choice_id != choice_id:
+                    deltas[choice_id] = deltas.get(choice_id, 0) + 1
+                    deltas[vote.choice_id] = deltas.get(vote.choice_id, 0) - 1
+                vote.choice_id = choice_id
+                vote.voted_at = cast_at or now
+                changed.append(vote)
+            if changed:
+                self.bulk_update(changed, ['choice', 'voted_at'])
+
+            deltas = {pk: delta for pk, delta in deltas.items() if delta}
+            if deltas:
+                Choice.objects.using(self.db).filter(pk__in=deltas).update(
+                    vote_count=F('vote_count') + Case(
+                        *[When(pk=pk, then=Value(delta))
+                          for pk, delta in deltas.items()],
+                        default=Value(0),
+                    ))
+        return outcomes
+
+    def _lock_votes(self, pairs):
+        """
+        Return the votes of (user_id, question_id) pairs, locked for update.
+
+        Only the votes of the pairs are read and locked, in batches the
+        database can take, ordered by id within each batch.
+        """
+        if not pairs:
+            return []
+        connection = connections[self.db]
+        batch_size = (connection.ops.bulk_batch_size(
+            ['user_id', 'question_id'], pairs) or len(pairs))
+        votes = []
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            condition = Q()
+            for user_id, question_id in batch:
+                condition |= Q(user_id=user_id, question_id=question_id)
+            votes += self.select_for_update().filter(condition).order_by('pk')
+        return votes
+
+    def _insert_new(self, rows):
+        """
+        Insert ((user_id, question_id), choice_id, voted_at) rows that do
+        not conflict with an existing vote, returning the pairs inserted.
+        """
+        connection = connections[self.db]
+        voted_at = self.model._meta.get_field('voted_at')
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        columns = ['user_id', 'question_id', 'choice_id', 'voted_at']
+        batch_size = connection.ops.bulk_batch_size(columns, rows) or len(rows)
+        inserted = set()
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                params = []
+                for (user_id, question_id), choice_id, when in batch:
+                    params += [user_id, question_id, choice_id,
+                               voted_at.get_db_prep_value(when, connection)]
+                values = ', '.join(['(%s, %s, %s, %s)'] * len(batch))
+                cursor.execute(
+                    f'INSERT INTO {table} ({", ".join(columns)}) '
+                    f'VALUES {values} '
+                    f'ON CONFLICT (user_id, question_id) DO NOTHING '
+                    f'RETURNING user_id, question_id', params)
+                inserted.update(map(tuple, cursor.fetchall()))
+        return inserted
+
+
 class Vote(models.Model):
     """Represents a vote by a user for a specific choice in a poll."""
 
     choice = models.ForeignKey(Choice, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # copied from choice so a user's vote on a question is unique and indexed
+    question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    # when the vote was cast, which a kiosk may report for itself
+    voted_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = VoteManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'question'],
+                                    name='polls_vote_one_per_question'),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        """Create a vote and remember which choice its tally belongs to."""
+        super().__init__(*args, **kwargs)
+        self._tallied_choice_id = None
+        self._loaded_voted_at = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Load a vote and remember its tallied choice and vote time."""
+        instance = super().from_db(db, field_names, values)
+        instance._tallied_choice_id = instance.__dict__.get('choice_id')
+        instance._loaded_voted_at = instance.__dict__.get('voted_at')
+        return instance
+
+    def save(self, *args, **kwargs):
+        """Save the vote and move its tally if the choice has changed."""
+        if self.question_id is None or self._tallied_choice_id != self.choice_id:
+            self.question_id = self.choice.question_id
+            # a changed vote is cast now, unless the caller says when
+            if (self._tallied_choice_id is not None
+                    and self.voted_at == self._loaded_voted_at):
+                self.voted_at = timezone.now()
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            if self._tallied_choice_id != self.choice_id:
+                if self._tallied_choice_id is not None:
+                    Choice.objects.filter(pk=self._tallied_choice_id).update(
+                        vote_count=F('vote_count') - 1)
+                Choice.objects.filter(pk=self.choice_id).update(
+                    vote_count=F('vote_count') + 1)
+                self._tallied_choice_id = self.choice_id
+            self._loaded_voted_at = self.voted_at
 
     def __str__(self):
         """Return a string representation of the vote."""
         return f'{self.user} voted for {self.choice}'
+
+
+class ResultSnapshot(models.Model):
+    """The frozen results of a question that has closed."""
+
+    question = models.OneToOneField(Question, on_delete=models.CASCADE,
+                                    primary_key=True, related_name='snapshot')
+    # votes per choice id, as they were when the question was finalized
+    counts = models.JSONField()
+    total = models.PositiveIntegerField()
+    finalized_at = models.DateTimeField()
+    # the results table, rendered once
+    html = models.TextField()
+    archived = models.BooleanField(default=False)
+
+    def __str__(self):
+        """Return the question and when it was finalized."""
+        return f'{self.question_id} finalized at {self.finalized_at}'
+
+
+class ArchivedVote(models.Model):
+    """A vote of a finalized question, moved out of the live vote table."""
+
+    # the id the vote had in the live table
+    id = models.BigIntegerField(primary_key=True)
+    choice = models.ForeignKey(Choice, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    voted_at = models.DateTimeField()
+
+    def __str__(self):
+        """Return a string representation of the vote."""
+        return f'{self.user_id} voted for {self.choice_id} (archived)'
+
+
+class ApiToken(models.Model):
+    """A bearer token a kiosk or other client authenticates with."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='api_tokens')
+    name = models.CharField(max_length=100)
+    # only the SHA-256 of the token is kept; the token is shown once
+    digest = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """Return the token's name and owner."""
+        return f'{self.name} ({self.user_id})'
+
+
+class FixtureFingerprint(models.Model):
+    """Records the content digest of a set of fixtures loaded into the db."""
+
+    digest = models.CharField(max_length=64, unique=True)
+    loaded_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """Return the digest and when it was loaded."""
+        return f'{self.digest} loaded at {self.loaded_at}'
+
+
+@receiver(post_delete, sender=Vote)
+def remove_vote_from_tally(sender, instance, **kwargs):
+    """Take a deleted vote off the tally of the choice it was counted for."""
+    # the choice may have been changed in memory since it was counted
+    choice_id = instance._tallied_choice_id or instance.choice_id
+    Choice.objects.filter(pk=choice_id, vote_count__gt=0).update(
+        vote_count=F('vote_count') - 1)
+
+
+@receiver([post_save, post_delete], sender=Question)
+@receiver([post_save, post_delete], sender=Choice)
+@receiver([post_save, post_delete], sender=Vote)
+def invalidate_cached_results(sender, instance, **kwargs):
+    """Drop the cached results of the question a changed row belongs to."""
+    question_id = (instance.pk if sender is Question
+                   else instance.question_id)
+    transaction.on_commit(lambda: invalidate_results(question_id))
+
+
+@receiver([post_save, post_delete], sender=Question)
+@receiver([post_save, post_delete], sender=Choice)
+def forget_question_metadata(sender, instance, **kwargs):
+    """Drop the cached metadata and choices of a changed question."""
+    question_id = (instance.pk if sender is Question
+                   else instance.question_id)
+    # now for this process, and again once the change is visible to others
+    forget_question(question_id)
+    transaction.on_commit(lambda: forget_question(question_id))
+
+
+@receiver([post_save, post_delete], sender=Question)
+def invalidate_cached_index(sender, instance, **kwargs):
+    """Drop the cached index pages when a question changes."""
+    invalidate_index()
+    transaction.on_commit(invalidate_index)
+
+
+@receiver(post_save, sender=Question)
+def reopen_finalized_question(sender, instance, **kwargs):
+    """Unfreeze the results of a finalized question that was reopened."""
+    from .finalize import reopen_question
+
+    # only a question saved as closed can have been finalized
+    now = timezone.now()
+    was_closed = (instance._loaded_end_date is not None
+                  and instance._loaded_end_date <= now)
+    if was_closed and (instance.end_date is None or instance.end_date > now):
+        reopen_question(instance.pk)
+    instance._loaded_end_date = instance.end_date
@@ -0,0 +1,251 @@
+"""
+In-process cache of question metadata and choice lists.
+
+The detail, results and vote views all need a question's dates to call
+is_published() and can_vote(), and the detail page and vote() need its
+choices. Both rarely change, so each process keeps them in a bounded LRU
+cache with a time to live. Saving or deleting a Question or Choice drops
+the entry in this process. With POLLS_QUESTION_CACHE_SHARED_INVALIDATION
+the drop is also published through the shared cache, so other processes
+notice on their next lookup instead of when the entry expires.
+
+Vote counts are never cached here; results come from polls.cache.
+Entries are loaded from the primary database, so a lagging replica
+cannot bring back what an invalidation just dropped.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from mysite.routers import primary_reads
+
+MISSING = object()
+# rough per-object overhead used to estimate the size of an entry
+OBJECT_OVERHEAD = 64
+QUESTION_FIELDS = ('id', 'question_text', 'pub_date', 'end_date')
+CHOICE_FIELDS = ('id', 'question_id', 'choice_text')
+
+
+def approximate_size(value):
+    """Return a rough estimate of the bytes a cached value takes."""
+    if isinstance(value, (tuple, list)):
+        return OBJECT_OVERHEAD + sum(approximate_size(item) for item in value)
+    if isinstance(value, str):
+        return OBJECT_OVERHEAD + len(value)
+    return OBJECT_OVERHEAD
+
+
+class LRUCache:
+    """A thread-safe LRU cache bounded by entries, bytes and age."""
+
+    def __init__(self, max_entries=10000, max_bytes=8 * 1024 * 1024, ttl=30.0):
+        """Create an empty cache."""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        # bumped by every delete, so a value loaded before it is not stored
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                      'invalidations': 0}
+
+    def get(self, key, version=None):
+        """Return a fresh value stored under the same version, or MISSING."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, entry_version, size, value = entry
+                if expires > time.monotonic() and entry_version == version:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return value
+                self._remove(key)
+            self.stats['misses'] += 1
+            return MISSING
+
+    def set(self, key, value, version=None, generation=None):
+        """
+        Store a value, evicting the least recently used over the caps.
+
+        Nothing is stored if an entry was dropped since generation was read.
+        """
+        size = approximate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, version, size,
+                                  value)
+            self.bytes += size
+            while (len(self._entries) > self.max_entries
+                   or self.bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def delete(self, key):
+        """Drop one entry."""
+        with self._lock:
+            self.generation += 1
+            if key in self._entries:
+                self._remove(key)
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.bytes = 0
+
+    def metrics(self):
+        """Return the hit, miss and eviction counts and the current size."""
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries),
+                        bytes=self.bytes)
+
+    def _remove(self, key):
+        """Drop an entry while holding the lock."""
+        self.bytes -= self._entries.pop(key)[2]
+
+
+_local = None
+_local_lock = threading.Lock()
+
+
+def local_cache():
+    """Return this process's cache, creating it from the settings."""
+    global _local
+    if _local is None:
+        with _local_lock:
+            if _local is None:
+                _local = LRUCache(
+                    max_entries=settings.POLLS_QUESTION_CACHE_MAX_ENTRIES,
+                    max_bytes=settings.POLLS_QUESTION_CACHE_MAX_BYTES,
+                    ttl=settings.POLLS_QUESTION_CACHE_TTL)
+    return _local
+
+
+def version_key(question_id):
+    """Return the shared cache key of a question's metadata version."""
+    return f'polls:question-meta-version:{question_id}'
+
+
+def shared_version(question_id):
+    """Return the published version of a question, or None if not shared."""
+    if not settings.POLLS_QUESTION_CACHE_SHARED_INVALIDATION:
+        return None
+    return cache.get(version_key(question_id), 0)
+
+
+async def ashared_version(question_id):
+    """Return the published version of a question, asynchronously."""
+    if not settings.POLLS_QUESTION_CACHE_SHARED_INVALIDATION:
+        return None
+    return await cache.aget(version_key(question_id), 0)
+
+
+def forget_question(question_id):
+    """Drop a question and its choices here, and in other processes."""
+    local = local_cache()
+    local.delete(('question', question_id))
+    local.delete(('choices', question_id))
+    if settings.POLLS_QUESTION_CACHE_SHARED_INVALIDATION:
+        try:
+            cache.incr(version_key(question_id))
+        except ValueError:
+            cache.add(version_key(question_id), 1, None)
+
+
+def forget_all():
+    """Drop every entry of this process, e.g. after a bulk load."""
+    local_cache().clear()
+
+
+def as_question(values):
+    """Return a Question built from cached field values, or None."""
+    from .models import Question
+
+    if values is None:
+        return None
+    return Question.from_db(DEFAULT_DB_ALIAS, QUESTION_FIELDS, values)
+
+
+def as_choices(rows):
+    """Return Choice objects built from cached rows."""
+    from .models import Choice
+
+    return [Choice.from_db(DEFAULT_DB_ALIAS, CHOICE_FIELDS, row) for row in rows]
+
+
+def get_question(question_id):
+    """Return a question with its dates, or None if it does not exist."""
+    from .models import Question
+
+    local = local_cache()
+    version = shared_version(question_id)
+    values = local.get(('question', question_id), version)
+    if values is MISSING:
+        generation = local.generation
+        with primary_reads():
+            values = (Question.objects.filter(pk=question_id)
+                      .values_list(*QUESTION_FIELDS).first())
+        local.set(('question', question_id), values, version, generation)
+    return as_question(values)
+
+
+async def aget_question(question_id):
+    """Return a question like get_question(), asynchronously."""
+    from .models import Question
+
+    local = local_cache()
+    version = await ashared_version(question_id)
+    values = local.get(('question', question_id), version)
+    if values is MISSING:
+        generation = local.generation
+        with primary_reads():
+            values = await (Question.objects.filter(pk=question_id)
+                            .values_list(*QUESTION_FIELDS).afirst())
+        local.set(('question', question_id), values, version, generation)
+    return as_question(values)
+
+
+def get_choices(question_id):
+    """Return the choices of a question in display order, without votes."""
+    from .models import Choice
+
+    local = local_cache()
+    version = shared_version(question_id)
+    rows = local.get(('choices', question_id), version)
+    if rows is MISSING:
+        generation = local.generation
+        with primary_reads():
+            rows = tuple(Choice.objects.filter(question_id=question_id)
+                         .order_by('id').values_list(*CHOICE_FIELDS))
+        local.set(('choices', question_id), rows, version, generation)
+    return as_choices(rows)
+
+
+async def aget_choices(question_id):
+    """Return the choices of a question like get_choices(), asynchronously."""
+    from .models import Choice
+
+    local = local_cache()
+    version = await ashared_version(question_id)
+    rows = local.get(('choices', question_id), version)
+    if rows is MISSING:
+        generation = local.generation
+        with primary_reads():
+            rows = tuple([row async for row in Choice.objects
+                          .filter(question_id=question_id).order_by('id')
+                          .values_list(*CHOICE_FIELDS)])
+        local.set(('choices', question_id), rows, version, generation)
+    return as_choices(rows)
@@ -0,0 +1,85 @@
+"""
+Rendering of the polls templates.
+
+Views give templates lists and plain values, not querysets or related
+managers, so a template only formats what its view has already read.
+render_template() holds templates to this: a query run while a polls
+template renders raises QueryBudgetExceeded when QUERY_BUDGET_RAISE is
+true and is logged otherwise. The context processors add the user and
+flash messages lazily, so a view whose template shows them loads them
+first, with signed_in() and load_messages().
+
+POLLS_TEMPLATE_ENGINE picks the engine the pages are rendered with:
+'django', whose cached loader compiles each template once per process, or
+'jinja2', which renders the equivalent templates in polls/jinja2 and
+keeps them compiled in its environment.
+"""
+import logging
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib import messages
+from django.http import HttpResponse
+from django.template import engines
+from django.templatetags.static import static
+from django.urls import reverse
+
+from .budget import (DEFAULT_MAX_DUPLICATES, QueryBudgetExceeded,
+                     QueryWatcher, watch_queries)
+
+logger = logging.getLogger('polls')
+
+
+def url(name, *args):
+    """Return the path of a named URL, for Jinja2 templates."""
+    return reverse(name, args=args)
+
+
+def environment(**options):
+    """Return the Jinja2 environment of the polls templates."""
+    from jinja2 import Environment
+
+    env = Environment(**options)
+    env.globals.update({'static': static, 'url': url})
+    return env
+
+
+@contextmanager
+def no_queries(template_name):
+    """Raise or log if a template runs queries inside the with block."""
+    watcher = QueryWatcher(DEFAULT_MAX_DUPLICATES)
+    with watch_queries(watcher):
+        yield
+    if not watcher.queries:
+        return
+    sql, _ = watcher.most_repeated()
+    message = (f"{template_name} ran {watcher.queries} queries while "
+               f"rendering; pass it evaluated values instead: {sql}")
+    if settings.QUERY_BUDGET_RAISE:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+def signed_in(request):
+    """Return True if the request's user is signed in, loading the user."""
+    return request.user.is_authenticated
+
+
+def load_messages(request):
+    """Read the flash messages of a request before its page renders."""
+    # len() loads them without marking them used, which would make an empty
+    # storage delete its cookie on every response
+    len(messages.get_messages(request))
+
+
+def render_template(template_name, context, request=None):
+    """Render a polls template with the configured engine."""
+    template = engines[settings.POLLS_TEMPLATE_ENGINE].get_template(
+        template_name)
+    with no_queries(template_name):
+        return template.render(context, request)
+
+
+def render_page(request, template_name, context):
+    """Return a response with a rendered polls page."""
+    return HttpResponse(render_template(template_name, context, request))
@@ -0,0 +1,248 @@
+"""
+Production static files: hashed names, precompressed, served by the app.
+
+collectstatic with CompressedManifestStaticFilesStorage shrinks large
+images, gives every file a content-hashed name and writes .gz (and, with
+the brotli package, .br) copies of text files next to it.
+StaticFilesMiddleware indexes STATIC_ROOT once per process and answers
+static requests before the rest of the stack runs. It sends the
+precompressed copy the client accepts and marks hashed names as cacheable
+forever.
+"""
+import gzip
+import io
+import mimetypes
+import os
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.html', '.json',
+                           '.map', '.xml', '.ico')
+OPTIMIZABLE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# files smaller than this are not worth a compressed copy
+MIN_COMPRESS_SIZE = 256
+# a copy must save at least this fraction of the size to be kept
+MIN_COMPRESS_SAVING = 0.05
+JPEG_QUALITY = 82
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def compress(data):
+    """Return the compressed copies of data worth keeping, by suffix."""
+    copies = {'.gz': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        copies['.br'] = brotli.compress(data, quality=11)
+    limit = len(data) * (1 - MIN_COMPRESS_SAVING)
+    return {suffix: copy for suffix, copy in copies.items()
+            if len(copy) < limit}
+
+
+def optimize_image(path, max_width):
+    """
+    Shrink an image file in place to at most max_width pixels wide.
+
+    JPEGs are saved progressive and PNGs losslessly recompressed, keeping
+    their EXIF and colour profile. The file is left alone without Pillow
+    or when the result is not smaller.
+    """
+    if Image is None:
+        return False
+    with Image.open(path) as image:
+        image.load()
+        kind = image.format
+        info = {key: image.info[key] for key in ('exif', 'icc_profile')
+                if image.info.get(key)}
+    # JPEGs are only encoded again when they shrink, so collecting twice
+    # does not lose quality twice
+    if kind == 'JPEG' and image.width <= max_width or kind not in ('JPEG',
+                                                                   'PNG'):
+        return False
+    if image.width > max_width:
+        height = round(image.height * max_width / image.width)
+        image = image.resize((max_width, height), Image.LANCZOS)
+    output = io.BytesIO()
+    if kind == 'JPEG':
+        image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True,
+                   progressive=True, **info)
+    else:
+        image.save(output, 'PNG', optimize=True, **info)
+    if output.tell() >= os.path.getsize(path):
+        return False
+    with open(path, 'wb') as image_file:
+        image_file.write(output.getvalue())
+    return True
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Manifest storage that also shrinks images and precompresses text."""
+
+    def post_process(self, paths, dry_run=False, **options):
+        """Hash every file, then optimize the images and compress the text."""
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # the hashes come from the source files, so optimizing the copies
+        # keeps names stable from one build to the next
+        for name in {*paths, *self.hashed_files.values()}:
+            if name.lower().endswith(OPTIMIZABLE_EXTENSIONS):
+                optimize_image(self.path(name),
+                               settings.STATIC_IMAGE_MAX_WIDTH)
+            elif name.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+                self.write_compressed(name)
+
+    def write_compressed(self, name):
+        """Write the compressed copies of one collected file."""
+        path = self.path(name)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as source:
+            data = source.read()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return
+        for suffix, copy in compress(data).items():
+            with open(path + suffix, 'wb') as target:
+                target.write(copy)
+
+
+def accepted_encodings(header):
+    """Return the content codings an Accept-Encoding header allows."""
+    accepted = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticFile:
+    """One collected file and its precompressed copies."""
+
+    def __init__(self, path, immutable):
+        """Describe the file at path and find its compressed copies."""
+        self.path = path
+        content_type, _ = mimetypes.guess_type(path)
+        self.content_type = content_type or 'application/octet-stream'
+        if self.content_type.startswith('text/'):
+            self.content_type += '; charset=utf-8'
+        self.cache_control = (IMMUTABLE_CACHE_CONTROL if immutable else
+                              f'public, max-age={settings.STATIC_MAX_AGE}')
+        stat = os.stat(path)
+        self.last_modified = int(stat.st_mtime)
+        self.variants = {None: (path, stat.st_size)}
+        for encoding, suffix in ENCODINGS:
+            if os.path.exists(path + suffix):
+                self.variants[encoding] = (path + suffix,
+                                           os.path.getsize(path + suffix))
+
+    def choose(self, accept_encoding):
+        """Return the coding, path and ETag of the copy to send."""
+        accepted = accepted_encodings(accept_encoding)
+        for encoding, _ in ENCODINGS:
+            if encoding in self.variants and encoding in accepted:
+                break
+        else:
+            encoding = None
+        path, size = self.variants[encoding]
+        etag = f'"{self.last_modified:x}-{size:x}-{encoding or "identity"}"'
+        return encoding, path, etag
+
+    def respond(self, request):
+        """Return the response to a GET or HEAD of this file."""
+        encoding, path, etag = self.choose(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        response = get_conditional_response(
+            request, etag=etag, last_modified=self.last_modified)
+        if response is None:
+            response = FileResponse(open(path, 'rb'),
+                                    content_type=self.content_type)
+            # FileResponse names the file it sends, e.g. style.css.gz
+            del response['Content-Disposition']
+            if encoding:
+                response['Content-Encoding'] = encoding
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(self.last_modified)
+        response['Cache-Control'] = self.cache_control
+        if len(self.variants) > 1:
+            response['Vary'] = 'Accept-Encoding'
+        return response
+
+
+def index_static_root(root, url):
+    """Return the collected files under root, by the URL they are served at."""
+    storage = CompressedManifestStaticFilesStorage(location=root)
+    hashed = set(storage.hashed_files.values())
+    files = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root).replace(os.sep, '/')
+            compressed = (name.endswith(tuple(suffix for _, suffix in ENCODINGS))
+                          and os.path.exists(path[:-len('.gz')]))
+            if compressed or relative == storage.manifest_name:
+                continue
+            files[url + relative] = StaticFile(path, relative in hashed)
+    return files
+
+
+class StaticFilesMiddleware:
+    """Serve the files collected in STATIC_ROOT without reaching a view."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        """Index STATIC_ROOT, or step aside if there is nothing to serve."""
+        root = settings.STATIC_ROOT
+        if not settings.STATIC_SERVE or not root or not os.path.isdir(root):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.files = index_static_root(root, settings.STATIC_URL)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """Serve a static file, or pass the request on."""
+        static_file = self.find(request)
+        if iscoroutinefunction(self):
+            return self.__acall__(request, static_file)
+        if static_file is None:
+            return self.get_response(request)
+        return static_file.respond(request)
+
+    async def __acall__(self, request, static_file):
+        """Serve a static file, or pass the request on, under ASGI."""
+        if static_file is None:
+            return await self.get_response(request)
+        return static_file.respond(request)
+
+    def find(self, request):
+        """Return the file a GET or HEAD asks for, or None."""
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        return self.files.get(request.path)
@@ -0,0 +1,12 @@
+"""The test runner of the project."""
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class QueryBudgetRunner(DiscoverRunner):
+    """Run the tests with query budgets raising instead of logging."""
+
+    def setup_test_environment(self, **kwargs):
+        """Set up the test environment and make budgets strict."""
+        super().setup_test_environment(**kwargs)
+        settings.QUERY_BUDGET_RAISE = True
@@ -1,10 +1,51 @@
 import datetime
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock, skipUnless
 
-from django.test import TestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
 from django.utils import timezone
-from django.urls import reverse
+from django.urls import include, path, reverse
 
-from .models import Question, User, Choice, Vote
+from mysite import routers
+from mysite.backends.pool import ConnectionPool, PoolTimeout
+
+from . import cache as results_cache
+from . import conditional
+from . import dashboard
+from . import export
+from . import finalize
+from . import ingest
+from . import live
+from . import metrics
+from . import question_cache
+from . import rendering
+from . import staticfiles
+from . import tokens
+from .budget import QueryBudgetExceeded, query_budget
+from .log import QueuedJSONHandler
+from .management.commands import serve
+from . import views
+from .models import ArchivedVote, Question, ResultSnapshot, User, Choice, Vote
 
 
 class QuestionModelTests(TestCase):
@@ -114,6 +155,12 @@ def create_question(question_text, days):
 
 
 class QuestionIndexViewTests(TestCase):
+    def setUp(self):
+        """
+        Start without cached index pages.
+        """
+        cache.clear()
+
     def test_no_questions(self):
         """
         If no questions exist, an appropriate message is displayed.
@@ -242,3 +289,2242 @@ class VoteModelTests(TestCase):
         self.assertEqual(self.choice1.votes, 0)
         self.assertEqual(self.choice2.votes, 1)
 
+    def test_changed_vote_keeps_a_given_time(self):
+        """
+        Changing a vote's choice stamps it now, unless the caller set a time.
+        """
+        cast_at = timezone.now() - datetime.timedelta(days=1)
+        vote = Vote.objects.create(user=self.user, choice=self.choice1, voted_at=cast_at)
+        self.assertEqual(vote.voted_at, cast_at)
+        vote = Vote.objects.get(pk=vote.pk)
+        vote.choice = self.choice2
+        vote.save()
+        self.assertGreater(vote.voted_at, cast_at)
+        vote = Vote.objects.get(pk=vote.pk)
+        vote.choice, vote.voted_at = self.choice1, cast_at
+        vote.save()
+        self.assertEqual(Vote.objects.get(pk=vote.pk).voted_at, cast_at)
+
+    def test_vote_count_is_loaded_with_the_choice(self):
+        """
+        The denormalized vote_count comes with the choice, without a query.
+        """
+        Vote.objects.create(user=self.user, choice=self.choice1)
+        choices = list(Choice.objects.order_by('id'))
+        with self.assertNumQueries(0):
+            self.assertEqual([choice.vote_count for choice in choices], [1, 0])
+
+    def test_votes_is_always_current(self):
+        """
+        Choice.votes reads the latest tally, unlike the loaded vote_count.
+        """
+        Vote.objects.create(user=self.user, choice=self.choice1)
+        self.assertEqual(self.choice1.vote_count, 0)
+        self.assertEqual(self.choice1.votes, 1)
+
+
+
+class VoteTallyTests(TestCase):
+    def setUp(self):
+        """
+        Set up a test user, question, and choices.
+        """
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.question = create_question(question_text="Tally question.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+        self.client.login(username='testuser', password='12345')
+        cache.clear()
+
+    def test_vote_view_updates_tally(self):
+        """
+        Voting increments the tally, and re-voting moves it to the new choice.
+        """
+        url = reverse('kupolls:vote', args=(self.question.id,))
+        self.client.post(url, {'choice': self.choice1.id})
+        self.assertEqual(self.choice1.votes, 1)
+        self.client.post(url, {'choice': self.choice2.id})
+        self.assertEqual(self.choice1.votes, 0)
+        self.assertEqual(self.choice2.votes, 1)
+        self.assertEqual(Vote.objects.count(), 1)
+
+    def test_deleting_vote_updates_tally(self):
+        """
+        Deleting a vote takes it off the tally.
+        """
+        vote = Vote.objects.create(user=self.user, choice=self.choice1)
+        vote.delete()
+        self.assertEqual(self.choice1.votes, 0)
+
+    def test_deleting_changed_vote_updates_counted_choice(self):
+        """
+        A vote deleted after its choice changed in memory leaves its tally.
+        """
+        vote = Vote.objects.create(user=self.user, choice=self.choice1)
+        vote.choice = self.choice2
+        vote.delete()
+        self.assertEqual(self.choice1.votes, 0)
+        self.assertEqual(self.choice2.votes, 0)
+
+    def test_results_read_tally(self):
+        """
+        The results page shows the tally without counting the vote table.
+        """
+        Vote.objects.create(user=self.user, choice=self.choice1)
+        response = self.client.get(reverse('kupolls:results', args=(self.question.id,)))
+        self.assertContains(response, f'<td id="votes-{self.choice1.id}">1</td>', html=True)
+
+    def test_tally_votes_command_rebuilds_drift(self):
+        """
+        tally_votes --check reports drift and tally_votes repairs it.
+        """
+        Vote.objects.create(user=self.user, choice=self.choice1)
+        Choice.objects.filter(pk=self.choice1.pk).update(vote_count=5)
+        with self.assertRaises(CommandError):
+            call_command('tally_votes', check=True, stdout=StringIO(), stderr=StringIO())
+        call_command('tally_votes', stdout=StringIO())
+        self.assertEqual(self.choice1.votes, 1)
+        call_command('tally_votes', check=True, stdout=StringIO())
+
+
+class ResultsCacheTests(TestCase):
+    def setUp(self):
+        """
+        Set up a question with choices and a clean cache.
+        """
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.question = create_question(question_text="Cached question.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+        self.url = reverse('kupolls:results', args=(self.question.id,))
+
+    def test_results_table_is_cached(self):
+        """
+        After the first render, results are served without any query.
+        """
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertContains(response, "Blue")
+
+    def test_vote_invalidates_results(self):
+        """
+        Recording a vote makes the next results page show the new count.
+        """
+        self.client.get(self.url)
+        self.client.login(username='testuser', password='12345')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('kupolls:vote', args=(self.question.id,)),
+                             {'choice': self.choice2.id})
+        response = self.client.get(self.url)
+        self.assertContains(response, f'<td id="votes-{self.choice2.id}">1</td>', html=True)
+
+    def test_single_flight_renders_once(self):
+        """
+        Only the worker holding the lock renders; others wait for its result.
+        """
+        render = mock.Mock(return_value="table")
+        self.assertEqual(results_cache.get_results_table(1, render), "table")
+        self.assertEqual(results_cache.get_results_table(1, render), "table")
+        self.assertEqual(render.call_count, 1)
+
+    def test_waiting_worker_falls_back_to_rendering(self):
+        """
+        A worker that cannot get the lock renders itself after waiting.
+        """
+        version = results_cache.results_version(2)
+        cache.add(f'polls:results:2:{version}:lock', 1)
+        render = mock.Mock(return_value="table")
+        with mock.patch.object(results_cache, 'RESULTS_LOCK_WAIT', 0.05):
+            self.assertEqual(results_cache.get_results_table(2, render), "table")
+        render.assert_called_once()
+
+    def test_lost_version_is_not_reused(self):
+        """
+        A version key lost from the cache comes back with a new version.
+        """
+        version = results_cache.results_version(3)
+        results_cache.invalidate_results(3)
+        bumped = results_cache.results_version(3)
+        cache.delete(results_cache.results_version_key(3))
+        self.assertNotIn(results_cache.results_version(3), (version, bumped))
+        cache.delete(results_cache.INDEX_VERSION_KEY)
+        self.assertNotIn(results_cache.index_version(), (1, 2))
+
+
+class IndexPaginationTests(TestCase):
+    def setUp(self):
+        """
+        Start without cached index pages.
+        """
+        cache.clear()
+
+    def test_open_status_is_annotated(self):
+        """
+        The index marks open and closed polls without calling can_vote().
+        """
+        open_question = create_question(question_text="Open.", days=-1)
+        closed_question = Question.objects.create(
+            question_text="Closed.",
+            pub_date=timezone.now() - datetime.timedelta(days=5),
+            end_date=timezone.now() - datetime.timedelta(days=1),
+        )
+        with mock.patch.object(Question, 'can_vote') as can_vote:
+            response = self.client.get(reverse('kupolls:index'))
+        can_vote.assert_not_called()
+        status = {q.id: q.is_open for q in response.context['latest_question_list']}
+        self.assertEqual(status, {open_question.id: True, closed_question.id: False})
+
+    def test_status_open_filter(self):
+        """
+        ?status=open lists only polls that are open for voting.
+        """
+        open_question = create_question(question_text="Open.", days=-1)
+        Question.objects.create(
+            question_text="Closed.",
+            pub_date=timezone.now() - datetime.timedelta(days=5),
+            end_date=timezone.now() - datetime.timedelta(days=1),
+        )
+        response = self.client.get(reverse('kupolls:index'), {'status': 'open'})
+        self.assertQuerysetEqual(response.context['latest_question_list'], [open_question])
+
+    def test_keyset_pages_cover_all_questions(self):
+        """
+        Following next cursors walks every question exactly once, in order.
+        """
+        same_time = timezone.now() - datetime.timedelta(days=1)
+        questions = [Question.objects.create(question_text=f"Q{i}", pub_date=same_time)
+                     for i in range(views.INDEX_PAGE_SIZE + 5)]
+        seen = []
+        params = {}
+        while True:
+            response = self.client.get(reverse('kupolls:index'), params)
+            seen.extend(response.context['latest_question_list'])
+            if not response.context['next_cursor']:
+                break
+            params = {'after': response.context['next_cursor']}
+        self.assertEqual(seen, sorted(questions, key=lambda q: -q.id))
+
+    def test_invalid_cursor_shows_first_page(self):
+        """
+        An unreadable cursor is ignored instead of failing.
+        """
+        question = create_question(question_text="Past question.", days=-1)
+        response = self.client.get(reverse('kupolls:index'), {'after': 'garbage'})
+        self.assertQuerysetEqual(response.context['latest_question_list'], [question])
+
+
+class VoteUpsertTests(TestCase):
+    def setUp(self):
+        """
+        Set up a test user, question, and choices.
+        """
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.question = create_question(question_text="Upsert question.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+        self.url = reverse('kupolls:vote', args=(self.question.id,))
+
+    def test_one_vote_per_user_and_question(self):
+        """
+        The database rejects a second vote by the same user on a question.
+        """
+        Vote.objects.create(user=self.user, choice=self.choice1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Vote.objects.bulk_create([Vote(user=self.user, choice=self.choice2,
+                                           question=self.question)])
+
+    def test_record_replaces_previous_vote(self):
+        """
+        Recording again updates the existing vote and moves the tally.
+        """
+        Vote.objects.record(self.user, self.choice1)
+        Vote.objects.record(self.user, self.choice2)
+        self.assertEqual(list(Vote.objects.values_list('choice_id', flat=True)),
+                         [self.choice2.id])
+        self.assertEqual(self.choice1.votes, 0)
+        self.assertEqual(self.choice2.votes, 1)
+
+    def test_record_many_last_write_wins(self):
+        """
+        Within a batch, the last vote of a user on a question is kept.
+        """
+        other = User.objects.create_user(username='other', password='12345')
+        Vote.objects.record_many([
+            (self.user.id, self.question.id, self.choice1.id),
+            (other.id, self.question.id, self.choice1.id),
+            (self.user.id, self.question.id, self.choice2.id),
+        ])
+        self.assertEqual(Vote.objects.get(user=self.user).choice, self.choice2)
+        self.assertEqual(self.choice1.votes, 1)
+        self.assertEqual(self.choice2.votes, 1)
+
+    def test_record_many_in_batches(self):
+        """
+        A batch too large for one INSERT is written in several.
+        """
+        User.objects.bulk_create(
+            [User(username=f'voter{n}') for n in range(300)])
+        users = User.objects.filter(username__startswith='voter')
+        outcomes = Vote.objects.record_many(
+            [(user.id, self.question.id, self.choice1.id) for user in users])
+        self.assertEqual(len(outcomes), 300)
+        self.assertEqual(self.choice1.votes, 300)
+
+    def test_changed_votes_locked_in_batches(self):
+        """
+        More changed votes than one locking query can take are all updated.
+        """
+        User.objects.bulk_create(
+            [User(username=f'voter{n}') for n in range(600)])
+        users = list(User.objects.filter(username__startswith='voter'))
+        Vote.objects.record_many(
+            [(user.id, self.question.id, self.choice1.id) for user in users])
+        Vote.objects.record_many(
+            [(user.id, self.question.id, self.choice2.id) for user in users])
+        self.assertEqual(self.choice1.votes, 0)
+        self.assertEqual(self.choice2.votes, 600)
+
+    def test_only_conflicting_votes_are_locked(self):
+        """
+        Other votes of the same users and questions are neither read nor locked.
+        """
+        other = User.objects.create_user(username='other', password='12345')
+        second = create_question(question_text="Second question.", days=-1)
+        second_choice = Choice.objects.create(question=second, choice_text="Green")
+        for user in (self.user, other):
+            Vote.objects.record(user, self.choice1)
+            Vote.objects.record(user, second_choice)
+        with transaction.atomic():
+            locked = Vote.objects._lock_votes(
+                [(self.user.id, self.question.id), (other.id, second.id)])
+        self.assertEqual(sorted((vote.user_id, vote.question_id) for vote in locked),
+                         [(self.user.id, self.question.id), (other.id, second.id)])
+
+    def test_vote_view_query_count(self):
+        """
+        With the question cached, a vote costs the locked upsert and tally update.
+        """
+        self.client.login(username='testuser', password='12345')
+        Vote.objects.record(self.user, self.choice1)
+        self.client.get(reverse('kupolls:detail', args=(self.question.id,)))
+        with self.assertNumQueries(8):
+            response = self.client.post(self.url, {'choice': self.choice2.id})
+        self.assertRedirects(response, reverse('kupolls:results', args=(self.question.id,)),
+                             fetch_redirect_response=False)
+
+    def test_vote_with_invalid_choice(self):
+        """
+        A malformed choice redisplays the form with an error message.
+        """
+        self.client.login(username='testuser', password='12345')
+        response = self.client.post(self.url, {'choice': 'abc'})
+        self.assertContains(response, "You didn&#x27;t select a choice.")
+        self.assertEqual(Vote.objects.count(), 0)
+
+
+class BufferedIngestionTests(TestCase):
+    def setUp(self):
+        """
+        Set up a question, a voter and an empty journal file.
+        """
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.question = create_question(question_text="Buffered question.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'journal.sqlite3')
+
+    def test_buffered_vote_is_queued(self):
+        """
+        In buffered mode, vote() queues the vote instead of writing it.
+        """
+        self.client.login(username='testuser', password='12345')
+        with self.settings(POLLS_VOTE_INGESTION='buffered', POLLS_VOTE_JOURNAL=self.path):
+            self.client.post(reverse('kupolls:vote', args=(self.question.id,)),
+                             {'choice': self.choice1.id})
+            self.assertEqual(ingest.get_journal().depth(), 1)
+        self.assertEqual(Vote.objects.count(), 0)
+
+    def test_flush_keeps_last_vote(self):
+        """
+        Flushing writes the last queued vote of each user and reports stats.
+        """
+        journal = ingest.VoteJournal(self.path)
+        journal.append(self.user.id, self.question.id, self.choice1.id)
+        journal.append(self.user.id, self.question.id, self.choice2.id)
+        self.assertEqual(ingest.flush(journal), 2)
+        self.assertEqual(Vote.objects.get(user=self.user).choice, self.choice2)
+        self.assertEqual(self.choice2.votes, 1)
+        stats = journal.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['last_flush_size'], 2)
+        self.assertIn('last_flush_latency', stats)
+
+    def test_unwritable_vote_is_dead_lettered(self):
+        """
+        A vote for a deleted choice is moved aside, not retried forever.
+        """
+        journal = ingest.VoteJournal(self.path)
+        journal.append(self.user.id, self.question.id, self.choice1.id)
+        journal.append(self.user.id, self.question.id, self.choice2.id)
+        dead_seq = journal.peek(2)[1][0]
+        deleted_id = self.choice2.id
+        self.choice2.delete()
+        self.assertEqual(ingest.flush(journal), 2)
+        self.assertEqual(Vote.objects.get(user=self.user).choice_id, self.choice1.id)
+        self.assertEqual(journal.dead(), [
+            (dead_seq, self.user.id, self.question.id, deleted_id,
+             "The choice no longer exists on the question.")])
+        stats = journal.stats()
+        self.assertEqual((stats['depth'], stats['dead']), (0, 1))
+
+    def test_queued_votes_survive_a_crash(self):
+        """
+        Votes queued before a failed flush are written after a restart.
+        """
+        journal = ingest.VoteJournal(self.path)
+        journal.append(self.user.id, self.question.id, self.choice1.id)
+        with mock.patch.object(Vote.objects, 'record_many', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                ingest.flush(journal)
+        del journal
+
+        restarted = ingest.VoteJournal(self.path)
+        self.assertEqual(restarted.depth(), 1)
+        with self.settings(POLLS_VOTE_JOURNAL=self.path):
+            call_command('flush_votes', once=True, stdout=StringIO())
+        self.assertEqual(restarted.depth(), 0)
+        self.assertEqual(Vote.objects.get(user=self.user).choice, self.choice1)
+
+
+class VoteBatchTests(TestCase):
+    def setUp(self):
+        """
+        Set up a kiosk account, two voters and an open and a closed question.
+        """
+        self.kiosk = User.objects.create_user(username='kiosk', password='12345')
+        self.kiosk.user_permissions.add(Permission.objects.get(codename='add_vote'))
+        self.token = tokens.create_token(self.kiosk, 'Lobby kiosk')
+        self.voters = [User.objects.create_user(username=f'voter{n}', password='12345')
+                       for n in range(2)]
+        self.question = create_question(question_text="Kiosk question.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+        self.closed = create_question(question_text="Closed question.", days=-5)
+        self.closed.end_date = timezone.now() - datetime.timedelta(days=1)
+        self.closed.save()
+        self.closed_choice = Choice.objects.create(question=self.closed, choice_text="Late")
+        self.url = reverse('kupolls:vote_batch')
+        self.cast_at = timezone.now() - datetime.timedelta(hours=1)
+
+    def record(self, voter, choice, minutes=0):
+        """Return a vote record cast minutes after the test's start time."""
+        return {'user': voter.id, 'question': choice.question_id, 'choice': choice.id,
+                'client_timestamp': (self.cast_at + datetime.timedelta(minutes=minutes)).isoformat()}
+
+    def post(self, body, token=None):
+        """Post a request body with the kiosk's bearer token."""
+        return self.client.post(self.url, body, content_type='application/json',
+                                HTTP_AUTHORIZATION=f'Bearer {token or self.token}')
+
+    def submit(self, records):
+        """Post a batch as the kiosk and return the decoded response."""
+        response = self.post(json.dumps({'votes': records}))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_batch_requires_a_token(self):
+        """
+        Without a valid bearer token the API answers 401 in JSON.
+        """
+        self.client.login(username='kiosk', password='12345')
+        response = self.client.post(self.url, json.dumps({'votes': []}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+        self.assertIn('error', response.json())
+        self.assertEqual(self.post('{"votes": []}', token='wrong').status_code, 401)
+
+    def test_batch_requires_permission(self):
+        """
+        Tokens of users without the add_vote permission get a JSON 403.
+        """
+        token = tokens.create_token(self.voters[0], 'Not a kiosk')
+        response = self.post(json.dumps({'votes': []}), token=token)
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('error', response.json())
+
+    def test_batch_needs_no_csrf_token(self):
+        """
+        Kiosks authenticate with their token, so CSRF checks do not apply.
+        """
+        self.client = Client(enforce_csrf_checks=True)
+        self.assertEqual(self.post(json.dumps({'votes': []})).status_code, 200)
+
+    def test_batch_records_votes(self):
+        """
+        Every valid record is written, with its kiosk time, and tallied.
+        """
+        payload = self.submit([self.record(self.voters[0], self.choice1),
+                               self.record(self.voters[1], self.choice2)])
+        self.assertEqual(payload['results'], [{'status': 'recorded'}] * 2)
+        self.assertEqual(payload['counts'], {'recorded': 2})
+        self.assertEqual(self.choice1.votes, 1)
+        self.assertEqual(self.choice2.votes, 1)
+        self.assertEqual(Vote.objects.get(user=self.voters[0]).voted_at, self.cast_at)
+
+    def test_retried_batch_is_idempotent(self):
+        """
+        Submitting the same batch again reports duplicates and changes nothing.
+        """
+        records = [self.record(self.voters[0], self.choice1),
+                   self.record(self.voters[1], self.choice1)]
+        self.submit(records)
+        payload = self.submit(records)
+        self.assertEqual(payload['counts'], {'duplicate': 2})
+        self.assertEqual(self.choice1.votes, 2)
+        self.assertEqual(Vote.objects.count(), 2)
+
+    def test_latest_cast_vote_wins(self):
+        """
+        The vote cast last wins, within a batch and against earlier batches.
+        """
+        payload = self.submit([self.record(self.voters[0], self.choice2, minutes=5),
+                               self.record(self.voters[0], self.choice1, minutes=1)])
+        self.assertEqual(payload['results'], [{'status': 'recorded'}, {'status': 'stale'}])
+        payload = self.submit([self.record(self.voters[0], self.choice1, minutes=3)])
+        self.assertEqual(payload['results'], [{'status': 'stale'}])
+        self.assertEqual(Vote.objects.get(user=self.voters[0]).choice, self.choice2)
+        self.assertEqual(self.choice1.votes, 0)
+        self.assertEqual(self.choice2.votes, 1)
+
+    def test_batch_stays_within_budget(self):
+        """
+        A batch that inserts, replaces and tallies votes keeps its budget.
+        """
+        self.assertTrue(settings.QUERY_BUDGET_RAISE)
+        self.submit([self.record(self.voters[0], self.choice1)])
+        payload = self.submit([self.record(self.voters[0], self.choice2, minutes=1),
+                               self.record(self.voters[1], self.choice1)])
+        self.assertEqual(payload['counts'], {'recorded': 2})
+
+    def test_invalid_records_are_rejected(self):
+        """
+        Records for closed questions, wrong choices, unknown users or with
+        bad fields are rejected one by one, and the rest are written.
+        """
+        mismatched = self.record(self.voters[1], self.choice1)
+        mismatched['question'] = self.closed.id
+        unknown_user = self.record(self.voters[1], self.choice1)
+        unknown_user['user'] = 0
+        future = self.record(self.voters[1], self.choice1, minutes=24 * 60)
+        payload = self.submit([self.record(self.voters[0], self.choice1),
+                               self.record(self.voters[1], self.closed_choice),
+                               mismatched, unknown_user, future,
+                               {'user': 'x'}, 'vote'])
+        statuses = [result['status'] for result in payload['results']]
+        self.assertEqual(statuses, ['recorded'] + ['rejected'] * 6)
+        self.assertEqual(payload['results'][1]['error'],
+                         "Voting is not allowed for this question.")
+        self.assertEqual(Vote.objects.count(), 1)
+
+    def test_batch_queries_do_not_grow_with_its_size(self):
+        """
+        Validating and writing a batch takes the same queries for any size.
+        """
+        voters = [User.objects.create_user(username=f'many{n}') for n in range(30)]
+        self.submit([self.record(self.voters[0], self.choice1)])
+        with CaptureQueriesContext(connection) as small:
+            self.submit([self.record(self.voters[1], self.choice1)])
+        with CaptureQueriesContext(connection) as large:
+            self.submit([self.record(voter, self.choice2) for voter in voters])
+        self.assertEqual(len(large), len(small))
+
+    def test_malformed_batches(self):
+        """
+        A body that is not a JSON batch, or too large a batch, gets a 400.
+        """
+        for body in ('not json', '[]', '{"votes": {}}'):
+            self.assertEqual(self.post(body).status_code, 400)
+        with self.settings(POLLS_VOTE_BATCH_MAX_SIZE=1):
+            response = self.post(
+                json.dumps({'votes': [self.record(self.voters[0], self.choice1)] * 2}))
+        self.assertEqual(response.status_code, 400)
+
+
+class AsyncURLConf:
+    """URLconf serving the polls app from its async views."""
+
+    urlpatterns = [
+        path('polls/', include('polls.async_urls')),
+        path('accounts/', include('django.contrib.auth.urls')),
+    ]
+
+
+@override_settings(ROOT_URLCONF=AsyncURLConf)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        """
+        Set up a question with choices, a voter and a clean cache.
+        """
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.question = create_question(question_text="Async question.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+
+    def test_index(self):
+        """
+        The async index lists published questions with their status.
+        """
+        create_question(question_text="Future question.", days=30)
+        response = self.client.get(reverse('kupolls:index'))
+        self.assertEqual(response.context['latest_question_list'], [self.question])
+        self.assertContains(response, "OPEN")
+
+    def test_detail_and_results(self):
+        """
+        The async detail and results pages show the question's choices.
+        """
+        self.assertContains(self.client.get(reverse('kupolls:detail', args=(self.question.id,))), "Blue")
+        Vote.objects.create(user=self.user, choice=self.choice2)
+        response = self.client.get(reverse('kupolls:results', args=(self.question.id,)))
+        self.assertContains(response, f'<td id="votes-{self.choice2.id}">1</td>', html=True)
+
+    def test_missing_question_redirects(self):
+        """
+        A missing question redirects to the index.
+        """
+        response = self.client.get(reverse('kupolls:results', args=(999,)))
+        self.assertRedirects(response, reverse('kupolls:index'))
+
+    def test_vote_requires_login(self):
+        """
+        Anonymous visitors are sent to the login page to vote.
+        """
+        response = self.client.post(reverse('kupolls:vote', args=(self.question.id,)),
+                                    {'choice': self.choice1.id})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/accounts/login/', response.url)
+
+    def test_vote(self):
+        """
+        A logged in user's vote is recorded and shown on the results page.
+        """
+        self.client.login(username='testuser', password='12345')
+        url = reverse('kupolls:vote', args=(self.question.id,))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'choice': self.choice1.id})
+        self.assertRedirects(response, reverse('kupolls:results', args=(self.question.id,)),
+                             fetch_redirect_response=False)
+        self.assertEqual(self.choice1.votes, 1)
+        response = self.client.get(reverse('kupolls:detail', args=(self.question.id,)))
+        self.assertEqual(response.context['user_vote'], self.choice1.id)
+
+    def test_vote_errors_match_sync_view(self):
+        """
+        A vote on a missing question is a 404 and one on a closed question is logged.
+        """
+        self.client.login(username='testuser', password='12345')
+        response = self.client.post(reverse('kupolls:vote', args=(999,)),
+                                    {'choice': self.choice1.id})
+        self.assertEqual(response.status_code, 404)
+        closed = create_question(question_text="Closed question.", days=-5)
+        closed.end_date = timezone.now() - datetime.timedelta(days=1)
+        closed.save()
+        choice = Choice.objects.create(question=closed, choice_text="Late")
+        with self.assertLogs('polls', 'INFO') as logs:
+            response = self.client.post(reverse('kupolls:vote', args=(closed.id,)),
+                                        {'choice': choice.id})
+        self.assertContains(response, "Voting is not allowed for this question.")
+        self.assertEqual(logs.records[0].event, 'vote_rejected')
+
+    def test_export(self):
+        """
+        The async export streams results to users allowed to view votes.
+        """
+        self.user.user_permissions.add(Permission.objects.get(codename='view_vote'))
+        self.client.login(username='testuser', password='12345')
+        response = self.client.get(reverse('kupolls:export', args=('results', 'csv')))
+
+        async def collect():
+            return [chunk async for chunk in response.streaming_content]
+
+        lines = b''.join(async_to_sync(collect)()).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+
+    def test_long_poll(self):
+        """
+        The async long poll returns the counts for an outdated version.
+        """
+        Vote.objects.create(user=self.user, choice=self.choice2)
+        response = self.client.get(reverse('kupolls:results_poll', args=(self.question.id,)),
+                                   {'since': '0'})
+        self.assertEqual(response.json()['counts'][str(self.choice2.id)], 1)
+
+    def test_closed_question_is_not_live(self):
+        """
+        The async stream and long poll of a closed question do not wait.
+        """
+        self.question.end_date = timezone.now() - datetime.timedelta(hours=1)
+        self.question.save()
+        response = self.client.get(reverse('kupolls:results_stream', args=(self.question.id,)))
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(reverse('kupolls:results_poll', args=(self.question.id,)),
+                                   {'since': '0'})
+        self.assertTrue(response.json()['closed'])
+
+    def test_results_api_streams(self):
+        """
+        The async results API streams long id lists without blocking.
+        """
+        Vote.objects.create(user=self.user, choice=self.choice2)
+        with mock.patch.object(views, 'RESULTS_API_STREAM_THRESHOLD', 0):
+            response = self.client.get(reverse('kupolls:results_api'),
+                                       {'ids': str(self.question.id)})
+
+        async def collect():
+            return [chunk async for chunk in response.streaming_content]
+
+        payload = json.loads(b''.join(async_to_sync(collect)()))
+        self.assertEqual(payload['results'][0]['counts'][str(self.choice2.id)], 1)
+
+
+class ResultsApiTests(TestCase):
+    def setUp(self):
+        """
+        Set up two published questions with votes and an unpublished one.
+        """
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.question = create_question(question_text="First.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+        self.other = create_question(question_text="Second.", days=-1)
+        self.other_choice = Choice.objects.create(question=self.other, choice_text="Yes")
+        self.future = create_question(question_text="Future.", days=5)
+        Vote.objects.record(self.user, self.choice2)
+        Vote.objects.record(self.user, self.other_choice)
+        self.url = reverse('kupolls:results_api')
+
+    def get(self, ids, **extra):
+        """Ask the results API for the given ids value."""
+        return self.client.get(self.url, {'ids': ids}, **extra)
+
+    def test_served_without_a_trailing_slash(self):
+        """
+        The API answers at /polls/api/results itself, not with a redirect.
+        """
+        self.assertEqual(self.url, '/polls/api/results')
+        self.assertEqual(self.get(str(self.question.id)).status_code, 200)
+
+    def test_counts_of_many_questions_in_one_query(self):
+        """
+        Every published question's counts come from a single query, after
+        one that finds which of the ids are published.
+        """
+        ids = f'{self.question.id},{self.other.id},{self.future.id},999'
+        with self.assertNumQueries(2):
+            payload = self.get(ids).json()
+        results = {entry['id']: entry for entry in payload['results']}
+        self.assertEqual(results[self.question.id]['counts'],
+                         {str(self.choice1.id): 0, str(self.choice2.id): 1})
+        self.assertEqual(results[self.question.id]['total'], 1)
+        self.assertEqual(results[self.other.id]['total'], 1)
+        self.assertEqual(payload['missing'], [self.future.id, 999])
+        self.assertEqual(payload['unchanged'], [])
+
+    def test_known_versions_are_skipped(self):
+        """
+        Questions whose version the client has are listed as unchanged
+        until a vote changes them.
+        """
+        version = self.get(str(self.question.id)).json()['results'][0]['version']
+        with self.assertNumQueries(1):
+            payload = self.get(f'{self.question.id}:{version}').json()
+        self.assertEqual(payload, {'results': [], 'unchanged': [self.question.id],
+                                   'missing': []})
+        vote = Vote.objects.get(user=self.user, question=self.question)
+        vote.choice = self.choice1
+        with self.captureOnCommitCallbacks(execute=True):
+            vote.save()
+        payload = self.get(f'{self.question.id}:{version}').json()
+        self.assertGreater(payload['results'][0]['version'], version)
+        self.assertEqual(payload['results'][0]['counts'][str(self.choice1.id)], 1)
+
+    def test_unknown_ids_get_no_version(self):
+        """
+        Ids of missing or unpublished questions are reported missing, even
+        with a version, and no version key is created for them.
+        """
+        payload = self.get(f'999:1,{self.future.id}:1').json()
+        self.assertEqual(payload, {'results': [], 'unchanged': [],
+                                   'missing': [self.future.id, 999]})
+        self.assertIsNone(cache.get(results_cache.results_version_key(999)))
+        self.assertIsNone(cache.get(results_cache.results_version_key(self.future.id)))
+
+    def test_gzipped_and_streamed(self):
+        """
+        Clients accepting gzip get a compressed body, streamed for long lists.
+        """
+        extra = {'HTTP_ACCEPT_ENCODING': 'gzip, br'}
+        ids = ','.join(str(pk) for pk in range(1, 50))
+        response = self.get(ids, **extra)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))['results']), 2)
+        with mock.patch.object(views, 'RESULTS_API_STREAM_THRESHOLD', 10):
+            response = self.get(ids, **extra)
+        self.assertTrue(response.streaming)
+        payload = json.loads(gzip.decompress(b''.join(response.streaming_content)))
+        self.assertEqual(len(payload['results']), 2)
+
+    def test_chunked_document_is_valid_json(self):
+        """
+        A document written over several chunks is still one JSON object.
+        """
+        ids = [self.question.id, self.other.id]
+        with mock.patch.object(dashboard, 'CHUNK_QUESTIONS', 1):
+            chunks = list(dashboard.results_document(
+                ids, results_cache.results_versions(ids), {}))
+        self.assertEqual(len(json.loads(b''.join(chunks))['results']), 2)
+
+    def test_bad_and_oversized_requests(self):
+        """
+        Malformed id lists and lists over the cap get a 400.
+        """
+        for ids in ('', 'a', '1:x'):
+            self.assertEqual(self.get(ids).status_code, 400)
+        with self.settings(POLLS_RESULTS_API_MAX_IDS=1):
+            self.assertEqual(self.get('1,2').status_code, 400)
+
+
+class LiveResultsTests(TestCase):
+    def setUp(self):
+        """
+        Set up a question with choices, a voter and a clean cache.
+        """
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.question = create_question(question_text="Live question.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+
+    def read_event(self, stream):
+        """
+        Return the JSON data of the next event on a stream.
+        """
+        event = next(stream)
+        if isinstance(event, bytes):
+            event = event.decode()
+        return json.loads(event.split('data: ', 1)[1])
+
+    def test_stream_short_polls_under_wsgi(self):
+        """
+        The sync stream sends the counts and closes, resending them on change.
+        """
+        url = reverse('kupolls:results_stream', args=(self.question.id,))
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertFalse(response.streaming)
+        self.assertIn(f'retry: {int(live.SHORT_POLL_INTERVAL * 1000)}', response.content.decode())
+        first = self.read_event(iter([response.content.split(b'\n\n', 1)[1]]))
+        self.assertEqual(first['counts'], {str(self.choice1.id): 0, str(self.choice2.id): 0})
+
+        response = self.client.get(url, HTTP_LAST_EVENT_ID=str(first['version']))
+        self.assertNotIn(b'data: ', response.content)
+        Vote.objects.record(self.user, self.choice2)
+        results_cache.invalidate_results(self.question.id)
+        response = self.client.get(url, HTTP_LAST_EVENT_ID=str(first['version']))
+        second = self.read_event(iter([response.content]))
+        self.assertEqual(second['counts'][str(self.choice2.id)], 1)
+        self.assertGreater(second['version'], first['version'])
+
+    @mock.patch.object(live, 'STREAM_INTERVAL', 0)
+    def test_async_stream_sends_snapshot_then_changes(self):
+        """
+        The async stream starts with every count and then sends only changes.
+        """
+        other = User.objects.create_user(username='other')
+
+        async def two_events():
+            stream = live.astream_tally(self.question.id)
+            first = await stream.__anext__()
+            await sync_to_async(Vote.objects.record)(self.user, self.choice2)
+            await sync_to_async(Vote.objects.record)(other, self.choice2)
+            await sync_to_async(results_cache.invalidate_results)(self.question.id)
+            second = await stream.__anext__()
+            await stream.aclose()
+            return first, second
+        first, second = (self.read_event(iter([event]))
+                         for event in async_to_sync(two_events)())
+        self.assertEqual(first['counts'], {str(self.choice1.id): 0, str(self.choice2.id): 0})
+        self.assertEqual(second['counts'], {str(self.choice2.id): 2})
+        self.assertGreater(second['version'], first['version'])
+
+    def test_closed_question_has_no_live_updates(self):
+        """
+        The results page of a closed question does not open an event stream.
+        """
+        response = self.client.get(reverse('kupolls:results', args=(self.question.id,)))
+        self.assertContains(response, 'EventSource')
+        self.question.end_date = timezone.now() - datetime.timedelta(hours=1)
+        self.question.save()
+        cache.clear()
+        response = self.client.get(reverse('kupolls:results', args=(self.question.id,)))
+        self.assertNotContains(response, 'EventSource')
+
+    def test_closed_question_endpoints_are_final(self):
+        """
+        A closed question's stream answers 204 and its poll the final counts.
+        """
+        Vote.objects.record(self.user, self.choice1)
+        self.question.end_date = timezone.now() - datetime.timedelta(hours=1)
+        self.question.save()
+        response = self.client.get(reverse('kupolls:results_stream', args=(self.question.id,)))
+        self.assertEqual(response.status_code, 204)
+        url = reverse('kupolls:results_poll', args=(self.question.id,))
+        payload = self.client.get(url).json()
+        self.assertTrue(payload['closed'])
+        self.assertEqual(payload['counts'][str(self.choice1.id)], 1)
+        response = self.client.get(url, {'since': payload['version']})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['closed'])
+
+    def test_long_poll_returns_newer_version(self):
+        """
+        A long poll with an old version returns the current counts at once.
+        """
+        url = reverse('kupolls:results_poll', args=(self.question.id,))
+        version = self.client.get(url).json()['version']
+        Vote.objects.record(self.user, self.choice1)
+        results_cache.invalidate_results(self.question.id)
+        response = self.client.get(url, {'since': version})
+        self.assertEqual(response.json()['counts'][str(self.choice1.id)], 1)
+
+    def test_long_poll_times_out_without_changes(self):
+        """
+        A poll with the current version ends at once with 204 No Content.
+        """
+        url = reverse('kupolls:results_poll', args=(self.question.id,))
+        version = self.client.get(url).json()['version']
+        self.assertEqual(self.client.get(url, {'since': version}).status_code, 204)
+
+    def test_stream_of_unpublished_question(self):
+        """
+        Unpublished questions have no live results.
+        """
+        future = create_question(question_text="Future question.", days=5)
+        response = self.client.get(reverse('kupolls:results_stream', args=(future.id,)))
+        self.assertEqual(response.status_code, 404)
+
+
+class FinalizePollsTests(TestCase):
+    def setUp(self):
+        """
+        Set up a poll that closed an hour ago with two votes.
+        """
+        cache.clear()
+        now = timezone.now()
+        self.question = Question.objects.create(
+            question_text="Closed.", pub_date=now - datetime.timedelta(days=2),
+            end_date=now - datetime.timedelta(hours=1))
+        self.yes = self.question.choice_set.create(choice_text="Yes")
+        self.no = self.question.choice_set.create(choice_text="No")
+        for name, choice in (('ann', self.yes), ('bob', self.no)):
+            user = User.objects.create_user(username=name, password='12345')
+            Vote.objects.create(user=user, choice=choice)
+
+    def test_snapshot_freezes_the_counts(self):
+        """
+        finalize_polls snapshots per-choice counts and the total.
+        """
+        call_command('finalize_polls', stdout=StringIO())
+        snapshot = ResultSnapshot.objects.get(question=self.question)
+        self.assertEqual(snapshot.counts, {str(self.yes.id): 1, str(self.no.id): 1})
+        self.assertEqual(snapshot.total, 2)
+        self.assertIn("Yes", snapshot.html)
+        self.assertEqual(Vote.objects.count(), 2)
+
+    def test_open_and_recently_closed_polls_are_left_alone(self):
+        """
+        Only polls closed longer than the grace period are finalized.
+        """
+        call_command('finalize_polls', grace=2 * 60 * 60, stdout=StringIO())
+        self.assertFalse(ResultSnapshot.objects.exists())
+
+    def test_reopened_question_is_not_finalized(self):
+        """
+        A question reopened after it was found closed is left live.
+        """
+        Question.objects.filter(pk=self.question.pk).update(
+            end_date=timezone.now() + datetime.timedelta(days=1))
+        self.assertIsNone(finalize.finalize_question(self.question.id, archive=True))
+        Question.objects.filter(pk=self.question.pk).update(end_date=None)
+        self.assertIsNone(finalize.finalize_question(self.question.id))
+        self.assertFalse(ResultSnapshot.objects.exists())
+        self.assertEqual(Vote.objects.count(), 2)
+
+    def test_archive_moves_votes_and_keeps_the_tally(self):
+        """
+        Archived votes leave polls_vote with their ids; counts do not change.
+        """
+        ids = sorted(Vote.objects.values_list('id', flat=True))
+        call_command('finalize_polls', archive=True, stdout=StringIO())
+        self.assertFalse(Vote.objects.exists())
+        self.assertEqual(sorted(ArchivedVote.objects.values_list('id', flat=True)), ids)
+        self.yes.refresh_from_db()
+        self.assertEqual(self.yes.vote_count, 1)
+        call_command('tally_votes', check=True, stdout=StringIO())
+        self.assertEqual([row[0] for row in export.vote_rows()], ids)
+
+    def test_results_are_served_from_the_snapshot(self):
+        """
+        The results page of a finalized poll shows the snapshot HTML.
+        """
+        call_command('finalize_polls', stdout=StringIO())
+        ResultSnapshot.objects.filter(question=self.question).update(
+            html='<p>frozen table</p>')
+        response = self.client.get(reverse('kupolls:results', args=(self.question.id,)))
+        self.assertContains(response, "frozen table")
+
+    def test_reopening_restores_votes(self):
+        """
+        Reopening a finalized poll drops its snapshot and restores its votes.
+        """
+        voted_at = sorted(Vote.objects.values_list('voted_at', flat=True))
+        call_command('finalize_polls', archive=True, stdout=StringIO())
+        self.question.end_date = timezone.now() + datetime.timedelta(days=1)
+        self.question.save()
+        self.assertFalse(ResultSnapshot.objects.exists())
+        self.assertFalse(ArchivedVote.objects.exists())
+        self.assertEqual(sorted(Vote.objects.values_list('voted_at', flat=True)), voted_at)
+
+    def test_saving_an_open_question_does_not_reopen(self):
+        """
+        Editing a question that was open when loaded skips the snapshot check.
+        """
+        question = Question.objects.get(pk=self.question.pk)
+        question.end_date = timezone.now() + datetime.timedelta(days=1)
+        question.save()
+        question = Question.objects.get(pk=self.question.pk)
+        question.question_text = "Still open."
+        with mock.patch.object(finalize, 'reopen_question') as reopen_question:
+            question.save()
+        reopen_question.assert_not_called()
+
+
+class LoadPollsDataTests(TestCase):
+    def test_loads_all_fixtures(self):
+        """
+        load_polls_data loads every fixture and rebuilds the vote tally.
+        """
+        call_command('load_polls_data', stdout=StringIO())
+        self.assertEqual(User.objects.count(), 8)
+        self.assertEqual(Question.objects.count(), 7)
+        self.assertEqual(Vote.objects.count(), 8)
+        self.assertEqual(Choice.objects.get(pk=9).votes, 2)
+        # later fixtures override earlier ones, as with loaddata
+        self.assertEqual(Question.objects.get(pk=1).end_date.year, 2024)
+        self.assertEqual(Question.objects.get(pk=1).end_date.month, 11)
+        # sequences continue after the loaded ids
+        self.assertGreater(create_question("New question.", days=-1).pk, 7)
+
+    def test_tallies_the_database_it_loads(self):
+        """
+        The vote tally is rebuilt on the database the fixtures go to.
+        """
+        with mock.patch('polls.management.commands.load_polls_data.call_command') as command:
+            call_command('load_polls_data', database='default', stdout=StringIO())
+        self.assertEqual(command.call_args.kwargs['database'], 'default')
+        self.assertEqual(command.call_args.args, ('tally_votes',))
+
+    def test_skips_when_fingerprint_matches(self):
+        """
+        A second run with unchanged fixtures does not load anything.
+        """
+        call_command('load_polls_data', stdout=StringIO())
+        out = StringIO()
+        with self.assertNumQueries(1):
+            call_command('load_polls_data', stdout=out)
+        self.assertIn("already loaded", out.getvalue())
+
+    def test_streams_fixture_in_small_chunks(self):
+        """
+        Fixtures are parsed incrementally, whatever the chunk size.
+        """
+        from polls.management.commands.load_polls_data import iter_fixture
+        path = os.path.join(settings.BASE_DIR, 'data', 'votes.json')
+        with open(path) as fixture:
+            expected = json.load(fixture)
+        self.assertEqual(list(iter_fixture(path, chunk_size=7)), expected)
+
+
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        """
+        Set up enough questions, choices and votes to expose N+1 queries.
+        """
+        cache.clear()
+        self.users = [User.objects.create_user(username=f'voter{n}', password='12345')
+                      for n in range(5)]
+        self.users[0].user_permissions.add(Permission.objects.get(codename='view_vote'))
+        self.questions = [create_question(question_text=f"Question {n}.", days=-1)
+                          for n in range(25)]
+        for question in self.questions:
+            choices = Choice.objects.bulk_create(
+                Choice(question=question, choice_text=f"Choice {n}") for n in range(10))
+            for user, choice in zip(self.users, choices):
+                Vote.objects.record(user, choice)
+        self.question = self.questions[0]
+        self.choice = self.question.choice_set.first()
+
+    def test_views_stay_within_budget(self):
+        """
+        Every view answers within its query budget, signed in or not.
+        """
+        self.assertTrue(settings.QUERY_BUDGET_RAISE)
+        pages = [reverse('kupolls:index'), reverse('kupolls:index') + '?status=open',
+                 reverse('kupolls:detail', args=(self.question.id,)),
+                 reverse('kupolls:results', args=(self.question.id,)),
+                 reverse('kupolls:results_stream', args=(self.question.id,)),
+                 reverse('signup')]
+        for page in pages:
+            self.client.get(page)
+        self.client.login(username='voter0', password='12345')
+        for page in pages[:4]:
+            self.assertEqual(self.client.get(page).status_code, 200)
+        vote_url = reverse('kupolls:vote', args=(self.question.id,))
+        self.client.post(vote_url, {'choice': self.choice.id})
+        self.client.post(vote_url, {})
+        self.client.get(reverse('kupolls:export', args=('votes', 'csv')))
+        self.client.get(reverse('kupolls:results_poll', args=(self.question.id,)))
+
+    def test_signup_within_budget(self):
+        """
+        Signing up and being logged in stays within the signup budget.
+        """
+        response = self.client.post(reverse('signup'), {
+            'username': 'newcomer', 'password1': 'Xy7!long-pass',
+            'password2': 'Xy7!long-pass'})
+        self.assertRedirects(response, reverse('kupolls:index'))
+
+    def test_n_plus_one_raises(self):
+        """
+        A view that runs one query per row goes over its duplicate budget.
+        """
+        @query_budget(30)
+        def n_plus_one(request):
+            for choice in Choice.objects.only('id')[:5]:
+                choice.choice_text
+        with self.assertRaises(QueryBudgetExceeded):
+            n_plus_one(RequestFactory().get('/'))
+
+    def test_replica_queries_are_counted(self):
+        """
+        The budget watches every database, not only the default one.
+        """
+        replica = mock.MagicMock()
+        aliases = {'default': connection, 'replica1': replica}
+
+        @query_budget(1)
+        def view(request):
+            return HttpResponse()
+        with mock.patch('polls.budget.connections', aliases):
+            view(RequestFactory().get('/'))
+        replica.execute_wrapper.assert_called_once()
+
+    def test_over_budget_is_logged_when_not_strict(self):
+        """
+        Outside DEBUG and tests, going over the budget logs a warning with the stack.
+        """
+        @query_budget(1)
+        def too_many(request):
+            Question.objects.count()
+            Choice.objects.count()
+        with self.settings(QUERY_BUDGET_RAISE=False):
+            with self.assertLogs('polls', level='WARNING') as logs:
+                too_many(RequestFactory().get('/'))
+        self.assertIn('ran 2 queries (budget 1)', logs.output[0])
+
+
+class SessionlessReadTests(TestCase):
+    def setUp(self):
+        """
+        Set up a published question with a choice and an unpublished one.
+        """
+        cache.clear()
+        self.question = create_question(question_text="Read me.", days=-1)
+        self.choice = Choice.objects.create(question=self.question, choice_text="Yes")
+        self.future = create_question(question_text="Not yet.", days=5)
+
+    def session_queries(self, *urls, follow=False):
+        """
+        Return the SQL touching django_session run while getting the urls.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            for url in urls:
+                response = self.client.get(url, follow=follow)
+                self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+        return [query['sql'] for query in queries if 'django_session' in query['sql']]
+
+    def test_anonymous_reads_skip_the_session_table(self):
+        """
+        Anonymous GETs of the index, detail and results run no session queries.
+        """
+        self.assertEqual(self.session_queries(
+            reverse('kupolls:index'),
+            reverse('kupolls:detail', args=(self.question.id,)),
+            reverse('kupolls:results', args=(self.question.id,))), [])
+
+    def test_flash_messages_use_a_signed_cookie(self):
+        """
+        A redirect with an error message round-trips without the session.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('kupolls:detail', args=(self.future.id,)),
+                                       follow=True)
+        self.assertContains(response, "is not published yet")
+        self.assertFalse([query for query in queries if 'django_session' in query['sql']])
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+
+    @override_settings(ROOT_URLCONF=AsyncURLConf)
+    def test_async_anonymous_reads_skip_the_session_table(self):
+        """
+        The async views also read anonymously without the session.
+        """
+        self.assertEqual(self.session_queries(
+            reverse('kupolls:index'),
+            reverse('kupolls:detail', args=(self.future.id,)),
+            reverse('kupolls:results', args=(self.question.id,)), follow=True), [])
+
+    def test_only_signed_in_voting_uses_the_session(self):
+        """
+        Voting needs a signed-in user, which is what loads a session.
+        """
+        User.objects.create_user(username='reader', password='12345')
+        self.client.login(username='reader', password='12345')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('kupolls:vote', args=(self.question.id,)),
+                             {'choice': self.choice.id})
+        self.assertTrue([query for query in queries if 'django_session' in query['sql']])
+
+
+class QuestionCacheTests(TestCase):
+    def setUp(self):
+        """
+        Set up an open question with two choices and a signed-in voter.
+        """
+        cache.clear()
+        self.question = create_question(question_text="Cached question.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client.login(username='testuser', password='12345')
+
+    def question_queries(self, queries):
+        """
+        Return how many captured queries read polls_question or polls_choice lists.
+        """
+        return len([query for query in queries
+                    if query['sql'].startswith('SELECT "polls_question"."id"')
+                    or 'WHERE "polls_choice"."question_id"' in query['sql']])
+
+    def test_views_share_one_lookup(self):
+        """
+        Detail, vote and results load the question and its choices once.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('kupolls:detail', args=(self.question.id,)))
+            self.client.post(reverse('kupolls:vote', args=(self.question.id,)),
+                             {'choice': self.choice1.id}, follow=True)
+        # the question, its choices, and the tally for the results table
+        self.assertEqual(self.question_queries(queries), 3)
+
+    def test_saving_a_question_invalidates(self):
+        """
+        Closing a question is seen by the next request.
+        """
+        self.client.get(reverse('kupolls:detail', args=(self.question.id,)))
+        self.question.end_date = timezone.now() - datetime.timedelta(hours=1)
+        self.question.save()
+        response = self.client.get(reverse('kupolls:detail', args=(self.question.id,)))
+        self.assertRedirects(response, reverse('kupolls:index'))
+
+    def test_adding_a_choice_invalidates(self):
+        """
+        A new choice shows up on the voting form straight away.
+        """
+        self.client.get(reverse('kupolls:detail', args=(self.question.id,)))
+        Choice.objects.create(question=self.question, choice_text="Green")
+        response = self.client.get(reverse('kupolls:detail', args=(self.question.id,)))
+        self.assertContains(response, "Green")
+
+    def test_shared_invalidation(self):
+        """
+        With the shared channel, a change made in another process is seen at once.
+        """
+        with self.settings(POLLS_QUESTION_CACHE_SHARED_INVALIDATION=True):
+            question_cache.get_question(self.question.id)
+            Question.objects.filter(pk=self.question.id).update(question_text="Renamed")
+            self.assertEqual(question_cache.get_question(self.question.id).question_text,
+                             "Cached question.")
+            # what forget_question() in another process publishes
+            cache.set(question_cache.version_key(self.question.id), 1, None)
+            self.assertEqual(question_cache.get_question(self.question.id).question_text,
+                             "Renamed")
+
+    def test_lru_limits_and_counters(self):
+        """
+        The cache evicts the least recently used entry and expires old ones.
+        """
+        lru = question_cache.LRUCache(max_entries=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertIs(lru.get('b'), question_cache.MISSING)
+        self.assertEqual(lru.get('a'), 1)
+        metrics = lru.metrics()
+        self.assertEqual((metrics['hits'], metrics['misses'], metrics['evictions'],
+                          metrics['entries']), (2, 1, 1, 2))
+
+        lru = question_cache.LRUCache(max_bytes=1000, ttl=0)
+        lru.set('big', 'x' * 2000)
+        lru.set('small', 'x')
+        self.assertEqual(lru.metrics()['entries'], 1)
+        self.assertIs(lru.get('small'), question_cache.MISSING)
+
+    def test_load_started_before_invalidation_is_not_stored(self):
+        """
+        A value read before the entry was invalidated is not cached.
+        """
+        lru = question_cache.LRUCache()
+        generation = lru.generation
+        lru.delete('a')
+        lru.set('a', 'stale', generation=generation)
+        self.assertIs(lru.get('a'), question_cache.MISSING)
+
+
+class IndexPageCacheTests(TestCase):
+    def setUp(self):
+        """
+        Set up a published question and an empty cache.
+        """
+        cache.clear()
+        self.question = create_question(question_text="Cached index.", days=-1)
+        self.url = reverse('kupolls:index')
+
+    def test_anonymous_index_is_cached(self):
+        """
+        The second anonymous request is served without queries.
+        """
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertContains(response, "Cached index.")
+
+    def test_saving_a_question_clears_the_page(self):
+        """
+        A new question shows up on the next anonymous request.
+        """
+        self.client.get(self.url)
+        create_question(question_text="Brand new.", days=-1)
+        self.assertContains(self.client.get(self.url), "Brand new.")
+
+    def test_timeout_ends_at_next_transition(self):
+        """
+        The page expires when the next poll is published or closes.
+        """
+        now = timezone.now()
+        Question.objects.create(question_text="Soon.",
+                                pub_date=now + datetime.timedelta(minutes=10))
+        self.question.end_date = now + datetime.timedelta(minutes=3)
+        self.question.save()
+        with mock.patch.object(views.cache, 'set') as cache_set:
+            self.client.get(self.url)
+        timeout = cache_set.call_args.args[2]
+        self.assertTrue(170 <= timeout <= 180, timeout)
+
+    def test_no_caching_right_before_a_transition(self):
+        """
+        A page rendered in the last second before a poll closes is not cached.
+        """
+        self.question.end_date = timezone.now() + datetime.timedelta(milliseconds=500)
+        self.question.save()
+        with mock.patch.object(views.cache, 'set') as cache_set:
+            self.client.get(self.url)
+        cache_set.assert_not_called()
+
+    def test_signed_in_users_are_not_served_the_cached_page(self):
+        """
+        Signed-in users and visitors with flash messages get a fresh page.
+        """
+        self.client.get(self.url)
+        User.objects.create_user(username='member', password='12345')
+        self.client.login(username='member', password='12345')
+        self.assertContains(self.client.get(self.url), "Welcome back, member")
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        """
+        Set up a question with a choice, a voter and an empty cache.
+        """
+        cache.clear()
+        self.question = create_question(question_text="Conditional.", days=-1)
+        self.choice = self.question.choice_set.create(choice_text="Yes")
+        User.objects.create_user(username='voter', password='12345')
+        self.results_url = reverse('kupolls:results', args=(self.question.id,))
+        self.index_url = reverse('kupolls:index')
+
+    def test_results_carry_validators(self):
+        """
+        The results page has an ETag, a Last-Modified date and no-cache.
+        """
+        response = self.client.get(self.results_url)
+        self.assertTrue(response['ETag'].startswith(f'"results-{self.question.id}-'))
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+    def test_results_not_modified_without_queries(self):
+        """
+        A matching If-None-Match gets a 304 without running any query.
+        """
+        etag = self.client.get(self.results_url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.results_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_results_if_modified_since(self):
+        """
+        If-Modified-Since at the Last-Modified date gets a 304.
+        """
+        last_modified = self.client.get(self.results_url)['Last-Modified']
+        response = self.client.get(self.results_url,
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_vote_changes_the_etag(self):
+        """
+        After a vote the old ETag no longer matches.
+        """
+        etag = self.client.get(self.results_url)['ETag']
+        self.client.login(username='voter', password='12345')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('kupolls:vote', args=(self.question.id,)),
+                             {'choice': self.choice.id})
+        self.client.cookies.pop('messages', None)
+        response = self.client.get(self.results_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_closing_changes_the_etag(self):
+        """
+        A page rendered with live updates is not reused once the poll closes.
+        """
+        etag = self.client.get(self.results_url)['ETag']
+        self.question.end_date = timezone.now() - datetime.timedelta(minutes=1)
+        self.question.save()
+        response = self.client.get(self.results_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertNotContains(response, 'EventSource')
+
+    def test_flash_messages_skip_validators(self):
+        """
+        A results page showing flash messages is neither 304 nor tagged.
+        """
+        etag = self.client.get(self.results_url)['ETag']
+        self.client.login(username='voter', password='12345')
+        response = self.client.post(
+            reverse('kupolls:vote', args=(self.question.id,)),
+            {'choice': self.choice.id}, HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertContains(response, "Your vote has been recorded")
+        self.assertNotIn('ETag', response)
+
+    def test_index_not_modified(self):
+        """
+        An anonymous visitor holding the cached index page gets a 304.
+        """
+        etag = self.client.get(self.index_url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.index_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_index_etag_changes_with_questions(self):
+        """
+        Saving a question gives the index page a new ETag.
+        """
+        etag = self.client.get(self.index_url)['ETag']
+        create_question(question_text="Another.", days=-1)
+        response = self.client.get(self.index_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_signed_in_index_has_no_validators(self):
+        """
+        The personalised index page is not tagged.
+        """
+        self.client.login(username='voter', password='12345')
+        self.assertNotIn('ETag', self.client.get(self.index_url))
+
+    def test_validators_of_the_question_set(self):
+        """
+        index_validators() changes when a question is saved.
+        """
+        before = conditional.index_validators()
+        self.question.question_text = "Renamed."
+        self.question.save()
+        self.assertNotEqual(conditional.index_validators()[0], before[0])
+
+
+class StaticFilesTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        """
+        Collect the static files with the manifest storage into a temp dir.
+        """
+        super().setUpClass()
+        cls.root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.root)
+        storages = dict(settings.STORAGES, staticfiles={
+            'BACKEND': 'polls.staticfiles.CompressedManifestStaticFilesStorage'})
+        with override_settings(STATIC_ROOT=cls.root, STORAGES=storages):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            manifest = staticfiles_storage.hashed_files
+            cls.middleware = staticfiles.StaticFilesMiddleware(
+                lambda request: HttpResponse(status=404))
+        cls.css = '/static/' + manifest['polls/style.css']
+        cls.image = manifest['polls/images/background.jpg']
+
+    def get(self, path, **headers):
+        """
+        Send a GET through the static files middleware.
+        """
+        return self.middleware(RequestFactory().get(path, **headers))
+
+    def test_text_is_precompressed(self):
+        """
+        The hashed stylesheet gets a smaller gzip copy next to it.
+        """
+        path = os.path.join(self.root, self.css[len('/static/'):])
+        self.assertLess(os.path.getsize(path + '.gz'), os.path.getsize(path))
+
+    def test_hashed_files_are_cached_forever(self):
+        """
+        A hashed name is immutable; a plain name is revalidated soon.
+        """
+        self.assertEqual(self.get(self.css)['Cache-Control'],
+                         staticfiles.IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(self.get('/static/polls/style.css')['Cache-Control'],
+                         f'public, max-age={settings.STATIC_MAX_AGE}')
+
+    def test_encoding_negotiation(self):
+        """
+        The client gets the compressed copy it accepts, or the plain file.
+        """
+        response = self.get(self.css, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['Content-Type'], 'text/css; charset=utf-8')
+        self.assertNotIn('Content-Encoding',
+                         self.get(self.css, HTTP_ACCEPT_ENCODING='gzip;q=0'))
+
+    def test_not_modified(self):
+        """
+        A matching If-None-Match gets a 304.
+        """
+        etag = self.get(self.css)['ETag']
+        self.assertEqual(self.get(self.css, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_unknown_paths_pass_through(self):
+        """
+        Requests for anything not collected reach the rest of the stack.
+        """
+        self.assertEqual(self.get('/static/polls/missing.css').status_code, 404)
+        self.assertEqual(self.get('/static/staticfiles.json').status_code, 404)
+
+    @skipUnless(staticfiles.Image, "Pillow is not installed")
+    def test_background_is_scaled_down(self):
+        """
+        The background image is collected at most STATIC_IMAGE_MAX_WIDTH wide.
+        """
+        with staticfiles.Image.open(os.path.join(self.root, self.image)) as image:
+            self.assertLessEqual(image.width, settings.STATIC_IMAGE_MAX_WIDTH)
+
+
+class ServeCommandTests(TestCase):
+    def test_workers_follow_cpu_count(self):
+        """
+        Sync servers get 2 x CPUs + 1 workers, ASGI servers one per CPU.
+        """
+        with mock.patch.object(serve, 'cpu_count', return_value=4):
+            self.assertEqual(serve.default_workers(), 9)
+            self.assertEqual(serve.default_workers(asgi=True), 4)
+
+    def test_up_to_date_database_is_left_alone(self):
+        """
+        Without pending migrations no lock is taken and nothing runs.
+        """
+        with mock.patch.object(serve, 'call_command') as call, \
+                mock.patch.object(serve, 'migration_lock') as lock:
+            serve.prepare_database('default', True, False, StringIO())
+        call.assert_not_called()
+        lock.assert_not_called()
+
+    def test_pending_migrations_run_under_the_lock(self):
+        """
+        Pending migrations are applied while holding the lock.
+        """
+        with mock.patch.object(serve, 'pending_migrations', return_value=['0001']), \
+                mock.patch.object(serve, 'call_command') as call:
+            serve.prepare_database('default', True, False, StringIO())
+        self.assertEqual(call.call_args.args, ('migrate',))
+
+    def test_load_data_alone_does_not_migrate(self):
+        """
+        Without --migrate, pending migrations are left for the operator.
+        """
+        with mock.patch.object(serve, 'pending_migrations', return_value=['0001']), \
+                mock.patch.object(serve, 'call_command') as call:
+            serve.prepare_database('default', False, True, StringIO())
+        self.assertEqual([c.args for c in call.call_args_list], [('load_polls_data',)])
+
+    def test_replica_that_waited_skips_migrate(self):
+        """
+        A replica that got the lock after another migrated does nothing.
+        """
+        with mock.patch.object(serve, 'pending_migrations', side_effect=[['0001'], []]), \
+                mock.patch.object(serve, 'call_command') as call:
+            serve.prepare_database('default', True, False, StringIO())
+        call.assert_not_called()
+
+    def test_workers_need_a_shared_cache(self):
+        """
+        Several workers are refused while the cache lives in each process.
+        """
+        with self.assertRaisesMessage(CommandError, "shared cache"):
+            call_command('serve', workers=2)
+
+    @skipUnless(importlib.util.find_spec('gunicorn'), "gunicorn is not installed")
+    def test_process_local_cache_runs_one_worker(self):
+        """
+        Without a shared cache the default is a single worker, not an error.
+        """
+        from gunicorn.app.base import BaseApplication
+
+        servers = []
+        with mock.patch.object(BaseApplication, 'run', autospec=True,
+                               side_effect=servers.append), \
+                mock.patch.object(serve, 'cpu_count', return_value=2):
+            call_command('serve')
+        self.assertEqual(servers[0].cfg.settings['workers'].get(), 1)
+
+    @skipUnless(importlib.util.find_spec('gunicorn'), "gunicorn is not installed")
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1'}})
+    def test_server_preloads_and_recycles_workers(self):
+        """
+        The server loads the app before forking and recycles its workers.
+        """
+        from gunicorn.app.base import BaseApplication
+
+        servers = []
+        with mock.patch.object(BaseApplication, 'run', autospec=True,
+                               side_effect=servers.append), \
+                mock.patch.object(serve, 'cpu_count', return_value=2):
+            call_command('serve', max_requests=500)
+        config = servers[0].cfg.settings
+        self.assertTrue(config['preload_app'].get())
+        self.assertEqual(config['workers'].get(), 5)
+        self.assertEqual(config['max_requests'].get(), 500)
+        self.assertTrue(callable(servers[0].load()))
+
+
+class ReplicaRoutingTests(SimpleTestCase):
+    replica_databases = {'default': {}, 'replica': {'REPLICA': {'weight': 3}}}
+
+    def setUp(self):
+        """
+        Set up a router over one healthy replica.
+        """
+        self.health = mock.Mock()
+        self.health.is_healthy.return_value = True
+        self.router = routers.ReplicaRouter(self.replica_databases, self.health)
+
+    def read_alias(self, model, replica_reads=True):
+        """
+        Return where the router sends a read of model during a request.
+        """
+        token = routers._replica_reads.set(replica_reads)
+        try:
+            return self.router.db_for_read(model)
+        finally:
+            routers._replica_reads.reset(token)
+
+    def test_polls_reads_go_to_the_replica(self):
+        """
+        Reads of polls models in a safe request go to the replica.
+        """
+        self.assertEqual(self.read_alias(Question), 'replica')
+        self.assertEqual(self.router.db_for_write(Question), 'default')
+
+    def test_other_reads_stay_on_the_primary(self):
+        """
+        Users, reads outside requests and primary_reads() use the primary.
+        """
+        self.assertEqual(self.read_alias(User), 'default')
+        self.assertEqual(self.read_alias(Question, replica_reads=False), 'default')
+        token = routers._replica_reads.set(True)
+        try:
+            with routers.primary_reads():
+                self.assertEqual(self.router.db_for_read(Question), 'default')
+        finally:
+            routers._replica_reads.reset(token)
+
+    def test_unhealthy_replica_is_skipped(self):
+        """
+        Without a healthy replica, reads go to the primary.
+        """
+        self.health.is_healthy.return_value = False
+        self.assertEqual(self.read_alias(Question), 'default')
+
+    def test_replicas_are_picked_by_weight(self):
+        """
+        A replica is chosen with its configured weight.
+        """
+        with mock.patch.object(routers.random, 'choices',
+                               return_value=['replica']) as choices:
+            self.read_alias(Question)
+        self.assertEqual(choices.call_args.kwargs['weights'], [3])
+
+    def test_health_is_checked_once_per_interval(self):
+        """
+        A failed check marks the replica down until the next interval.
+        """
+        health = routers.ReplicaHealth(interval=60)
+        with mock.patch.object(health, 'check', return_value=False) as check:
+            self.assertFalse(health.is_healthy('replica'))
+            self.assertFalse(health.is_healthy('replica'))
+        self.assertEqual(check.call_count, 1)
+
+    def test_middleware_pins_writers_to_the_primary(self):
+        """
+        A POST sets the sticky cookie; requests carrying it read the primary.
+        """
+        seen = []
+
+        def view(request):
+            seen.append(routers._replica_reads.get())
+            return HttpResponse()
+
+        middleware = routers.ReplicaMiddleware(view)
+        factory = RequestFactory()
+        middleware(factory.get('/polls/'))
+        response = middleware(factory.post('/polls/1/vote/'))
+        self.assertEqual(response.cookies[settings.REPLICA_STICKY_COOKIE]['max-age'],
+                         settings.REPLICA_STICKY_SECONDS)
+        sticky = factory.get('/polls/1/results/')
+        sticky.COOKIES[settings.REPLICA_STICKY_COOKIE] = '1'
+        middleware(sticky)
+        middleware(factory.get(reverse('admin:index')))
+        self.assertEqual(seen, [True, False, False, False])
+
+
+class TemplateRenderingTests(TestCase):
+    def setUp(self):
+        """
+        Set up a voter and an open question with choices.
+        """
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.question = create_question(question_text="Rendered question.", days=-1)
+        self.choice1 = Choice.objects.create(question=self.question, choice_text="Blue")
+        self.choice2 = Choice.objects.create(question=self.question, choice_text="Red")
+        Vote.objects.record(self.user, self.choice2)
+
+    def test_template_queries_are_refused(self):
+        """
+        A template given a queryset to evaluate goes over its zero budget.
+        """
+        with self.assertRaises(QueryBudgetExceeded):
+            rendering.render_template('polls/results_table.html',
+                                      {'choices': Choice.objects.all()})
+
+    def test_compiled_templates_are_cached(self):
+        """
+        The Django engine compiles each polls template once per process.
+        """
+        from django.template import engines
+        from django.template.loaders.cached import Loader
+
+        self.assertIsInstance(engines['django'].engine.template_loaders[0], Loader)
+
+    @override_settings(MESSAGE_STORAGE='django.contrib.messages.storage.session.SessionStorage')
+    def test_pages_with_session_messages_render_without_queries(self):
+        """
+        Messages kept in the session are read before the page renders.
+        """
+        self.client.login(username='testuser', password='12345')
+        response = self.client.get(reverse('kupolls:detail', args=(999,)), follow=True)
+        self.assertContains(response, "does not exists")
+        response = self.client.get(reverse('kupolls:results', args=(self.question.id,)))
+        self.assertEqual(response.status_code, 200)
+
+    @skipUnless(importlib.util.find_spec('jinja2'), "Jinja2 is not installed")
+    def test_jinja2_pages_match_django(self):
+        """
+        The Jinja2 templates render the same pages as the Django ones.
+        """
+        self.client.login(username='testuser', password='12345')
+        urls = [reverse('kupolls:index'),
+                reverse('kupolls:detail', args=(self.question.id,)),
+                reverse('kupolls:results', args=(self.question.id,))]
+        pages = {}
+        for engine, templates in (('django', settings.TEMPLATES),
+                                  ('jinja2', [*settings.TEMPLATES, settings.JINJA2_TEMPLATES])):
+            with self.settings(POLLS_TEMPLATE_ENGINE=engine, TEMPLATES=templates):
+                cache.clear()
+                pages[engine] = [self.client.get(url).content.decode() for url in urls]
+        for django_page, jinja2_page in zip(pages['django'], pages['jinja2']):
+            # the masked CSRF token differs on every render
+            self.assertHTMLEqual(
+                re.sub(r'name="csrfmiddlewaretoken" value="[^"]*"', '', jinja2_page),
+                re.sub(r'name="csrfmiddlewaretoken" value="[^"]*"', '', django_page))
+        self.assertIn('Welcome back, testuser', pages['jinja2'][0])
+        self.assertIn('name="csrfmiddlewaretoken"', pages['jinja2'][1])
+
+    def test_render_benchmark_report(self):
+        """
+        bench_templates reports render times per template and size.
+        """
+        out = StringIO()
+        call_command('bench_templates', choices=[2, 5], iterations=2,
+                     engine=['django'], stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(len(report['django']), 8)
+        self.assertIn('p99_ms', report['django']['polls/detail.html@5'])
+
+
+class BenchPollsTests(TestCase):
+    def test_small_benchmark_report(self):
+        """
+        bench_polls seeds a consistent dataset and reports every view as JSON.
+        """
+        out = StringIO()
+        call_command('bench_polls', questions=20, choices=3, users=5, votes=60,
+                     requests=3, in_place=True, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['dataset']['votes'], 60)
+        self.assertEqual(set(report['views']), {'index', 'detail', 'results', 'vote'})
+        for view in report['views'].values():
+            self.assertEqual(view['errors'], 0)
+            self.assertGreater(view['queries_per_request'], 0)
+            self.assertIn('p99_ms', view)
+        self.assertEqual(Question.objects.count(), 20)
+        self.assertEqual(Choice.objects.count(), 60)
+        # the seeded tally matches the seeded votes
+        call_command('tally_votes', check=True, stdout=StringIO())
+
+    def test_too_many_votes_is_an_error(self):
+        """
+        Asking for more votes than user and question pairs is refused.
+        """
+        with self.assertRaises(CommandError):
+            call_command('bench_polls', questions=2, users=2, votes=5,
+                         in_place=True, stdout=StringIO())
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        """
+        Set up two questions with votes and a user allowed to export.
+        """
+        self.user = User.objects.create_user(username='auditor', password='12345')
+        self.user.user_permissions.add(Permission.objects.get(codename='view_vote'))
+        self.question = create_question(question_text="Export question.", days=-1)
+        self.other_question = create_question(question_text="Other question.", days=-1)
+        self.choice = Choice.objects.create(question=self.question, choice_text="Blue")
+        other_choice = Choice.objects.create(question=self.other_question, choice_text="Red")
+        Vote.objects.record(self.user, self.choice)
+        Vote.objects.record(self.user, other_choice)
+
+    def test_export_requires_permission(self):
+        """
+        Users without the view_vote permission cannot export.
+        """
+        User.objects.create_user(username='voter', password='12345')
+        self.client.login(username='voter', password='12345')
+        url = reverse('kupolls:export', args=('votes', 'csv'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_csv_votes_filtered_by_question(self):
+        """
+        The CSV export streams a header and the votes of one question.
+        """
+        self.client.login(username='auditor', password='12345')
+        response = self.client.get(reverse('kupolls:export', args=('votes', 'csv')),
+                                   {'question': self.question.id})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,user_id,question_id,choice_id,voted_at')
+        self.assertEqual(len(lines), 2)
+        self.assertIn(f',{self.question.id},{self.choice.id},', lines[1])
+
+    def test_ndjson_votes_filtered_by_time(self):
+        """
+        Votes outside the time range are left out of the export.
+        """
+        self.client.login(username='auditor', password='12345')
+        url = reverse('kupolls:export', args=('votes', 'ndjson'))
+        future = (timezone.now() + datetime.timedelta(days=1)).isoformat()
+        response = self.client.get(url, {'since': future})
+        self.assertEqual(b''.join(response.streaming_content), b'')
+        response = self.client.get(url, {'until': future})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 2)
+
+    def test_invalid_time_is_rejected(self):
+        """
+        An unreadable time range is a bad request.
+        """
+        self.client.login(username='auditor', password='12345')
+        response = self.client.get(reverse('kupolls:export', args=('votes', 'csv')),
+                                   {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_votes_command_results(self):
+        """
+        export_votes writes the per-choice results of a question.
+        """
+        out = StringIO()
+        call_command('export_votes', kind='results', export_format='ndjson',
+                     question=str(self.question.id), stdout=out)
+        self.assertEqual(json.loads(out.getvalue()), {
+            'question_id': self.question.id, 'choice_id': self.choice.id,
+            'choice_text': 'Blue', 'votes': 1,
+        })
+
+
+class FakeConnection:
+    """A stand-in for a DB-API connection."""
+
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def test_connections_are_reused(self):
+        """
+        A returned connection is handed out again instead of reconnecting.
+        """
+        pool = ConnectionPool(max_size=2)
+        connection = pool.checkout(FakeConnection)
+        pool.checkin(connection)
+        self.assertIs(pool.checkout(FakeConnection), connection)
+        self.assertEqual(connection.rollbacks, 1)
+        metrics = pool.metrics()
+        self.assertEqual((metrics['checkouts'], metrics['opened'], metrics['in_use']), (2, 1, 1))
+
+    def test_checkout_times_out_when_exhausted(self):
+        """
+        Checking out more than max_size connections waits, then fails.
+        """
+        pool = ConnectionPool(max_size=1, checkout_timeout=0.01)
+        pool.checkout(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.checkout(FakeConnection)
+        metrics = pool.metrics()
+        self.assertEqual((metrics['waits'], metrics['exhausted']), (1, 1))
+
+    def test_waiter_gets_returned_connection(self):
+        """
+        A waiting checkout receives the connection another thread returns.
+        """
+        pool = ConnectionPool(max_size=1, checkout_timeout=5)
+        connection = pool.checkout(FakeConnection)
+        timer = threading.Timer(0.05, pool.checkin, args=(connection,))
+        timer.start()
+        self.assertIs(pool.checkout(FakeConnection), connection)
+        timer.join()
+
+    def test_checkin_keeps_the_slot_until_returned(self):
+        """
+        A connection being rolled back still counts as in use, so no waiter
+        opens another one past max_size meanwhile.
+        """
+        pool = ConnectionPool(max_size=1)
+        connection = pool.checkout(FakeConnection)
+        sizes = []
+        connection.rollback = lambda: sizes.append(pool.metrics()['in_use'])
+        pool.checkin(connection)
+        self.assertEqual(sizes, [1])
+        metrics = pool.metrics()
+        self.assertEqual((metrics['in_use'], metrics['idle']), (0, 1))
+
+    def test_stale_and_broken_connections_are_replaced(self):
+        """
+        Idle-expired, closed or unhealthy connections are not reused.
+        """
+        pool = ConnectionPool(max_size=1, idle_timeout=0)
+        connection = pool.checkout(FakeConnection)
+        pool.checkin(connection)
+        time.sleep(0.01)
+        self.assertIsNot(pool.checkout(FakeConnection), connection)
+        self.assertTrue(connection.closed)
+
+        ping = mock.Mock(side_effect=OSError)
+        pool = ConnectionPool(max_size=1, health_check_after=0, ping=ping)
+        connection = pool.checkout(FakeConnection)
+        pool.checkin(connection)
+        time.sleep(0.01)
+        self.assertIsNot(pool.checkout(FakeConnection), connection)
+        ping.assert_called_once_with(connection)
+
+    def test_failed_connect_frees_the_slot(self):
+        """
+        A connect() that raises does not use up pool capacity.
+        """
+        pool = ConnectionPool(max_size=1)
+        with self.assertRaises(OSError):
+            pool.checkout(mock.Mock(side_effect=OSError))
+        self.assertIsInstance(pool.checkout(FakeConnection), FakeConnection)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        """
+        Point METRICS_DIR at an empty temporary directory.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        overrides = self.settings(METRICS_DIR=self.directory, METRICS_TOKEN='secret')
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        create_question(question_text="Measured question.", days=-1)
+
+    def scrape(self):
+        """
+        Return the text of the /metrics endpoint.
+        """
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def counter(self, text, key):
+        """
+        Return the value of one series in a scrape, or 0 if it is absent.
+        """
+        for line in text.splitlines():
+            if line.startswith(key + ' '):
+                return float(line.split()[-1])
+        return 0
+
+    def test_requests_are_counted_by_view(self):
+        """
+        Each request adds to its view's count, latency histogram and queries.
+        """
+        key = 'polls_requests_total{view="kupolls:index"}'
+        before = self.counter(self.scrape(), key)
+        self.client.get(reverse('kupolls:index'))
+        text = self.scrape()
+        self.assertEqual(self.counter(text, key), before + 1)
+        self.assertIn('polls_request_seconds_bucket{view="kupolls:index",le="+Inf"}', text)
+        self.assertGreater(self.counter(text, 'polls_db_queries_total{view="kupolls:index"}'), 0)
+
+    def test_vote_is_logged_as_event(self):
+        """
+        A vote is logged with structured fields rather than only a sentence.
+        """
+        question = create_question(question_text="Vote logging.", days=-1)
+        choice = Choice.objects.create(question=question, choice_text="Yes")
+        user = User.objects.create_user(username='logged', password='12345')
+        self.client.force_login(user)
+        with self.assertLogs('polls', level='INFO') as logs:
+            self.client.post(reverse('kupolls:vote', args=(question.id,)), {'choice': choice.id})
+        [record] = [record for record in logs.records if getattr(record, 'event', None) == 'vote']
+        self.assertEqual((record.user_id, record.question_id, record.choice_id),
+                         (user.pk, question.id, choice.id))
+
+    def test_vote_phases_are_timed(self):
+        """
+        vote() records the time of its lookup and write phases.
+        """
+        question = create_question(question_text="Vote timing.", days=-1)
+        choice = Choice.objects.create(question=question, choice_text="Yes")
+        User.objects.create_user(username='voter', password='12345')
+        self.client.login(username='voter', password='12345')
+        self.client.post(reverse('kupolls:vote', args=(question.id,)), {'choice': choice.id})
+        text = self.scrape()
+        self.assertIn('polls_vote_phase_seconds_count{phase="lookup"}', text)
+        self.assertIn('polls_vote_phase_seconds_count{phase="write"}', text)
+
+    def test_snapshots_of_other_workers_are_added(self):
+        """
+        /metrics adds up the snapshot files written by other processes.
+        """
+        key = 'polls_requests_total{view="kupolls:detail"}'
+        before = self.counter(self.scrape(), key)
+        histogram = [0] * (len(metrics.LATENCY_BUCKETS) + 2)
+        histogram[0], histogram[-2], histogram[-1] = 3, 0.003, 3
+        with open(os.path.join(self.directory, 'metrics-999999999.json'), 'w') as snapshot:
+            json.dump({
+                'counters': {key: 3},
+                'histograms': {'polls_request_seconds{view="kupolls:detail"}': histogram},
+                'gauges': {'polls_db_pool{alias="default",metric="size",pid="999999999"}': 4},
+            }, snapshot)
+        text = self.scrape()
+        self.assertEqual(self.counter(text, key), before + 3)
+        # the worker is gone, so its pool gauges are not reported
+        self.assertNotIn('pid="999999999"', text)
+        # and its counts are folded into the retired snapshot
+        self.assertEqual(sorted(name for name in os.listdir(self.directory)
+                                if name.endswith('.json')), [metrics.RETIRED_FILE])
+        self.assertEqual(self.counter(self.scrape(), key), before + 3)
+
+    def test_token_is_required(self):
+        """
+        /metrics needs the bearer token, and is closed while none is set.
+        """
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 403)
+        with self.settings(METRICS_TOKEN=''):
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ')
+            self.assertEqual(response.status_code, 403)
+
+
+class QueuedLoggingTests(SimpleTestCase):
+    def setUp(self):
+        """
+        Set up a temporary log file path.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(directory.name, 'polls.log')
+
+    def record(self, message='User %s voted', *args, level=logging.INFO, **extra):
+        """
+        Return a log record with extra fields.
+        """
+        record = logging.makeLogRecord({'name': 'polls', 'levelno': level,
+                                        'levelname': logging.getLevelName(level),
+                                        'msg': message, 'args': args})
+        record.__dict__.update(extra)
+        return record
+
+    def read_lines(self, handler):
+        """
+        Return the JSON objects in the log file of a handler.
+        """
+        with open(handler.file_handler.baseFilename) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_records_are_written_as_json(self):
+        """
+        Records are formatted lazily in the writer thread as JSON lines.
+        """
+        handler = QueuedJSONHandler(self.path)
+        handler.handle(self.record('User %s voted', 7, event='vote', user_id=7))
+        handler.close()
+        [line] = self.read_lines(handler)
+        self.assertEqual(line['message'], 'User 7 voted')
+        self.assertEqual((line['event'], line['user_id'], line['level']), ('vote', 7, 'INFO'))
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        """
+        A stalled writer makes records drop, never the caller wait.
+        """
+        handler = QueuedJSONHandler(self.path, queue_size=2)
+        release = threading.Event()
+        with mock.patch.object(handler.file_handler, 'emit_batch',
+                               side_effect=lambda records: release.wait()):
+            started = time.monotonic()
+            for _ in range(50):
+                handler.handle(self.record())
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertGreater(handler.dropped, 0)
+            release.set()
+            handler.close()
+
+    def test_file_is_rotated_by_size(self):
+        """
+        The log file is rolled over once it would grow past max_bytes.
+        """
+        handler = QueuedJSONHandler(self.path, max_bytes=200, backup_count=2, batch_size=1)
+        for number in range(10):
+            handler.handle(self.record('Record number %s', number))
+        handler.close()
+        path = handler.file_handler.baseFilename
+        self.assertTrue(os.path.exists(path + '.1'))
+        self.assertLessEqual(os.path.getsize(path), 200)
+
+    def test_sampling_keeps_warnings(self):
+        """
+        Sampled-away events drop their info records but not their warnings.
+        """
+        handler = QueuedJSONHandler(self.path, sample_rates={'vote': 0.0})
+        handler.handle(self.record(event='vote'))
+        handler.handle(self.record(event='login'))
+        handler.handle(self.record(event='vote', level=logging.WARNING))
+        handler.close()
+        lines = self.read_lines(handler)
+        self.assertEqual([(line['event'], line['level']) for line in lines],
+                         [('login', 'INFO'), ('vote', 'WARNING')])
+
+    def test_processes_share_one_file(self):
+        """
+        A forked worker appends to the same file as its parent.
+        """
+        handler = QueuedJSONHandler(self.path)
+        handler.handle(self.record('From the parent'))
+        handler.flush()
+        with mock.patch('os.getpid', return_value=4242):
+            handler.handle(self.record('From the worker'))
+            handler.flush()
+        handler.close()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['polls.log', 'polls.log.lock'])
+        self.assertEqual([line['message'] for line in self.read_lines(handler)],
+                         ['From the parent', 'From the worker'])
+
+    def test_flush_keeps_the_writer_running(self):
+        """
+        Flushing waits for the queued records without stopping the writer.
+        """
+        handler = QueuedJSONHandler(self.path)
+        handler.handle(self.record('Before the flush'))
+        handler.flush()
+        writer = handler._writer
+        self.assertEqual(len(self.read_lines(handler)), 1)
+        self.assertTrue(writer.is_alive())
+        handler.handle(self.record('After the flush'))
+        handler.close()
+        self.assertIs(handler._writer, writer)
+        self.assertEqual(len(self.read_lines(handler)), 2)
+
+    def test_file_rotated_by_another_process_is_reopened(self):
+        """
+        A handler whose file was rotated elsewhere writes to the new file.
+        """
+        handler = QueuedJSONHandler(self.path)
+        handler.handle(self.record('Before the rotation'))
+        handler.flush()
+        os.rename(self.path, self.path + '.1')
+        handler.handle(self.record('After the rotation'))
+        handler.close()
+        self.assertEqual([line['message'] for line in self.read_lines(handler)],
+                         ['After the rotation'])
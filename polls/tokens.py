@@ -0,0 +1,35 @@
+"""
+Bearer tokens for API clients such as kiosks.
+
+A client sends "Authorization: Bearer <token>" instead of a session
+cookie, so its requests need no CSRF token. Only the SHA-256 digest of a
+token is stored, and create_token() returns the token itself once.
+"""
+import hashlib
+import secrets
+
+from .models import ApiToken
+
+
+def token_digest(token):
+    """Return the digest a token is stored under."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_token(user, name):
+    """Create a token for user and return it."""
+    token = secrets.token_urlsafe(32)
+    ApiToken.objects.create(user=user, name=name, digest=token_digest(token))
+    return token
+
+
+def token_user(request):
+    """Return the active user of the request's bearer token, or None."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+    api_token = (ApiToken.objects.select_related('user')
+                 .filter(digest=token_digest(token.strip())).first())
+    if api_token is None or not api_token.user.is_active:
+        return None
+    return api_token.user
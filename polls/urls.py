@@ -1,4 +1,5 @@
-from django.urls import path
+from django.conf import settings
+from django.urls import path, re_path
 
 from . import views
 
@@ -7,5 +8,15 @@ urlpatterns = [
     path('', views.IndexView.as_view(), name='index'),
     path('<int:pk>/', views.DetailView.as_view(), name='detail'),
     path('<int:pk>/results/', views.ResultsView.as_view(), name='results'),
+    path('<int:pk>/results/stream/', views.results_stream,
+         name='results_stream'),
+    path('<int:pk>/results/poll/', views.results_poll, name='results_poll'),
+    path('api/results', views.results_api, name='results_api'),
+    path('api/votes/', views.vote_batch, name='vote_batch'),
     path('<int:question_id>/vote/', views.vote, name='vote'),
-]
\ No newline at end of file
+    re_path(r'^export/(?P<kind>votes|results)\.(?P<export_format>csv|ndjson)$',
+            views.export_data, name='export'),
+]
+
+if settings.POLLS_ASYNC_VIEWS:
+    from .async_urls import urlpatterns  # noqa: F811
@@ -1,29 +1,206 @@
 """Views for index, detail, and result pages."""
-from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponseRedirect, Http404
+from datetime import datetime
+
+from django.shortcuts import redirect
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseRedirect, Http404, JsonResponse,
+                         StreamingHttpResponse)
 from django.urls import reverse
+from django.utils.safestring import mark_safe
 from django.views import generic
 from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+from django.utils.text import compress_sequence, compress_string
 from django.contrib import messages
-from django.contrib.auth.decorators import login_required
-from .models import Choice, Question, Vote
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.contrib.auth.decorators import login_required, permission_required
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.db import IntegrityError, transaction
+from django.db.models import Min, Q
+from django.conf import settings
+from django.core.cache import cache
+from mysite.routers import primary_reads
+from . import metrics
+from .budget import query_budget
+from .cache import (get_results_table, index_page_key, index_timeout,
+                    index_version, invalidate_results, results_versions)
+from .conditional import (may_have_messages, not_modified, results_validators,
+                          set_validators)
+from .batch import BatchError, count_results, parse_batch, submit_votes
+from .ingest import buffered_ingestion, get_journal
+from .dashboard import parse_ids, published_ids, results_document
+from .export import EXPORT_FORMATS, export, parse_filters
+from .live import final_tally, poll_tally, short_poll_events
+from .models import Question, ResultSnapshot, Vote
+from .question_cache import forget_question, get_choices, get_question
+from .rendering import load_messages, render_page, render_template, signed_in
+from .staticfiles import MIN_COMPRESS_SIZE, accepted_encodings
+from .tokens import token_user
 from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.dispatch import receiver
 import logging
 
 
+INDEX_PAGE_SIZE = 20
+# results API requests for more questions than this are streamed
+RESULTS_API_STREAM_THRESHOLD = 100
+
+
+def encode_cursor(question):
+    """Return the keyset cursor pointing just after the given question."""
+    position = f"{question.pub_date.isoformat()}|{question.id}"
+    return urlsafe_base64_encode(position.encode())
+
+
+def decode_cursor(cursor):
+    """Return the (pub_date, id) of a cursor, or None if it is invalid."""
+    try:
+        pub_date, question_id = (urlsafe_base64_decode(cursor).decode()
+                                 .split('|'))
+        return datetime.fromisoformat(pub_date), int(question_id)
+    except ValueError:
+        return None
+
+
+def index_queryset(params):
+    """Return the published questions of the index page the params ask for."""
+    now = timezone.now()
+    questions = Question.objects.published(now).with_is_open(now)
+    if params.get('status') == 'open':
+        questions = questions.open(now)
+    position = decode_cursor(params.get('after', ''))
+    if position:
+        pub_date, question_id = position
+        questions = questions.filter(
+            Q(pub_date__lt=pub_date)
+            | Q(pub_date=pub_date, id__lt=question_id))
+    # one extra row tells whether there is a next page
+    return questions.order_by('-pub_date', '-id')[:INDEX_PAGE_SIZE + 1]
+
+
+def split_index_page(questions):
+    """Return the questions to show and the cursor of the next page."""
+    if len(questions) > INDEX_PAGE_SIZE:
+        return (questions[:INDEX_PAGE_SIZE],
+                encode_cursor(questions[INDEX_PAGE_SIZE - 1]))
+    return questions, None
+
+
+def choices_of(question, *fields):
+    """Return the choices of a question in display order."""
+    # question is loaded too, or attaching the known question to every
+    # choice would fetch the deferred question_id one row at a time
+    return question.choice_set.only('question', *fields).order_by('id')
+
+
+def next_index_changes(now):
+    """Return the Min() aggregates of the next pub_date and end_date."""
+    return {
+        'next_pub_date': Min('pub_date', filter=Q(pub_date__gt=now)),
+        'next_end_date': Min('end_date', filter=Q(end_date__gt=now)),
+    }
+
+
+def is_anonymous_read(request):
+    """Return True for a GET with no session and no pending messages."""
+    return (request.method == 'GET'
+            and settings.SESSION_COOKIE_NAME not in request.COOKIES
+            and CookieStorage.cookie_name not in request.COOKIES)
+
+
+def index_page_validators(version, now):
+    """Return the ETag and Last-Modified timestamp of an index page."""
+    # the page also changes when polls open or close, so it is named by
+    # when it was rendered as well as by the version of the questions
+    rendered = int(now.timestamp())
+    return f'"index-{version}-{rendered}"', rendered
+
+
+def render_results_table(question):
+    """Return the results table of a question, frozen once it is finalized."""
+    # only a question that can no longer be voted on has a snapshot
+    if not question.can_vote():
+        html = (ResultSnapshot.objects.filter(question_id=question.id)
+                .values_list('html', flat=True).first())
+        if html is not None:
+            return html
+    return render_template('polls/results_table.html', {
+        'choices': list(choices_of(question, 'choice_text', 'vote_count')),
+    })
+
+
+def find_choice(choices, choice_id):
+    """Return the choice with the posted id, or None."""
+    try:
+        choice_id = int(choice_id)
+    except (TypeError, ValueError):
+        return None
+    return next((choice for choice in choices if choice.id == choice_id), None)
+
+
+@method_decorator(query_budget(3), name='dispatch')
 class IndexView(generic.ListView):
-    """Index view that is displaying top 5 recent questions."""
+    """Index view that is displaying published questions, newest first."""
 
     template_name = 'polls/index.html'
     context_object_name = 'latest_question_list'
 
+    def get(self, request, *args, **kwargs):
+        """
+        Serve anonymous visitors a cached page.
+
+        The page is cached until the next poll opens or closes, or until a
+        question is saved, so its OPEN and CLOSED badges are never stale.
+        Its ETag names the cached copy, so a client holding it gets a 304.
+        """
+        if not is_anonymous_read(request):
+            return super().get(request, *args, **kwargs)
+        version = index_version()
+        key = index_page_key(request.GET, version)
+        page = cache.get(key)
+        if page is not None:
+            content, etag, last_modified = page
+            return (not_modified(request, etag, last_modified)
+                    or set_validators(HttpResponse(content), etag,
+                                      last_modified))
+        now = timezone.now()
+        # the page is shared by every visitor, so it is read from the primary
+        with primary_reads():
+            response = super().get(request, *args, **kwargs)
+            timeout = index_timeout(now, Question.objects.aggregate(
+                **next_index_changes(now)).values())
+        if timeout > 0:
+            etag, last_modified = index_page_validators(version, now)
+            cache.set(key, (response.content, etag, last_modified), timeout)
+            set_validators(response, etag, last_modified)
+        return response
+
+    def render_to_response(self, context, **response_kwargs):
+        """Render the page with the polls template engine."""
+        return render_page(self.request, self.template_name, context)
+
     def get_queryset(self):
-        """Return all published questions."""
-        return (Question.objects.filter(pub_date__lte=timezone.now())
-                .order_by('-pub_date'))
+        """Return one page of published questions after the cursor."""
+        page, self.next_cursor = split_index_page(
+            list(index_queryset(self.request.GET)))
+        return page
+
+    def get_context_data(self, **kwargs):
+        """Add the cursor of the next page and the status filter."""
+        context = super().get_context_data(**kwargs)
+        # the page greets the user and shows messages, so both are loaded
+        # before rendering
+        context['signed_in'] = signed_in(self.request)
+        load_messages(self.request)
+        context['next_cursor'] = self.next_cursor
+        context['status'] = self.request.GET.get('status', '')
+        return context
 
 
+@method_decorator(query_budget(5), name='dispatch')
 class DetailView(generic.DetailView):
     """Detail view that displaying choices specially for each question."""
 
@@ -32,9 +209,8 @@ class DetailView(generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         """Handle the Get request for the detail view."""
-        try:
-            question = get_object_or_404(Question, pk=kwargs["pk"])
-        except Http404:
+        question = get_question(kwargs["pk"])
+        if question is None:
             messages.error(request,
                            f"Poll number {kwargs['pk']} does not exists.")
             return redirect("kupolls:index")
@@ -50,20 +226,19 @@ class DetailView(generic.DetailView):
 
         user_vote = None
         if request.user.is_authenticated:
-            try:
-                previous_vote = (Vote.objects.get
-                                 (user=request.user, choice__question=question))
-                user_vote = previous_vote.choice.id
-            except Vote.DoesNotExist:
-                user_vote = None
+            user_vote = (Vote.objects
+                         .filter(user=request.user, question=question)
+                         .values_list('choice_id', flat=True).first())
 
-        return render(request, self.template_name, {
+        return render_page(request, self.template_name, {
             'question': question,
+            'choices': get_choices(question.id),
             'user_vote': user_vote,
             'error_message': self.request.GET.get('error_message')
         })
 
 
+@method_decorator(query_budget(3), name='dispatch')
 class ResultsView(generic.DetailView):
     """Result view for each question."""
 
@@ -72,63 +247,209 @@ class ResultsView(generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         """Handle the Get request for the result view."""
-        try:
-            question = get_object_or_404(Question, pk=kwargs["pk"])
-        except Http404:
+        question = get_question(kwargs["pk"])
+        if question is None:
             messages.error(request, f"Poll number {kwargs['pk']} does not exists.")
             return redirect("kupolls:index")
         if not question.is_published():
             messages.error(self.request, f"Result for poll number {question.id} is not available yet.")
             return redirect("kupolls:index")
-        return render(request, self.template_name, {"question": question})
+        # a page showing flash messages is not the one the version names
+        conditional = not may_have_messages(request)
+        if conditional:
+            etag, last_modified = results_validators(question)
+            response = not_modified(request, etag, last_modified)
+            if response is not None:
+                return response
+        results_table = get_results_table(
+            question.id, lambda: render_results_table(question))
+        load_messages(request)
+        response = render_page(request, self.template_name, {
+            "question": question,
+            "results_table": mark_safe(results_table),
+            "live": question.can_vote(),
+        })
+        if conditional:
+            set_validators(response, etag, last_modified)
+        return response
+
+def published_question_or_404(pk):
+    """Return a published question or raise Http404."""
+    question = get_question(pk)
+    if question is None:
+        raise Http404(f"Poll number {pk} does not exist.")
+    if not question.is_published():
+        raise Http404(f"Poll number {pk} is not published yet.")
+    return question
+
+
+@query_budget(2)
+def results_stream(request, pk):
+    """Answer an EventSource with the current vote counts, then close."""
+    question = published_question_or_404(pk)
+    if not question.can_vote():
+        # the counts are final; 204 stops the EventSource reconnecting
+        return HttpResponse(status=204)
+    # a WSGI worker is not held open; the client reconnects to poll again
+    response = HttpResponse(
+        short_poll_events(question.id, request.headers.get('Last-Event-ID', '')),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@query_budget(2)
+def results_poll(request, pk):
+    """Return the vote counts if they changed from the ?since= version."""
+    question = published_question_or_404(pk)
+    if not question.can_vote():
+        return JsonResponse(final_tally(question.id))
+    payload = poll_tally(question.id, request.GET.get('since', ''))
+    if payload is None:
+        return HttpResponse(status=204)
+    return JsonResponse(payload)
+
+def results_api_response(request, wrap=None):
+    """Return the vote counts of the ?ids= questions as gzipped JSON."""
+    try:
+        question_ids, known = parse_ids(request.GET.get('ids', ''),
+                                        settings.POLLS_RESULTS_API_MAX_IDS)
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
+    # versions are only kept for questions that exist
+    versions = results_versions(published_ids(question_ids))
+    chunks = results_document(question_ids, versions, known)
+    gzipped = 'gzip' in accepted_encodings(
+        request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    if len(question_ids) > RESULTS_API_STREAM_THRESHOLD:
+        if gzipped:
+            chunks = compress_sequence(chunks)
+        response = StreamingHttpResponse(wrap(chunks) if wrap else chunks,
+                                         content_type='application/json')
+    else:
+        content = b''.join(chunks)
+        gzipped = gzipped and len(content) >= MIN_COMPRESS_SIZE
+        response = HttpResponse(compress_string(content) if gzipped
+                                else content, content_type='application/json')
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+@query_budget(2)
+def results_api(request):
+    """Return the vote counts of several questions at once."""
+    return results_api_response(request)
+
+def export_response(request, kind, export_format, wrap=None):
+    """Return a streaming export of votes or results for the request."""
+    try:
+        filters = parse_filters(request.GET.get('question'),
+                                request.GET.get('since'),
+                                request.GET.get('until'))
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
+    lines = export(kind, export_format, filters)
+    response = StreamingHttpResponse(wrap(lines) if wrap else lines,
+                                     content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = (f'attachment; '
+                                       f'filename="{kind}.{export_format}"')
+    return response
+
+
+@query_budget(4)
+@login_required
+@permission_required('polls.view_vote', raise_exception=True)
+def export_data(request, kind, export_format):
+    """Stream votes or per-choice results as CSV or NDJSON."""
+    return export_response(request, kind, export_format)
 
 logger = logging.getLogger('polls')
+@query_budget(9)
 @login_required
 def vote(request, question_id):
     """Vote for one of the answers to a question."""
-    question = get_object_or_404(Question, pk=question_id)
     this_user = request.user
+    # the question and its choices usually come from the in-process cache
+    with metrics.timer('polls_vote_phase_seconds', phase='lookup'):
+        question = get_question(question_id)
+        if question is None:
+            raise Http404(f"Poll number {question_id} does not exist.")
+        choices = get_choices(question.id)
+        selected_choice = find_choice(choices, request.POST.get('choice'))
 
     if not question.can_vote():
-        logging.info(f"User {this_user} attempted to vote on question {question_id}, but voting is not allowed.")
+        logger.info("User %s attempted to vote on closed question %s",
+                    this_user.pk, question_id,
+                    extra={'event': 'vote_rejected', 'user_id': this_user.pk,
+                           'question_id': question_id})
         # If voting is not allowed, redisplay the question voting form with an error message.
-        return render(request, 'kupolls/detail.html', {
+        return render_page(request, 'polls/detail.html', {
             'question': question,
+            'choices': choices,
             'error_message': "Voting is not allowed for this question.",
         })
 
-    choice_id = request.POST.get('choice')
-
-    if choice_id is None:
+    if selected_choice is None:
         # If no choice is selected, redisplay the question voting form with an error message.
-        return render(request, 'polls/detail.html', {
+        return render_page(request, 'polls/detail.html', {
             'question': question,
+            'choices': choices,
             'error_message': "You didn't select a choice.",
         })
 
-    try:
-        selected_choice = question.choice_set.get(pk=request.POST['choice'])
-    except (KeyError, Choice.DoesNotExist):
-        # Redisplay the question voting form.
-        return render(request, 'kupolls/detail.html', {
-            'question': question,
-            'error_message': "You didn't select a choice.",
-        })
-
-    try:
-        # find a vote for this user and this question.
-        vote = Vote.objects.get(user=this_user, choice__question=question)
-        # update his vote
-        vote.choice = selected_choice
-    except Vote.DoesNotExist:
-        # no matching vote - create new Vote
-        vote = Vote.objects.create(user=this_user, choice=selected_choice)
-
-    vote.save()
-    logger.info(f"User {this_user} successfully voted on question {question_id} for choice {selected_choice.id}.")
+    with metrics.timer('polls_vote_phase_seconds', phase='write'):
+        if buffered_ingestion():
+            # flush_votes writes the queued vote in a later batch
+            get_journal().append(this_user.pk, question.id, selected_choice.id)
+        else:
+            # a single upsert on (user, question) replaces any earlier vote
+            try:
+                Vote.objects.record(this_user, selected_choice)
+            except IntegrityError:
+                # the cached choice was deleted by another process
+                forget_question(question.id)
+                raise Http404(f"Choice {selected_choice.id} does not exist.")
+            transaction.on_commit(lambda: invalidate_results(question.id))
+    logger.info("User %s voted on question %s for choice %s",
+                this_user.pk, question.id, selected_choice.id,
+                extra={'event': 'vote', 'user_id': this_user.pk,
+                       'question_id': question.id,
+                       'choice_id': selected_choice.id})
     messages.success(request, "Your vote has been recorded")
     return HttpResponseRedirect(reverse('kupolls:results', args=(question.id,)))
 
+
+# kiosks send a bearer token, not a session cookie, so CSRF cannot apply
+@csrf_exempt
+@require_POST
+# the token and the user's permissions, two queries to check the votes and
+# up to four to write a batch that fits one statement each
+@query_budget(9)
+def vote_batch(request):
+    """Record a JSON batch of votes from a kiosk, reporting on each one."""
+    user = token_user(request)
+    if user is None:
+        response = JsonResponse({'error': "A valid bearer token is required."},
+                                status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    if not user.has_perm('polls.add_vote'):
+        return JsonResponse(
+            {'error': "The token's user may not add votes."}, status=403)
+    try:
+        records = parse_batch(request.body, settings.POLLS_VOTE_BATCH_MAX_SIZE)
+    except BatchError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    results = submit_votes(records)
+    counts = count_results(results)
+    logger.info("User %s submitted a batch of %s votes", user.pk,
+                len(records),
+                extra={'event': 'vote_batch', 'user_id': user.pk,
+                       'counts': counts})
+    return JsonResponse({'results': results, 'counts': counts})
+
 def get_client_ip(request):
     """Get the visitor’s IP address using request headers."""
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
@@ -143,10 +464,16 @@ def get_client_ip(request):
 def log_user_login(sender, request, user, **kwargs):
     """Log when a user logs in."""
     ip_addr = get_client_ip(request)
-    logger.info(f"User {user.username} logged in from IP: {ip_addr}")
+    logger.info("User %s logged in from IP: %s", user.username, ip_addr,
+                extra={'event': 'login', 'username': user.username,
+                       'ip': ip_addr})
 
 @receiver(user_logged_out)
 def log_user_logout(sender, request, user, **kwargs):
     """Log when a user logs out."""
     ip_addr = get_client_ip(request)
-    logger.info(f"User {user.username} logged out from IP: {ip_addr}")
\ No newline at end of file
+    # user is None when nobody was logged in
+    username = getattr(user, 'username', None)
+    logger.info("User %s logged out from IP: %s", username, ip_addr,
+                extra={'event': 'logout', 'username': username,
+                       'ip': ip_addr})
\ No newline at end of file